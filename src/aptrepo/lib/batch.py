@@ -0,0 +1,165 @@
+"""
+:Description:
+    Batch mode of apt-repo and apt-pkg ('--batch [file]', '-' for stdin):
+    any number of commands run in one process, sharing the configuration,
+    package databases and catalogs the first of them loaded, instead of
+    paying interpreter start up and loading per command.
+
+    A command is one line, either the arguments that would follow the
+    program name on a command line (split as a shell would), or a JSON
+    object with "args" (a list, or a string split the same way) and
+    optional "options" ({"jobs": 2, "flat": true} -> --jobs 2 --flat):
+
+        stable add build/*.deb --jobs 4
+        {"args": ["stable", "remove", "oldtool"]}
+
+    Options given on the command line next to --batch are the defaults of
+    every command. Blank lines and lines starting with "#" are skipped. One JSON result is
+    written per command:
+
+        {"line": 1, "command": [...], "ok": true, "status": 0,
+         "result": ..., "output": "...", "error": null, "seconds": 0.12}
+
+    where output is what the command printed and error what it reported
+    on stderr (or the exception that stopped it).
+"""
+
+import io
+import os
+import sys
+import json
+import argparse
+import time
+import shlex
+import contextlib
+import traceback
+
+def option_args(options):
+    """ Command line arguments for {option: value} """
+    argv = []
+    for k, v in options.items():
+        flag = "--{}".format(k.replace('_', '-'))
+        if v is True:
+            argv.append(flag)
+
+        elif v is None or v is False:
+            continue
+
+        elif isinstance(v, (list, tuple)):
+            argv.append(flag)
+            argv.extend(str(x) for x in v)
+
+        else:
+            argv.extend([flag, str(v)])
+
+    return argv
+
+def parse_command(line):
+    """ The argument list of one batch line, None for lines to skip """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+
+    if not line.startswith('{'):
+        return shlex.split(line)
+
+    command = json.loads(line)
+    args = command.get('args', [])
+    argv = shlex.split(args) if isinstance(args, str) else [str(a) for a in args]
+    return argv + option_args(command.get('options', {}))
+
+def parse_with_defaults(parser, defaults, argv):
+    """ parser.parse_args(argv), with options not given defaulting to those of the namespace defaults """
+    namespace = argparse.Namespace(**vars(defaults))
+    namespace.batch = None
+    return parser.parse_args(argv, namespace)
+
+def read_commands(path):
+    """ Yields (line number, argument list or the exception parsing it) for the file at path, or stdin """
+    f = sys.stdin if path == '-' else open(path, 'r')
+    try:
+        for n, line in enumerate(f, 1):
+            try:
+                argv = parse_command(line)
+
+            except ValueError as E:
+                yield n, E
+                continue
+
+            if argv is not None:
+                yield n, argv
+
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def run_command(execute, argv):
+    """ Runs execute(argv) with its output captured; returns the result dict (without line) """
+    out, err = io.StringIO(), io.StringIO()
+    result = dict(command=argv, ok=False, status=1, result=None, output="", error=None)
+    start = time.monotonic()
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            result['result'] = execute(argv)
+
+        result['ok'], result['status'] = True, 0
+
+    except SystemExit as E:
+        # argparse errors and the tools' own exit codes
+        result['status'] = E.code if isinstance(E.code, int) else (0 if E.code is None else 1)
+        result['ok'] = result['status'] == 0
+        if isinstance(E.code, str):
+            err.write(E.code)
+
+    except Exception as E:
+        err.write("{}: {}".format(type(E).__name__, E))
+        result['trace'] = traceback.format_exc()
+        result['status'] = getattr(E, 'code', 1) if isinstance(getattr(E, 'code', 1), int) else 1
+
+    result['output'] = out.getvalue()
+    result['error'] = err.getvalue().strip() or None
+    result['seconds'] = round(time.monotonic() - start, 6)
+    return result
+
+@contextlib.contextmanager
+def results_stream(stream):
+    """ Child processes (dpkg-deb) write to fd 1: while results go to stdout, fd 1 is stderr """
+    if stream is not sys.stdout:
+        yield stream
+        return
+
+    sys.stdout.flush()
+    saved = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        with os.fdopen(os.dup(saved), 'w') as results:
+            yield results
+
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+
+def run_batch(path, execute, stream=None):
+    """
+    :Description:
+        Runs every command of the batch file at path through
+        execute(argument list), which returns the command's result, and
+        writes one JSON line per command to stream. Returns the number of
+        commands that failed.
+    """
+    failed = 0
+    with results_stream(stream or sys.stdout) as stream:
+        for n, argv in read_commands(path):
+            if isinstance(argv, Exception):
+                result = dict(command=None, ok=False, status=1, result=None, output="",
+                              error="Invalid command: {}".format(argv), seconds=0)
+
+            else:
+                result = run_command(execute, argv)
+
+            result = dict(line=n, **result)
+            failed += 0 if result['ok'] else 1
+            stream.write(json.dumps(result, default=str, sort_keys=True) + "\n")
+            stream.flush()
+
+    return failed
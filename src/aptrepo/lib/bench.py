@@ -0,0 +1,356 @@
+"""
+:Description:
+    Benchmarks of the main apt-pkg and apt-repo paths on synthetic data, run
+    by 'apt-bench'. make_workspace() generates a package workspace of N
+    packages with M files each, file sizes drawn from a distribution, spread
+    over K architectures; Bench then times:
+
+    o hashing the payload files (md5, sha1 and sha256 in one read)
+    o PackageDB writes and reads, and loading the whole workspace
+    o build_package() for deb (dpkg-deb and the native writer) and ipk
+    o a Packages_gz() scan of the built packages, cold and cached
+    o apt-repo add, info, haspkg and remove on a repository with the
+      requested architectures and components
+
+    Results are JSON (see run_benchmarks) so runs can be compared with
+    compare_results(). Everything runs offline; the dpkg-deb case is
+    skipped when dpkg-deb is not installed, the native writer still
+    provides the packages the repository cases publish.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import random
+import shutil
+import platform
+import datetime
+import statistics
+import contextlib
+import subprocess
+import aptrepo.lib.db
+import aptrepo.lib.build
+import aptrepo.lib.workspace
+from aptrepo.lib.repository import Repository
+from aptrepo.lib.scanpackages import Packages_gz, stanza_cache_path
+from aptrepo.lib.security import hash_file
+
+FORMAT_VERSION = 1
+
+CASES = ["hash", "db_write", "db_read", "workspace_load", "workspace_load_cached",
+         "build_deb_dpkg", "build_deb_native", "build_ipk", "packages_gz", "packages_gz_cached",
+         "repo_add", "repo_info", "repo_haspkg", "repo_remove"]
+
+DEFAULTS = dict(packages=20, files=10, sizes="1K-64K", architectures=["amd64"],
+                components=["main"], repeat=3, seed=0)
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_size(text):
+    """ "512", "4K", "1.5M" -> bytes """
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1] if text and text[-1] in UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+def size_distribution(spec):
+    """
+    :Description:
+        Returns a function drawing a file size from a random.Random for
+        spec: "4K" (fixed), "1K-64K" (uniform) or "lognormal:16K[:sigma]"
+        (median 16K, sigma 1.0 unless given).
+    """
+    if spec.startswith("lognormal:"):
+        parts = spec.split(':')
+        median = parse_size(parts[1])
+        sigma = float(parts[2]) if len(parts) > 2 else 1.0
+        return lambda rng: max(1, int(rng.lognormvariate(0, sigma) * median))
+
+    if '-' in spec:
+        low, high = [parse_size(s) for s in spec.split('-', 1)]
+        return lambda rng: rng.randint(low, high)
+
+    size = parse_size(spec)
+    return lambda rng: size
+
+def payload(rng, size):
+    """ size bytes that compress about as well as typical package content (half random, half text) """
+    half = size // 2
+    text = (b"synthetic apt-bench payload line\n" * (half // 33 + 1))[:size - half]
+    return rng.randbytes(half) + text
+
+def make_workspace(directory, packages, files, sizes, architectures, seed=0):
+    """
+    :Description:
+        Creates packages package folders with files payload files each in
+        directory, each with its package database; package i is built for
+        architectures[i % len(architectures)]. Returns the package names.
+    """
+    rng = random.Random(seed)
+    draw = size_distribution(sizes)
+    names = []
+    for i in range(packages):
+        name = "bench{:05d}".format(i)
+        src = os.path.join(directory, name, "src")
+        os.makedirs(src, exist_ok=True)
+        db = aptrepo.lib.db.PackageDB(directory, name, directory=directory,
+                                      architecture=[architectures[i % len(architectures)]],
+                                      desc="apt-bench synthetic package",
+                                      description=["Generated by apt-bench"],
+                                      maintainer=["apt-bench <apt-bench@localhost>"])
+        for j in range(files):
+            path = os.path.join(src, "file{:04d}.dat".format(j))
+            with open(path, 'wb') as f:
+                f.write(payload(rng, draw(rng)))
+
+            db.db['Files'][path] = "/usr/share/{}/file{:04d}.dat".format(name, j)
+
+        db.write()
+        names.append(name)
+
+    return names
+
+@contextlib.contextmanager
+def silenced():
+    """ Discards what the timed code prints, child processes (dpkg-deb) included """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    os.close(devnull)
+    try:
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f), contextlib.redirect_stderr(f):
+            yield
+
+    finally:
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved:
+            os.close(fd)
+
+def summarize(seconds):
+    return dict(status="ok", seconds=[round(s, 6) for s in seconds], min=round(min(seconds), 6),
+                median=round(statistics.median(seconds), 6), mean=round(statistics.mean(seconds), 6))
+
+def environment():
+    dpkg = shutil.which('dpkg-deb')
+    version = None
+    if dpkg:
+        try:
+            version = subprocess.run([dpkg, '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                     universal_newlines=True).stdout.split('\n')[0]
+
+        except OSError:
+            pass
+
+    return dict(python=platform.python_version(), implementation=platform.python_implementation(),
+                platform=platform.platform(), machine=platform.machine(), cpus=os.cpu_count(),
+                dpkg_deb=version)
+
+class Bench(object):
+    """
+    :Description:
+        One benchmark run in workdir. Call the case_* methods (or run())
+        in CASES order: later cases use what earlier ones built.
+    """
+
+    def __init__(self, workdir, packages, files, sizes, architectures, components, repeat, seed=0):
+        self.workdir = os.path.abspath(workdir)
+        self.params = dict(packages=packages, files=files, sizes=sizes, architectures=architectures,
+                           components=components, repeat=repeat, seed=seed)
+        self.repeat = repeat
+        self.wsdir = os.path.join(self.workdir, "workspace")
+        self.outdir = os.path.join(self.workdir, "packages")
+        os.makedirs(self.wsdir, exist_ok=True)
+        os.makedirs(self.outdir, exist_ok=True)
+        with silenced():
+            self.names = make_workspace(self.wsdir, packages, files, sizes, architectures, seed)
+
+        self.dbs = aptrepo.lib.workspace.load_workspace(self.wsdir, use_cache=False)
+        self.results = {}
+
+    def measure(self, fn, setup=None):
+        seconds = []
+        for i in range(self.repeat):
+            if setup is not None:
+                with silenced():
+                    setup()
+
+            with silenced():
+                start = time.perf_counter()
+                fn()
+                seconds.append(time.perf_counter() - start)
+
+        return summarize(seconds)
+
+    def payload_files(self):
+        return [f for db in self.dbs.values() for f in db.db['Files']]
+
+    def case_hash(self):
+        paths = self.payload_files()
+        result = self.measure(lambda: [hash_file(p, ["md5", "sha1", "sha256"]) for p in paths])
+        size = sum(os.path.getsize(p) for p in paths)
+        result.update(files=len(paths), bytes=size, mb_per_second=round(size / result['min'] / 1024 ** 2, 2))
+        return result
+
+    def case_db_write(self):
+        return self.measure(lambda: [db.write() for db in self.dbs.values()])
+
+    def case_db_read(self):
+        # Every read parses again: the per process parse cache is emptied first
+        return self.measure(lambda: [aptrepo.lib.db.PackageDB(self.wsdir, n) for n in self.names],
+                            setup=aptrepo.lib.db._PARSED.clear)
+
+    def case_workspace_load(self):
+        return self.measure(lambda: aptrepo.lib.workspace.load_workspace(self.wsdir, use_cache=False),
+                            setup=aptrepo.lib.db._PARSED.clear)
+
+    def case_workspace_load_cached(self):
+        aptrepo.lib.workspace.load_workspace(self.wsdir)
+        return self.measure(lambda: aptrepo.lib.workspace.load_workspace(self.wsdir),
+                            setup=aptrepo.lib.db._PARSED.clear)
+
+    def build(self, profile, writer, target):
+        """ Builds every package with profile (and writer) into target """
+        os.makedirs(target, exist_ok=True)
+        cwd = os.getcwd()
+        os.chdir(target)
+        try:
+            for n, db in self.dbs.items():
+                kwargs = dict(db.db)
+                kwargs['Build'] = dict(kwargs['Build'], profiles=[profile], writer=writer)
+                kwargs['Package'] = dict(kwargs['Package'], directory=target)
+                retcodes = aptrepo.lib.build.build_package(self.wsdir, n, **kwargs)
+                if any(r != 0 for r in retcodes):
+                    raise Exception("Building {} failed: {}".format(n, retcodes))
+
+        finally:
+            os.chdir(cwd)
+
+    def case_build_deb_dpkg(self):
+        if not shutil.which('dpkg-deb'):
+            return dict(status="skipped", reason="dpkg-deb not installed")
+
+        return self.measure(lambda: self.build('deb', 'dpkg', os.path.join(self.outdir, "dpkg")))
+
+    def case_build_deb_native(self):
+        return self.measure(lambda: self.build('deb', 'native', os.path.join(self.outdir, "native")))
+
+    def case_build_ipk(self):
+        return self.measure(lambda: self.build('ipk', 'dpkg', os.path.join(self.outdir, "ipk")))
+
+    def debs(self):
+        debs = sorted(glob.glob(os.path.join(self.outdir, "native", "*.deb")))
+        if not debs:
+            with silenced():
+                self.build('deb', 'native', os.path.join(self.outdir, "native"))
+
+            debs = sorted(glob.glob(os.path.join(self.outdir, "native", "*.deb")))
+
+        return debs
+
+    def case_packages_gz(self):
+        self.debs()
+        cache = stanza_cache_path(self.outdir, "native")
+        return self.measure(lambda: Packages_gz(self.outdir, "native"),
+                            setup=lambda: os.path.exists(cache) and os.remove(cache))
+
+    def case_packages_gz_cached(self):
+        self.debs()
+        with silenced():
+            Packages_gz(self.outdir, "native")
+
+        return self.measure(lambda: Packages_gz(self.outdir, "native"))
+
+    def repository(self):
+        if not hasattr(self, 'repo'):
+            self.repo = Repository("bench", os.path.join(self.workdir, "config"),
+                                   directory=os.path.join(self.workdir, "repository"),
+                                   architecture=self.params['architectures'],
+                                   restrictions=self.params['components'])
+            with silenced():
+                self.repo.create()
+
+        return self.repo
+
+    def case_repo_add(self):
+        repo, debs = self.repository(), self.debs()
+        return self.measure(lambda: repo.add(debs), setup=lambda: repo.remove(self.names))
+
+    def case_repo_info(self):
+        repo = self.repository()
+        return self.measure(repo.info)
+
+    def case_repo_haspkg(self):
+        repo = self.repository()
+        return self.measure(lambda: repo.haspkg(self.names))
+
+    def case_repo_remove(self):
+        repo, debs = self.repository(), self.debs()
+        return self.measure(lambda: repo.remove(self.names), setup=lambda: repo.add(debs))
+
+    def run(self, cases=None, progress=None):
+        for case in cases or CASES:
+            if progress is not None:
+                progress.write("{}...\n".format(case))
+                progress.flush()
+
+            try:
+                self.results[case] = getattr(self, "case_" + case)()
+
+            except Exception as E:
+                self.results[case] = dict(status="failed", reason="{}: {}".format(type(E).__name__, E))
+
+        if hasattr(self, 'repo'):
+            self.repo.close()
+
+        return self.results
+
+def run_benchmarks(workdir, cases=None, progress=None, **params):
+    """
+    :Description:
+        Runs the benchmark cases (all of CASES by default) on data generated
+        in workdir from params (see DEFAULTS) and returns the JSON ready
+        result: the parameters, the environment, and per case its status
+        and the seconds of each repetition with their min, median and mean.
+    """
+    options = dict(DEFAULTS)
+    options.update({k: v for k, v in params.items() if not v is None})
+    unknown = [c for c in cases or [] if not c in CASES]
+    if unknown:
+        raise Exception("Unknown benchmark case(s): {} (available: {})".format(
+            ', '.join(unknown), ', '.join(CASES)))
+
+    bench = Bench(workdir, **options)
+    return dict(format=FORMAT_VERSION,
+                created=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                params=bench.params, environment=environment(),
+                cases=bench.run(cases, progress))
+
+def compare_results(old, new, threshold=0.1):
+    """
+    :Description:
+        Compares the min time of every case in two run_benchmarks() results.
+        Returns one dict per case with both times, new/old ratio and a
+        verdict: "slower" or "faster" beyond threshold (0.1 = 10%), "same",
+        or "n/a" when either run did not time the case.
+    """
+    rows = []
+    for case in [c for c in CASES if c in old['cases'] or c in new['cases']]:
+        a, b = old['cases'].get(case, {}), new['cases'].get(case, {})
+        row = dict(case=case, old=a.get('min'), new=b.get('min'), ratio=None, verdict="n/a")
+        if a.get('status') == "ok" and b.get('status') == "ok" and a['min'] > 0:
+            row['ratio'] = round(b['min'] / a['min'], 3)
+            row['verdict'] = "slower" if row['ratio'] > 1 + threshold else \
+                             "faster" if row['ratio'] < 1 - threshold else "same"
+
+        rows.append(row)
+
+    return rows
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)
@@ -1,7 +1,8 @@
 """
 :Description:
-    Module for building the debian packages
-    Currently relies on the dpkg-deb --build command.
+    Module for building the debian packages. Build writer 'dpkg' stages the
+    tree and runs dpkg-deb --build; 'native' writes the .deb in python
+    (debfile.write_deb) without dpkg-deb.
 """
 
 from subprocess import Popen, PIPE
@@ -12,9 +13,22 @@ import sys
 import importlib
 from decimal import *
 import aptrepo.lib.db
+import aptrepo.lib.debfile as debfile
+import aptrepo.lib.compress as compress
 import traceback
 import logging
+import tarfile
+import stat
+import io
+import fnmatch
+import hashlib
+import time
+import aptrepo.lib.trace as trace
+from aptrepo.lib.arch import arch
+from concurrent.futures import ThreadPoolExecutor
+from aptrepo.lib.security import hash_file, CHUNK_SIZE
 
+# Default Build 'exclude' glob patterns
 REMOVE_FILES_FOLDERS = ['__pycache__', '.svn']
 
 SECTIONS = ["admin", "cli-mono", "comm", "database", "debug", "devel", "doc", "editors", "education", "electronics", 
@@ -23,130 +37,359 @@ SECTIONS = ["admin", "cli-mono", "comm", "database", "debug", "devel", "doc", "e
     "news", "ocaml", "oldlibs", "otherosfs", "perl", "php", "python", "ruby", "science", "shells", "sound", "tasks",
     "tex", "text", "utils", "vcs", "video", "web", "x11", "xfce", "zope"]
 
-def copytree(src, dst, write_into=True):
-    logging.debug(__name__)
-    os.makedirs(dst, exist_ok=True)
-    common = ''
-    newdst = ''
-    for root, folders, files in os.walk(src): 
-        for d in folders:
-            common = os.path.commonprefix([src, os.path.join(root, d)])
-            newdst = os.path.join(dst, os.path.join(root, d).replace(common, ''))
-            os.makedirs(newdst, exist_ok=True)
-            #print("Create Dir {} here: {}".format(os.path.join(root, d), newdst))
-            
-        for f in files:
-            common = os.path.commonprefix([src, os.path.join(root, f)])
-            newdst = os.path.join(dst, os.path.join(root, f).replace(common, ''))
-            # Need to ensure directories exist leading to this file
-            #print("Copy File {} here: {}".format(os.path.join(root, f), newdst))
-            shutil.copy2(os.path.join(root, f), newdst)
-                
+def is_non_deployable(arcname, patterns):
+    """
+    Non Deployables are files and folders that no one wants deployed on the
+    target system. Examples of these are "__pycache__" folders from python,
+    ".svn" folders from subversion and other temp files that litter 
+    code folders that shouldn't be placed on the target system.
+    patterns are globs matched against the name and the path in the package.
+    """
+    name = os.path.basename(arcname)
+    return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(arcname, p) for p in patterns)
+
+def _copy_hashed(src, dst):
+    """ Copies src to dst, returning (size, md5) computed from the same read """
+    md5 = hashlib.md5()
+    size = 0
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        for chunk in iter(lambda: fsrc.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+            fdst.write(chunk)
+            size += len(chunk)
 
-def create_deb_struct(path, pkgname, **kwargs):
+    shutil.copystat(src, dst)
+    trace.count("bytes_copied", size)
+    trace.count("bytes_hashed", size)
+    return size, md5.hexdigest()
+
+def build_manifest(stage_to=None, **kwargs):
+    """
+    :Description:
+        Walks the Files and Override sources of a package database once.
+        Non deployables (the Build 'exclude' glob patterns) are pruned before
+        anything is read or copied. Every file is read a single time to
+        record its size and md5, and if stage_to is given it is copied there
+        during that same read.
+
+        Symlinks within source directories are kept as symlinks (entries
+        with their target as link, and no md5) rather than followed.
+
+        Returns a dict of package path to entry dicts holding src (None for
+        directories only implied by a destination path), dir, size and md5.
+    """
     logging.debug(__name__)
-    tmpdir = tempfile.mkdtemp(suffix='tmp', prefix=pkgname, 
-                              dir=os.path.join(path, pkgname))
-    
-    copypath = os.path.join(path, pkgname, tmpdir)
-    os.makedirs(os.path.join(copypath, 'DEBIAN'), exist_ok=True)
+    patterns = kwargs.get('Build', {}).get('exclude', REMOVE_FILES_FOLDERS)
+    manifest = {}
+    tracer = trace.current()
+    started, pruning = time.perf_counter(), [0.0]
+
+    def excluded(arcname):
+        if tracer is None:
+            return is_non_deployable(arcname, patterns)
+
+        # Timed in aggregate: one event per file would cost more than the check
+        t = time.perf_counter()
+        result = is_non_deployable(arcname, patterns)
+        pruning[0] += time.perf_counter() - t
+        if result:
+            tracer.count("files_excluded")
+
+        return result
+
+    def add_dir(arcname, src=None):
+        manifest[arcname] = dict(src=src, dir=True, size=0, md5=None)
+        if not stage_to is None:
+            os.makedirs(os.path.join(stage_to, arcname), exist_ok=True)
+
+    def add_parents(arcname):
+        parents = []
+        parent = os.path.dirname(arcname)
+        while parent and not parent in manifest:
+            parents.insert(0, parent)
+            parent = os.path.dirname(parent)
+
+        for p in parents:
+            add_dir(p)
+
+    def add_file(arcname, src):
+        if not stage_to is None:
+            size, md5 = _copy_hashed(src, os.path.join(stage_to, arcname))
+
+        else:
+            digests = hash_file(src, ["md5"])
+            size, md5 = digests['size'], digests['md5']
+
+        manifest[arcname] = dict(src=src, dir=False, size=size, md5=md5)
+        trace.count("files_walked")
+
+    def add_link(arcname, src):
+        manifest[arcname] = dict(src=src, dir=False, link=os.readlink(src), size=0, md5=None)
+        if not stage_to is None:
+            os.symlink(manifest[arcname]['link'], os.path.join(stage_to, arcname))
+
     for deploykeys in ['Files', 'Override']:
         for src, dst in kwargs.get(deploykeys, {}).items():
-            # TODO: blacklist file types and folders, use os.walk
+            dst = os.path.normpath(dst).lstrip(os.sep)
+            if excluded(dst):
+                continue
+
+            add_parents(dst)
             if os.path.isdir(src):
-                #print("Copy tree {}, {}".format(src, os.path.join(path, pkgname, tmpdir, dst)))
-                copytree(src, os.path.join(path, pkgname, tmpdir, dst))
-                
+                add_dir(dst, src)
+                for root, folders, files in os.walk(src):
+                    reldir = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+                    folders[:] = sorted(d for d in folders if not excluded(os.path.join(reldir, d)))
+                    for d in folders:
+                        if os.path.islink(os.path.join(root, d)):
+                            # Listed, but not descended into, by os.walk
+                            add_link(os.path.join(reldir, d), os.path.join(root, d))
+
+                        else:
+                            add_dir(os.path.join(reldir, d), os.path.join(root, d))
+
+                    for f in sorted(files):
+                        if excluded(os.path.join(reldir, f)):
+                            continue
+
+                        if os.path.islink(os.path.join(root, f)):
+                            add_link(os.path.join(reldir, f), os.path.join(root, f))
+
+                        else:
+                            add_file(os.path.join(reldir, f), os.path.join(root, f))
+
             else:
-                dstpath = os.path.join(path, pkgname, tmpdir, *dst.split(os.sep)[:-1])
-                os.makedirs(dstpath, exist_ok=True)
-                shutil.copy2(src, os.path.join(path, pkgname, tmpdir, dst))
-                
-    return tmpdir
+                add_file(dst, src)
+
+    if tracer is not None:
+        tracer.add_event("exclude", started, pruning[0])
+
+    return manifest
+
+def installed_size(manifest):
+    with trace.phase("size"):
+        return sum(e['size'] for e in manifest.values())
 
-def create_ipk_struct(path, pkgname, **kwargs):
+def md5sums_text(manifest):
+    """ The DEBIAN/md5sums file for a manifest """
+    return ''.join("{}  {}\n".format(manifest[a]['md5'], a)
+                   for a in sorted(manifest) if not manifest[a]['dir'] and not manifest[a].get('link'))
+
+def create_payload_struct(path, pkgname, **kwargs):
+    """
+    :Description:
+        Stages the package payload once under [tmpdir]/DATA in a single
+        manifest pass, so that every build profile of the package can be
+        built from the same copy. Returns (tmpdir, manifest).
+    """
     logging.debug(__name__)
     tmpdir = tempfile.mkdtemp(suffix='tmp', prefix=pkgname, 
                               dir=os.path.join(path, pkgname))
     copypath = os.path.join(path, pkgname, tmpdir)
-    os.makedirs(os.path.join(copypath, 'CONTROL'), exist_ok=True)
     os.makedirs(os.path.join(copypath, 'DATA'), exist_ok=True)
-    for deploykeys in ['Files', 'Override']:
-        for src, dst in kwargs.get(deploykeys, {}).items():
-        # TODO: blacklist file types and folders, use os.walk
-            if os.path.isdir(src):
-                copytree(src, os.path.join(path, pkgname, tmpdir, 'DATA', dst))
-                
-            else:
-                dstpath = os.path.join(path, pkgname, tmpdir, 'DATA', *dst.split(os.sep)[:-1])
-                os.makedirs(dstpath, exist_ok=True)
-                shutil.copy2(src, os.path.join(path, pkgname, tmpdir, 'DATA', dst))
-                
-    return tmpdir
-    
+    try:
+        with trace.phase("stage", package=pkgname):
+            manifest = build_manifest(stage_to=os.path.join(copypath, 'DATA'), **kwargs)
+
+    except Exception:
+        shutil.rmtree(tmpdir)
+        raise
+
+    return tmpdir, manifest
+
+def link_tree(src, dst):
+    """ A copy of the staged tree src at dst made of hard links, for one variant of a build matrix """
+    shutil.copytree(src, dst, symlinks=True, copy_function=os.link)
+    return dst
+
+def build_architectures(**kwargs):
+    """
+    :Description:
+        The build matrix of a package: the architectures of its database,
+        without duplicates, each built into its own artifact. 'all' marks an
+        architecture independent package, which is built once whatever else
+        is listed next to it.
+    """
+    archs = []
+    for a in kwargs.get('Package', {}).get('architecture') or [arch()]:
+        a = a.strip()
+        if a and not a in archs:
+            archs.append(a)
+
+    return ['all'] if 'all' in archs else archs
+
+def for_architecture(a, **kwargs):
+    """ The package database of the build matrix variant for architecture a """
+    variant = dict(kwargs)
+    variant['Package'] = dict(kwargs.get('Package', {}), architecture=[a])
+    return variant
+
+def each_architecture(build, archs):
+    """ Returns [build(a) for a in archs], running the variants concurrently """
+    if len(archs) == 1:
+        return [build(archs[0])]
+
+    with ThreadPoolExecutor(max_workers=len(archs)) as pool:
+        return list(pool.map(build, archs))
+
 def build_package(path, pkgname, **kwargs):
+    """
+    :Description:
+        Builds every profile of the package for every architecture of its
+        build matrix (see build_architectures) and returns one return code
+        per artifact. The payload is staged once and shared by all the
+        profiles and architectures that need a staged copy; per architecture
+        only the control data is written again. The variants of a profile
+        are built concurrently.
+    """
     pkg_profiles = kwargs['Build'].get('profiles', ['deb'])
+    archs = build_architectures(**kwargs)
+    ignored = [a for a in kwargs['Package'].get('architecture', []) if a != 'all']
+    if archs == ['all'] and ignored:
+        sys.stderr.write("Warning: Architecture 'all' is built once, ignoring {}\n".format(', '.join(ignored)))
+
+    staging = [p for p in pkg_profiles if p == 'ipk' or
+               (p == 'deb' and kwargs['Build'].get('writer') != 'native')]
+    shared = len(staging) > 1 or (len(staging) == 1 and len(archs) > 1)
+    staged, manifest = create_payload_struct(path, pkgname, **kwargs) if shared else (None, None)
     retcodes = []
-    if 'deb' in pkg_profiles:
-        retcodes.append(build_deb_package(path, pkgname, **kwargs))
+    try:
+        if 'deb' in pkg_profiles:
+            if kwargs['Build'].get('writer') == 'native':
+                retcodes.extend(build_deb_native_matrix(path, pkgname, archs, **kwargs))
+
+            elif len(archs) == 1:
+                retcodes.append(build_deb_package(path, pkgname, staged=staged, manifest=manifest,
+                                                  **for_architecture(archs[0], **kwargs)))
 
-    if 'ipk' in pkg_profiles:
-        retcodes.append(build_ipk_package(path, pkgname, **kwargs))
+            else:
+                retcodes.extend(each_architecture(
+                    lambda a: build_deb_package(path, pkgname, staged=staged, manifest=manifest,
+                                                variant="DEB-{}".format(a), **for_architecture(a, **kwargs)),
+                    archs))
+
+        if 'ipk' in pkg_profiles:
+            retcodes.extend(build_ipk_package(path, pkgname, archs, staged=staged, manifest=manifest, **kwargs))
+
+    finally:
+        if not staged is None:
+            shutil.rmtree(staged)
 
     return retcodes
 
-def build_ipk_package(path, pkgname, **kwargs):
+def build_ipk_package(path, pkgname, archs=None, staged=None, manifest=None, **kwargs):
+    """
+    :Description:
+        Builds one .ipk per architecture in archs (by default the build
+        matrix of the database). data.tar.gz is written once and shared;
+        each variant gets its own CONTROL directory and control.tar.gz.
+        Returns the return codes in the order of archs.
+    """
     logging.debug(__name__)
-    tmpdir = create_ipk_struct(path, pkgname, **kwargs)
-    remove_non_deployables(tmpdir, *REMOVE_FILES_FOLDERS)
-    write_ipk_control_file(tmpdir, pkgname, **kwargs)
-    retcode = write_ipk_archives(tmpdir, pkgname, **kwargs)
-    shutil.rmtree(tmpdir)
-    return retcode
-    
-def write_ipk_archives(path, pkgname, **kwargs):
+    archs = build_architectures(**kwargs) if archs is None else archs
+    tmpdir = staged
+    if staged is None:
+        tmpdir, manifest = create_payload_struct(path, pkgname, **kwargs)
+
+    def variant(a):
+        vdir = os.path.join(tmpdir, "IPK-{}".format(a))
+        os.makedirs(os.path.join(vdir, 'CONTROL'), exist_ok=True)
+        vkwargs = for_architecture(a, **kwargs)
+        try:
+            with trace.phase("control", package=pkgname, profile="ipk", architecture=a):
+                write_ipk_control_file(vdir, pkgname, **vkwargs)
+
+            with trace.phase("archive", package=pkgname, profile="ipk", architecture=a):
+                return write_ipk_archives(tmpdir, vdir, pkgname, a, **vkwargs)
+
+        finally:
+            shutil.rmtree(vdir)
+
+    try:
+        with trace.phase("archive", package=pkgname, profile="ipk"):
+            retcode = write_ipk_data(tmpdir, **kwargs)
+
+        if retcode != 0:
+            return [retcode for a in archs]
+
+        return each_architecture(variant, archs)
+
+    finally:
+        if staged is None:
+            shutil.rmtree(tmpdir)
+        
+def file_version(**kwargs):
+    """ The package version as dpkg-deb and opkg-build put it in file names: without its epoch """
+    return str(kwargs.get('Package', {}).get('set_version', "0.1")).replace("_", "").split(':', 1)[-1]
+
+def ipk_filename(pkgname, arch, **kwargs):
+    return os.path.join(kwargs['Package'].get('directory', os.getcwd()), "{}_{}_{}.ipk".format(
+        pkgname, file_version(**kwargs), arch))
+
+def _ipk_reset(epoch):
+    def reset(ti):
+        ti.uid = ti.gid = 0
+        ti.uname = ti.gname = "root"
+        ti.mtime = clamp_mtime(ti.mtime, epoch)
+        return ti
+
+    return reset
+
+def _ipk_level(**kwargs):
+    # ipk archives stay gzip for opkg; only the level is configurable
+    method, level = compression(**kwargs)
+    return level if method == 'gzip' else None
+
+def write_ipk_data(path, **kwargs):
+    """ Writes the architecture independent members of the ipk archives: data.tar.gz and debian-binary """
     logging.debug(__name__)
     try:
-        import tarfile
-        with tarfile.open(name=os.path.join(path, "control.tar.gz"), mode='w:gz') as tf:
-            for f in os.listdir(os.path.join(path, 'CONTROL')):
-                tf.add(os.path.join(path, 'CONTROL', f), arcname=f)
-                
-        with tarfile.open(name=os.path.join(path, "data.tar.gz"), mode='w:gz') as tf:
-            for f in os.listdir(os.path.join(path, 'DATA')):
-                tf.add(os.path.join(path, 'DATA', f), arcname=f)
+        epoch = source_date_epoch(**kwargs)
+        reset = _ipk_reset(epoch)
+        with open(os.path.join(path, "data.tar.gz"), 'wb') as f, \
+                compress.compressed_tar(f, 'gzip', _ipk_level(**kwargs), epoch) as tf:
+            for f in sorted(os.listdir(os.path.join(path, 'DATA'))):
+                tf.add(os.path.join(path, 'DATA', f), arcname=f, filter=reset)
                 
         with open(os.path.join(path, 'debian-binary'), 'w') as f:
             f.write('2.0')
+
+        return 0
+
+    except Exception as E:
+        logging.error("Error occured: {}".format(E))
+        sys.stderr.write("Error occured: {}".format(E))
+        return 2
+
+def write_ipk_archives(path, variant, pkgname, arch, **kwargs):
+    """ Writes the .ipk of architecture arch from variant/CONTROL and the shared members in path """
+    logging.debug(__name__)
+    try:
+        epoch = source_date_epoch(**kwargs)
+        reset = _ipk_reset(epoch)
+        level = _ipk_level(**kwargs)
+        with open(os.path.join(variant, "control.tar.gz"), 'wb') as f, \
+                compress.compressed_tar(f, 'gzip', level, epoch) as tf:
+            for f in sorted(os.listdir(os.path.join(variant, 'CONTROL'))):
+                tf.add(os.path.join(variant, 'CONTROL', f), arcname=f, filter=reset)
+
+        members = [os.path.join(variant, 'control.tar.gz'), os.path.join(path, 'data.tar.gz'),
+                   os.path.join(path, 'debian-binary')]
+        with open(ipk_filename(pkgname, arch, **kwargs), 'wb') as f, \
+                compress.compressed_tar(f, 'gzip', level, epoch) as tf:
+            for member in members:
+                tf.add(member, arcname=os.path.basename(member), filter=reset)
             
-        for a in kwargs['Package']['architecture']:
-            with tarfile.open(name=os.path.join(
-                kwargs['Package'].get('directory', os.getcwd()), "{}_{}_{}.ipk".format(
-                    pkgname, kwargs['Package']['set_version'],
-                    a)), 
-                mode='w:gz') as tf:
-                
-                for files in ['control.tar.gz', 'data.tar.gz', 'debian-binary']:
-                    tf.add(os.path.join(path, files), arcname=files)
-            
-        print("apt-pkg: building package '{}' in '{}'.".format(pkgname, 
-                                                               os.path.join(
-                kwargs['Package'].get('directory', os.getcwd()), "{}_{}_{}.ipk".format(
-                    pkgname, kwargs['Package']['set_version'],
-                    a))))
+        # One write, as the variants of a build matrix print from several threads
+        print("apt-pkg: building package '{}' in '{}'.\n".format(pkgname, ipk_filename(pkgname, arch, **kwargs)), end='')
         return 0
-        
-    except ImportError as iE:
-        logging.error("Tarfile module not installed, failed to create archives. Build Failed.")
-        sys.stderr.write("Tarfile module not installed, failed to create archives. Build Failed.")
-        return 1
     
     except Exception as E:
         logging.error("Error occured: {}".format(E))
         sys.stderr.write("Error occured: {}".format(E))
         return 2
 
-def build_deb_package(path, pkgname, **kwargs):
+def build_deb_package(path, pkgname, staged=None, manifest=None, variant=None, **kwargs):
     """
     TODO:
         - Copy package into a temporary directory where it can be built either in a 
@@ -157,17 +400,216 @@ def build_deb_package(path, pkgname, **kwargs):
         - target: Either a directory or a filename;
                   If directory: saves package based on control file data (name_ver_arch.deb)
                   If filename: save package file to filename
+        - variant: builds in a hard linked copy of the shared payload by
+                   that name, so several variants can be built at once
     """
     logging.debug(__name__)
-    tmpdir = create_deb_struct(path, pkgname, **kwargs)
-    remove_non_deployables(tmpdir, *REMOVE_FILES_FOLDERS)
-    write_deb_control_file(tmpdir, pkgname, **kwargs)
-    proc = Popen(['dpkg-deb', '--build', os.path.join(path, tmpdir), "."])
-    proc.communicate()
-    shutil.rmtree(tmpdir)
+    if kwargs.get('Build', {}).get('writer') == 'native':
+        return build_deb_native(path, pkgname, **kwargs)
+
+    tmpdir = staged
+    if staged is None:
+        tmpdir, manifest = create_payload_struct(path, pkgname, **kwargs)
+
+    # DEBIAN only lives in the (possibly shared) payload for this build
+    builddir = os.path.join(tmpdir, 'DATA')
+    if not variant is None:
+        builddir = link_tree(builddir, os.path.join(tmpdir, variant))
+
+    os.makedirs(os.path.join(builddir, 'DEBIAN'), exist_ok=True)
+    try:
+        with trace.phase("control", package=pkgname, profile="deb"):
+            write_deb_control_file(builddir, pkgname, manifest=manifest, **kwargs)
+
+        method, level = compression(**kwargs)
+        cmd = ['dpkg-deb', '-Z{}'.format(method)]
+        if not level is None:
+            cmd.append('-z{}'.format(level))
+
+        env = None
+        if source_date_epoch(**kwargs) is not None:
+            env = dict(os.environ, SOURCE_DATE_EPOCH=str(source_date_epoch(**kwargs)))
+
+        with trace.phase("archive", package=pkgname, profile="deb", writer="dpkg"):
+            trace.count("subprocesses")
+            proc = Popen(cmd + ['--build', os.path.join(path, builddir), "."], env=env)
+            proc.communicate()
+
+    finally:
+        if staged is None:
+            shutil.rmtree(tmpdir)
+
+        elif not variant is None:
+            shutil.rmtree(builddir)
+
+        else:
+            shutil.rmtree(os.path.join(builddir, 'DEBIAN'))
         
     return proc.returncode
 
+def source_date_epoch(**kwargs):
+    """ The SOURCE_DATE_EPOCH of the build: Build source_date_epoch, else the environment's; None if neither is set """
+    epoch = kwargs.get('Build', {}).get('source_date_epoch')
+    if epoch is None:
+        epoch = os.environ.get('SOURCE_DATE_EPOCH') or None
+
+    return None if epoch is None else int(epoch)
+
+def clamp_mtime(mtime, epoch):
+    """ Timestamps newer than the build epoch are clamped down to it """
+    return mtime if epoch is None else min(int(mtime), epoch)
+
+def compression(**kwargs):
+    """ (method, level) of the package's Build compression settings """
+    build = kwargs.get('Build', {})
+    method = build.get('compression', 'gzip')
+    compress.extension(method)
+    level = build.get('compress_level')
+    return method, (int(level) if level else None)
+
+def _tar_add(tf, arcname, src=None, data=None, mode=None, epoch=None):
+    """ Adds a root owned entry to tf, taking content from src or data """
+    ti = tarfile.TarInfo("./{}".format(arcname) if arcname else ".")
+    ti.uid = ti.gid = 0
+    ti.uname = ti.gname = "root"
+    if data is not None:
+        ti.size = len(data)
+        ti.mode = 0o644 if mode is None else mode
+        ti.mtime = 0 if epoch is None else epoch
+        tf.addfile(ti, io.BytesIO(data))
+        return
+
+    # Control scripts, given a mode, are always packed as files
+    st = None if src is None else os.stat(src) if mode is not None else os.lstat(src)
+    ti.mtime = clamp_mtime(st.st_mtime, epoch) if st is not None else (epoch or 0)
+    if st is None or stat.S_ISDIR(st.st_mode):
+        ti.type = tarfile.DIRTYPE
+        ti.mode = 0o755 if st is None else stat.S_IMODE(st.st_mode)
+        tf.addfile(ti)
+
+    elif stat.S_ISLNK(st.st_mode):
+        ti.type = tarfile.SYMTYPE
+        ti.linkname = os.readlink(src)
+        ti.mode = 0o777
+        tf.addfile(ti)
+
+    else:
+        ti.size = st.st_size
+        # Modes as they are, setuid/setgid and sticky bits included, as dpkg-deb packs them
+        ti.mode = stat.S_IMODE(st.st_mode) if mode is None else mode
+        with open(src, 'rb') as f:
+            tf.addfile(ti, f)
+
+def deb_filename(pkgname, **kwargs):
+    """ The file name dpkg-deb --build gives the package: name_version_arch.deb, without the version epoch """
+    return "{}_{}_{}.deb".format(pkgname.replace("_", ""), file_version(**kwargs),
+                                 ', '.join(kwargs.get('Package', {}).get('architecture')))
+
+def native_data_writer(manifest, method, level, epoch):
+    """ The writer streaming the data.tar of a manifest, compressed with method, into a file object """
+    # Symlinks go last, as dpkg-deb --build orders them
+    entries = sorted(manifest.items(), key=lambda kv: ('link' in kv[1], kv[0].split(os.sep)))
+
+    def data_writer(fileobj):
+        with compress.compressed_tar(fileobj, method, level, epoch) as tf:
+            _tar_add(tf, '', epoch=epoch)
+            for arcname, entry in entries:
+                _tar_add(tf, arcname, src=entry['src'], epoch=epoch)
+
+    return data_writer
+
+def build_deb_native_matrix(path, pkgname, archs, **kwargs):
+    """
+    :Description:
+        Builds the native .deb of every architecture in archs. The manifest
+        is walked once, and with more than one architecture the data.tar is
+        compressed once into a temporary file that every variant copies
+        into its archive. Returns the return codes in the order of archs.
+    """
+    with trace.phase("stage", package=pkgname, writer="native"):
+        manifest = build_manifest(**kwargs)
+
+    if len(archs) == 1:
+        return [build_deb_native(path, pkgname, manifest=manifest, **for_architecture(archs[0], **kwargs))]
+
+    method, level = compression(**kwargs)
+    fd, data = tempfile.mkstemp(suffix='.data', prefix=pkgname, dir=os.path.join(path, pkgname))
+    try:
+        with os.fdopen(fd, 'wb') as f, \
+                trace.phase("archive", package=pkgname, profile="deb", writer="native"):
+            native_data_writer(manifest, method, level, source_date_epoch(**kwargs))(f)
+
+        return each_architecture(
+            lambda a: build_deb_native(path, pkgname, manifest=manifest, data=data,
+                                       **for_architecture(a, **kwargs)),
+            archs)
+
+    finally:
+        os.remove(data)
+
+def build_deb_native(path, pkgname, manifest=None, data=None, **kwargs):
+    """
+    :Description:
+        Builds the .deb in-process, streaming control.tar and data.tar
+        (compressed as set in Build compression) straight from the source paths in the package database into the ar
+        container. Modes and root ownership are set in the tar headers, so no
+        staging directory and no dpkg-deb run are needed. data is the path
+        of an already compressed data.tar to use instead (see
+        build_deb_native_matrix).
+    """
+    logging.debug(__name__)
+    if manifest is None:
+        with trace.phase("stage", package=pkgname, writer="native"):
+            manifest = build_manifest(**kwargs)
+
+    controls = kwargs.get('Control', {})
+    epoch = source_date_epoch(**kwargs)
+    method, level = compression(**kwargs)
+
+    def control_writer(fileobj):
+        with compress.compressed_tar(fileobj, method, level, epoch) as tf:
+            _tar_add(tf, '', epoch=epoch)
+            for k, v in sorted(controls.items()):
+                if os.path.exists(v) and os.path.isfile(v):
+                    print("\tGenerating {}".format(k))
+                    _tar_add(tf, k, src=v, mode=0o755, epoch=epoch)
+
+            # Same rule as write_deb_control_file for the generated control file
+            if controls.get('controls', None) is None:
+                with trace.phase("control", package=pkgname, profile="deb"):
+                    text = deb_control_text(pkgname, installed_size(manifest), **kwargs)
+
+                _tar_add(tf, 'control', data=text.encode('utf-8'), epoch=epoch)
+
+            _tar_add(tf, 'md5sums', data=md5sums_text(manifest).encode('utf-8'), epoch=epoch)
+
+    if data is None:
+        data_writer = native_data_writer(manifest, method, level, epoch)
+
+    else:
+        def data_writer(fileobj):
+            with open(data, 'rb') as f:
+                shutil.copyfileobj(f, fileobj, CHUNK_SIZE)
+
+    target = os.path.join(os.getcwd(), deb_filename(pkgname, **kwargs))
+    try:
+        with trace.phase("archive", package=pkgname, profile="deb", writer="native"):
+            debfile.write_deb(target, control_writer, data_writer,
+                              control_name="control.tar" + compress.extension(method),
+                              data_name="data.tar" + compress.extension(method),
+                              mtime=epoch or 0)
+
+    except Exception as E:
+        logging.error("Error occured: {}".format(E))
+        sys.stderr.write("Error occured: {}\n".format(E))
+        if os.path.exists(target):
+            os.remove(target)
+
+        return 2
+
+    print("apt-pkg: building package '{}' in '{}'.\n".format(pkgname, target), end='')
+    return 0
+
 def write_ipk_control_file(path, pkgname, **kwargs):
     logging.debug(__name__)
     umask = os.umask(0o022)
@@ -195,7 +637,37 @@ def write_ipk_control_file(path, pkgname, **kwargs):
             
             cf.write("Description: {}\n".format(pkgkw.get('desc', 'Description Not Set')))
 
-def write_deb_control_file(path, pkgname, **kwargs):
+def deb_control_text(pkgname, installed_size, **kwargs):
+    """ Returns the generated DEBIAN/control file for a package database """
+    lines = []
+    lines.append("Package: {}\n".format(pkgname.replace("_", "")))
+    pkgkw = kwargs.get('Package', {})
+    lines.append("Version: {}\n".format(str(pkgkw.get('set_version', "0.1")).replace("_", "")))
+    lines.append("Architecture: {}\n".format(', '.join(pkgkw.get('architecture'))))
+    lines.append("Section: {}\n".format(pkgkw['section'] if pkgkw.get('section') in SECTIONS else "misc"))
+    lines.append("Essential: {}\n".format("yes" if pkgkw.get('essential') else "no"))
+
+    for lst in ['depends', 'recommends', 'suggests', 'replaces', 'provides']:
+        if pkgkw.get(lst):
+            lines.append("{}: {}\n".format(lst.title(), ', '.join(pkgkw.get(lst))))
+
+    lines.append("Description: {}\n".format(pkgkw.get('desc', 'Description Not Set')))
+    for d in [desc.strip() for desc in pkgkw.get('description', ['...'])]:
+        lines.append(" {}\n".format(d))
+
+    size = Decimal(installed_size / 1024).quantize(Decimal('1.'), rounding=ROUND_UP)
+    lines.append("Installed-Size: {}\n".format(size))
+    pkgkw = kwargs.get('User', {})
+    if not pkgkw.get('homepage') is None:
+        lines.append("Homepage: {}\n".format(pkgkw.get('homepage')))
+    lines.append("Package-Type: deb\n")
+
+    if not pkgkw.get('maintainer') is None:
+        lines.append("Maintainer: {}\n".format(', '.join(pkgkw.get('maintainer'))))
+
+    return ''.join(lines)
+
+def write_deb_control_file(path, pkgname, manifest=None, **kwargs):
     logging.debug(__name__)
     umask = os.umask(0o022)
     # TODO Detect if package has a database file and use those
@@ -211,71 +683,33 @@ def write_deb_control_file(path, pkgname, **kwargs):
     # as a control option
     if controls.get('controls', None) is None:
         with open(os.path.join(path, "DEBIAN", "control"), 'w') as cf:
-            cf.write("Package: {}\n".format(pkgname.replace("_", "")))
-            pkgkw = kwargs.get('Package', {})
-            cf.write("Version: {}\n".format(str(pkgkw.get('set_version', "0.1")).replace("_", "")))
-            cf.write("Architecture: {}\n".format(', '.join(pkgkw.get('architecture'))))
-            cf.write("Section: {}\n".format(pkgkw['section'] if pkgkw.get('section') in SECTIONS else "misc"))
-            cf.write("Essential: {}\n".format("yes" if pkgkw.get('essential') else "no"))
-            
-            for lst in ['depends', 'recommends', 'suggests', 'replaces', 'provides']:
-                if pkgkw.get(lst):
-                    cf.write("{}: {}\n".format(lst.title(), ', '.join(pkgkw.get(lst))))
-        
-            cf.write("Description: {}\n".format(pkgkw.get('desc', 'Description Not Set')))
-            for d in [desc.strip() for desc in pkgkw.get('description', ['...'])]:
-                cf.write(" {}\n".format(d))
-            
-            size = Decimal(pkg_installed_size(path) / 1024).quantize(Decimal('1.'), rounding=ROUND_UP)
-            cf.write("Installed-Size: {}\n".format(size))
-            pkgkw = kwargs.get('User', {})
-            if not pkgkw.get('homepage') is None:
-                cf.write("Homepage: {}\n".format(pkgkw.get('homepage')))
-            cf.write("Package-Type: deb\n")
-            
-            if not pkgkw.get('maintainer') is None:
-                cf.write("Maintainer: {}\n".format(', '.join(pkgkw.get('maintainer'))))
-            
-            
+            size = pkg_installed_size(path) if manifest is None else installed_size(manifest)
+            cf.write(deb_control_text(pkgname, size, **kwargs))
 
-def remove_non_deployables(toplevel, *non_deployables):
-    logging.debug(__name__)
-    """
-    Non Deployables are files and folders that no one wants deployed on the
-    target system. Examples of these are "__pycache__" folders from python,
-    ".svn" folders from subversion and other temp files that litter 
-    code folders that shouldn't be placed on the target system.
-    """
-    for root, folders, files in os.walk(toplevel):
-        for f in files: 
-            if f in non_deployables:
-                os.remove(os.path.join(root, f))
-                
-        for d in folders:
-            if d in non_deployables:
-                shutil.rmtree(os.path.join(root, d))
+    if not manifest is None:
+        with open(os.path.join(path, "DEBIAN", "md5sums"), 'w') as f:
+            f.write(md5sums_text(manifest))
 
-def pkg_installed_size(path, append_bytes=None, ignored_files=['DEBIAN']):
+def pkg_installed_size(path, ignored_files=['DEBIAN']):
     logging.debug(__name__)
     """
-    FIXME: Doesn't calculate size recursively
     :Description:
-        Recursive method that aims to compile a total Installed-Size value
-        for the resulting control file.
-        Performs a quick check to ensure the DEBIAN folder is not included.
+        Compiles a total Installed-Size value (in bytes) for the resulting
+        control file from a staged tree, leaving out the DEBIAN folder.
+        Builds that have a manifest use installed_size() instead.
     """
-    bytecount = 0 if append_bytes is None else append_bytes
-    if os.path.exists(path):        
-        if os.path.isdir(path):
-            for root, dirs, files in os.walk(path):
-                if root.split(os.sep)[-1] in ignored_files:
-                    continue
-                    
-                for f in files:
-                    bytecount += pkg_installed_size(os.path.join(root, f), bytecount) if \
-                        os.path.isdir(f) else os.path.getsize(os.path.join(root, f))
-            
-        else:
-            bytecount += os.path.getsize(path)
-    
-    return bytecount
\ No newline at end of file
+    with trace.phase("size"):
+        return _tree_size(path, ignored_files)
+
+def _tree_size(path, ignored_files):
+    bytecount = 0
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not d in ignored_files]
+            for f in files:
+                bytecount += os.path.getsize(os.path.join(root, f))
+
+    elif os.path.exists(path):
+        bytecount += os.path.getsize(path)
+
+    return bytecount
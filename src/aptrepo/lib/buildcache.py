@@ -0,0 +1,137 @@
+"""
+:Description:
+    Build cache for apt-pkg. A package's inputs (its parsed database plus
+    every file referenced by Files, Override and Control) are fingerprinted;
+    when the fingerprint matches the last successful build and its artifacts
+    are still in place, the build is skipped and the artifacts are reused.
+
+    Builds are stamped with a SOURCE_DATE_EPOCH (the newest input mtime
+    unless the environment sets one), so identical inputs give identical
+    bytes. It is handed to the build as Build source_date_epoch, not set
+    in the process environment, which concurrent builds share.
+"""
+
+import os
+import json
+import hashlib
+import aptrepo.lib.build
+from aptrepo.lib.security import hash_file
+
+CACHE_FILE = ".buildcache"
+
+def input_files(**kwargs):
+    """ Yields every source file the package database refers to """
+    for section in ['Files', 'Override', 'Control']:
+        for src in sorted(kwargs.get(section, {})):
+            if os.path.isdir(src):
+                for root, folders, files in os.walk(src):
+                    folders.sort()
+                    for f in sorted(files):
+                        yield os.path.join(root, f)
+
+            elif os.path.exists(src):
+                yield src
+
+def fingerprint(mode="mtime", **kwargs):
+    """
+    :Description:
+        Returns (fingerprint, newest input mtime) for a package database.
+        In "mtime" mode files contribute their size and mtime, in "content"
+        mode their size and sha256.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps(kwargs, default=str, sort_keys=True).encode('utf-8'))
+    newest = 0
+    for f in input_files(**kwargs):
+        st = os.stat(f)
+        newest = max(newest, int(st.st_mtime))
+        if mode == "content":
+            h.update("{}\0{}\0{}\n".format(f, st.st_size, hash_file(f, ["sha256"])['sha256']).encode('utf-8'))
+
+        else:
+            h.update("{}\0{}\0{}\n".format(f, st.st_size, st.st_mtime_ns).encode('utf-8'))
+
+    return h.hexdigest(), newest
+
+def artifact_paths(pkgname, **kwargs):
+    """
+    :Description:
+        Paths of the packages build_package produces for this database, one
+        per profile and architecture, named as dpkg-deb and the ipk writer
+        name them (see build.file_version).
+    """
+    paths = []
+    profiles = kwargs['Build'].get('profiles', ['deb'])
+    archs = aptrepo.lib.build.build_architectures(**kwargs)
+    if 'deb' in profiles:
+        for a in archs:
+            paths.append(os.path.join(os.getcwd(), aptrepo.lib.build.deb_filename(
+                pkgname, **aptrepo.lib.build.for_architecture(a, **kwargs))))
+
+    if 'ipk' in profiles:
+        for a in archs:
+            paths.append(os.path.abspath(aptrepo.lib.build.ipk_filename(pkgname, a, **kwargs)))
+
+    return paths
+
+def _stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def load_cache(path, pkgname):
+    try:
+        with open(os.path.join(path, pkgname, CACHE_FILE), 'r') as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(path, pkgname, cache):
+    cachepath = os.path.join(path, pkgname, CACHE_FILE)
+    with open(cachepath + ".tmp", 'w') as f:
+        json.dump(cache, f, indent=4, sort_keys=True)
+
+    os.replace(cachepath + ".tmp", cachepath)
+
+def is_fresh(entry, artifacts):
+    if not entry or sorted(entry.get('artifacts', {})) != sorted(artifacts):
+        return False
+
+    for a in artifacts:
+        if not os.path.exists(a) or _stamp(a) != entry['artifacts'][a]:
+            return False
+
+    return True
+
+def cached_build_package(path, pkgname, force=False, **kwargs):
+    """
+    :Description:
+        build_package() behind the build cache. Returns the same list of
+        return codes; a cache hit returns success for every artifact without
+        building anything.
+    """
+    mode = kwargs['Build'].get('cache', 'mtime')
+    if mode == 'off':
+        return aptrepo.lib.build.build_package(path, pkgname, **kwargs)
+
+    fp, newest = fingerprint(mode, **kwargs)
+    artifacts = artifact_paths(pkgname, **kwargs)
+    cache = load_cache(path, pkgname)
+    if not force and cache.get('fingerprint') == fp and is_fresh(cache, artifacts):
+        for a in artifacts:
+            print("apt-pkg: '{}' is up to date, reusing '{}'.".format(pkgname, a))
+
+        return [0 for a in artifacts]
+
+    # Unless the environment sets one, the build is stamped with its newest input
+    build = kwargs['Build']
+    if aptrepo.lib.build.source_date_epoch(**kwargs) is None:
+        build = dict(build, source_date_epoch=newest)
+
+    retcodes = aptrepo.lib.build.build_package(path, pkgname, **dict(kwargs, Build=build))
+
+    if retcodes and all(r == 0 for r in retcodes) and all(os.path.exists(a) for a in artifacts):
+        save_cache(path, pkgname, dict(fingerprint=fp,
+                                       artifacts={a: _stamp(a) for a in artifacts}))
+
+    return retcodes
@@ -0,0 +1,272 @@
+"""
+:Description:
+    Persistent catalog of every package published in a repository, kept in
+    an SQLite database at the root of the repository ([directory]/[toplevel]).
+
+    Each index directory (dists/[platform]/[component]/binary-[arch]) is
+    mirrored into the catalog whenever its Packages file is regenerated, in a
+    single transaction, so lookups (exact name, name prefix, filename, latest
+    version in Debian version order) and repository totals are answered from
+    indexed tables instead of walking dists/.
+"""
+
+import os
+import sqlite3
+import datetime
+from aptrepo.lib.version import collate_versions
+from aptrepo.lib.scanpackages import scan_packages, read_packages
+
+CATALOG_FILE = ".catalog.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS indexes (
+    path TEXT PRIMARY KEY,
+    platform TEXT NOT NULL,
+    component TEXT NOT NULL,
+    arch TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS packages (
+    id INTEGER PRIMARY KEY,
+    idx TEXT NOT NULL REFERENCES indexes(path) ON DELETE CASCADE,
+    platform TEXT NOT NULL,
+    component TEXT NOT NULL,
+    arch TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL COLLATE debversion,
+    architecture TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    basename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    md5 TEXT,
+    sha1 TEXT,
+    sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS packages_name ON packages (platform, name);
+CREATE INDEX IF NOT EXISTS packages_basename ON packages (platform, basename);
+CREATE INDEX IF NOT EXISTS packages_idx ON packages (idx);
+CREATE INDEX IF NOT EXISTS packages_sha256 ON packages (sha256);
+CREATE INDEX IF NOT EXISTS packages_filename ON packages (filename);
+"""
+
+def split_index_path(index):
+    """ dists/[platform]/[component]/binary-[arch] -> (platform, component, arch) """
+    parts = index.strip(os.sep).split(os.sep)
+    if len(parts) < 4 or parts[0] != 'dists':
+        raise Exception("Not an index directory: {}".format(index))
+
+    arch = parts[-1][len('binary-'):] if parts[-1].startswith('binary-') else parts[-1]
+    return parts[1], os.sep.join(parts[2:-1]), arch
+
+class Catalog(object):
+    """
+    :Description:
+        The package catalog of the repository served from webroot. Rows are
+        plain dicts with the columns of the packages table.
+    """
+
+    def __init__(self, webroot):
+        self.webroot = webroot
+        self.path = os.path.join(webroot, CATALOG_FILE)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.create_collation("debversion", collate_versions)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _rows(self, sql, params=()):
+        return [dict(r) for r in self.conn.execute(sql, params)]
+
+    def replace_index(self, index, stanzas):
+        """
+        :Description:
+            Replaces everything recorded for the index directory index
+            (relative to webroot) with the given Packages stanzas.
+        """
+        platform, component, arch = split_index_path(index)
+        rows = []
+        for s in stanzas:
+            s = dict(s)
+            rows.append((index, platform, component, arch, s.get('Package', ''),
+                         s.get('Version', ''), s.get('Architecture', arch),
+                         s['Filename'], os.path.basename(s['Filename']), int(s.get('Size', 0)),
+                         s.get('MD5sum'), s.get('SHA1'), s.get('SHA256')))
+
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO indexes VALUES (?, ?, ?, ?, ?)",
+                              (index, platform, component, arch,
+                               datetime.datetime.now(datetime.timezone.utc).isoformat()))
+            self.conn.execute("DELETE FROM packages WHERE idx = ?", (index,))
+            self.conn.executemany("INSERT INTO packages (idx, platform, component, arch, name, "
+                                  "version, architecture, filename, basename, size, md5, sha1, sha256) "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def indexes(self, platform):
+        return [r['path'] for r in self._rows("SELECT path FROM indexes WHERE platform = ? "
+                                              "ORDER BY path", (platform,))]
+
+    def rebuild(self, platform):
+        """
+        :Description:
+            Re-reads every index directory of platform from disk: from its
+            Packages file, which also covers pool entries, or by scanning the
+            directory when there is no Packages file yet.
+        """
+        distpath = os.path.join(self.webroot, 'dists', platform)
+        with self.conn:
+            self.conn.execute("DELETE FROM packages WHERE platform = ?", (platform,))
+            self.conn.execute("DELETE FROM indexes WHERE platform = ?", (platform,))
+
+        # dists/[platform] is usually a symlink to the live generation
+        for root, dirs, files in os.walk(distpath, followlinks=True):
+            dirs.sort()
+            if os.path.basename(root).startswith('binary-'):
+                index = os.path.relpath(root, self.webroot)
+                stanzas = read_packages(root, index)
+                if not stanzas and not "Packages" in files:
+                    stanzas = scan_packages(self.webroot, root)
+
+                self.replace_index(index, stanzas)
+
+    def ensure(self, platform):
+        """ Fills the catalog from disk the first time a platform is looked up """
+        if not self.indexes(platform):
+            self.rebuild(platform)
+
+    def ensure_all(self):
+        """ ensure() for every platform of the repository """
+        distspath = os.path.join(self.webroot, 'dists')
+        if os.path.isdir(distspath):
+            for platform in sorted(os.listdir(distspath)):
+                if os.path.isdir(os.path.join(distspath, platform)):
+                    self.ensure(platform)
+
+    def find(self, platform, name=None, prefix=None, version=None, basename=None):
+        """
+        :Description:
+            Returns the packages of platform matching an exact name, a name
+            prefix, or a file name, optionally restricted to one version.
+            Results are ordered by name, then by descending version.
+        """
+        sql = "SELECT * FROM packages WHERE platform = ?"
+        params = [platform]
+        if name is not None:
+            sql += " AND name = ?"
+            params.append(name)
+
+        if prefix is not None:
+            # Package names cannot contain glob characters, so GLOB is a
+            # plain, index-assisted prefix match here
+            sql += " AND name GLOB ?"
+            params.append(prefix + '*')
+
+        if basename is not None:
+            sql += " AND basename = ?"
+            params.append(basename)
+
+        if version is not None:
+            sql += " AND version = ?"
+            params.append(version)
+
+        return self._rows(sql + " ORDER BY name, version DESC, component, arch", params)
+
+    def members(self, index):
+        """ Rows of every package listed in the index directory index """
+        return self._rows("SELECT * FROM packages WHERE idx = ? ORDER BY filename", (index,))
+
+    def find_basename(self, basename):
+        """ Rows of every package file named basename, in any platform """
+        return self._rows("SELECT * FROM packages WHERE basename = ?", (basename,))
+
+    def find_sha256(self, sha256):
+        return self._rows("SELECT * FROM packages WHERE sha256 = ?", (sha256,))
+
+    def sha256s(self):
+        """ The sha256 of every package file listed by any index, of any platform """
+        return set(r[0] for r in self.conn.execute("SELECT DISTINCT sha256 FROM packages WHERE sha256 IS NOT NULL"))
+
+    def referencing(self, filename):
+        """ Rows of every index, of any platform, listing filename """
+        return self._rows("SELECT * FROM packages WHERE filename = ?", (filename,))
+
+    def is_referenced(self, filename):
+        """ True when any index, of any platform, lists filename """
+        return self.conn.execute("SELECT 1 FROM packages WHERE filename = ? LIMIT 1",
+                                 (filename,)).fetchone() is not None
+
+    def latest(self, platform, name, arch=None):
+        """ The highest version of package name in platform (optionally for one arch), or None """
+        sql = "SELECT * FROM packages WHERE platform = ? AND name = ?"
+        params = [platform, name]
+        if arch is not None:
+            sql += " AND arch = ?"
+            params.append(arch)
+
+        rows = self._rows(sql + " ORDER BY version DESC LIMIT 1", params)
+        return rows[0] if rows else None
+
+    def superseded(self, platform, keep, names=None):
+        """
+        :Description:
+            Rows of platform beyond the keep highest versions (in Debian
+            version order) of their package and architecture within each
+            index, for every package or only those named in names. Computed
+            in one ranked pass over the platform's rows.
+        """
+        sql = "SELECT * FROM packages WHERE platform = ?"
+        params = [platform]
+        if names is not None:
+            sql += " AND name IN ({})".format(', '.join('?' for n in names))
+            params.extend(names)
+
+        rows = self._rows("SELECT * FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY idx, name, architecture "
+                          "ORDER BY version DESC) AS rank FROM ({})) WHERE rank > ? "
+                          "ORDER BY idx, name, version DESC".format(sql), params + [keep])
+        for r in rows:
+            del r['rank']
+
+        return rows
+
+    def count(self, platform):
+        return self.conn.execute("SELECT COUNT(*) FROM packages WHERE platform = ?",
+                                 (platform,)).fetchone()[0]
+
+    def total_size(self, platform):
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM packages WHERE platform = ?",
+                                 (platform,)).fetchone()[0]
+
+def lookup(catalog, platform, spec):
+    """
+    :Description:
+        Resolves a command line package spec: "name", "name=version",
+        "prefix*" or a package file name.
+    """
+    if os.path.splitext(spec)[1] in ('.deb', '.ipk'):
+        return catalog.find(platform, basename=os.path.basename(spec))
+
+    if spec.endswith('*'):
+        return catalog.find(platform, prefix=spec[:-1])
+
+    name, _, version = spec.partition('=')
+    return catalog.find(platform, name=name, version=version or None)
+
+def spec_matches(spec, name, version, basename):
+    """ lookup() semantics for a single package not (yet) in the catalog """
+    if os.path.splitext(spec)[1] in ('.deb', '.ipk'):
+        return basename == os.path.basename(spec)
+
+    if spec.endswith('*'):
+        return name.startswith(spec[:-1])
+
+    n, _, v = spec.partition('=')
+    return name == n and (not v or collate_versions(version, v) == 0)
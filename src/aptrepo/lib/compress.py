@@ -0,0 +1,197 @@
+"""
+:Description:
+    Compression backends shared by package builds and repository indexes.
+
+    Supported methods are "gzip", "xz" and "none". xz output is produced in
+    parallel the way "xz -T" does it: the input is cut into XZ_CHUNK_SIZE
+    chunks that are LZMA2 compressed independently on a thread pool (lzma
+    releases the GIL), then written out in order as the blocks of a single
+    .xz stream, which every xz decoder (dpkg and apt included) can read.
+"""
+
+import io
+import os
+import gzip
+import lzma
+import zlib
+import struct
+import tarfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+METHODS = ["gzip", "xz", "none"]
+EXTENSIONS = {"gzip": ".gz", "xz": ".xz", "none": ""}
+DEFAULT_LEVELS = {"gzip": 9, "xz": 6, "none": None}
+
+XZ_CHUNK_SIZE = 4 * 1024 * 1024
+
+def extension(method):
+    if not method in EXTENSIONS:
+        raise Exception("Unsupported compression: {} (use one of {})".format(
+            method, ', '.join(METHODS)))
+
+    return EXTENSIONS[method]
+
+XZ_MAGIC = b"\xfd7zXZ\x00"
+XZ_FOOTER_MAGIC = b"YZ"
+XZ_CHECK_CRC32 = b"\x00\x01"
+# LZMA2 dictionary size of each xz preset, 0 to 9
+XZ_PRESET_DICT_SIZES = [2 ** 18, 2 ** 20, 2 ** 21, 2 ** 22, 2 ** 22,
+                        2 ** 23, 2 ** 23, 2 ** 24, 2 ** 25, 2 ** 26]
+
+def _xz_varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+
+    out.append(n)
+    return bytes(out)
+
+def _xz_pad(n):
+    return b"\x00" * (-n % 4)
+
+def _xz_crc32(data):
+    return struct.pack("<I", zlib.crc32(data) & 0xffffffff)
+
+def _xz_dict_size(preset, chunk_size):
+    """ Smallest xz encodable dictionary size covering the preset and chunk: (size, property byte) """
+    wanted = min(XZ_PRESET_DICT_SIZES[preset & 0x1f], chunk_size)
+    for prop in range(40):
+        size = (2 | (prop & 1)) << (prop // 2 + 11)
+        if size >= wanted:
+            return size, prop
+
+    return 2 ** 32 - 1, 40
+
+def _xz_block(data, preset, dict_size, prop):
+    """ One complete xz block (header, LZMA2 data, padding, CRC32 check) for data """
+    compressed = lzma.compress(bytes(data), format=lzma.FORMAT_RAW, filters=[
+        {"id": lzma.FILTER_LZMA2, "preset": preset, "dict_size": dict_size}])
+    # flags: one filter, no sizes; filter: LZMA2 (0x21) with a 1 byte property
+    header = b"\x00" + b"\x21\x01" + bytes([prop])
+    header += _xz_pad(len(header) + 1)
+    header = bytes([(len(header) + 1 + 4) // 4 - 1]) + header
+    header += _xz_crc32(header)
+    unpadded = len(header) + len(compressed) + 4
+    return (header + compressed + _xz_pad(len(compressed)) + _xz_crc32(bytes(data)),
+            unpadded, len(data))
+
+class ParallelXzWriter(io.RawIOBase):
+    """
+    Write-only file object that xz compresses everything written to it into
+    fileobj as one .xz stream, XZ_CHUNK_SIZE bytes per block, compressing up
+    to workers blocks at once. At most 2 * workers chunks are held in
+    memory. fileobj is not closed.
+    """
+
+    def __init__(self, fileobj, preset=None, workers=None, chunk_size=XZ_CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.preset = DEFAULT_LEVELS["xz"] if preset is None else int(preset)
+        self.dict_size, self.dict_prop = _xz_dict_size(self.preset, chunk_size)
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = []
+        self.records = []
+        self.buf = bytearray()
+        self.pos = 0
+        self.fileobj.write(XZ_MAGIC + XZ_CHECK_CRC32 + _xz_crc32(XZ_CHECK_CRC32))
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def _write_block(self, future):
+        block, unpadded, size = future.result()
+        self.fileobj.write(block)
+        self.records.append((unpadded, size))
+
+    def _submit(self, data):
+        self.pending.append(self.pool.submit(_xz_block, bytes(data), self.preset,
+                                             self.dict_size, self.dict_prop))
+        while len(self.pending) >= 2 * self.workers:
+            self._write_block(self.pending.pop(0))
+
+    def write(self, data):
+        self.pos += len(data)
+        self.buf.extend(data)
+        while len(self.buf) >= self.chunk_size:
+            self._submit(self.buf[:self.chunk_size])
+            del self.buf[:self.chunk_size]
+
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+
+        if self.buf:
+            self._submit(self.buf)
+            self.buf = bytearray()
+
+        for f in self.pending:
+            self._write_block(f)
+
+        self.pending = []
+        self.pool.shutdown()
+        index = b"\x00" + _xz_varint(len(self.records))
+        for unpadded, size in self.records:
+            index += _xz_varint(unpadded) + _xz_varint(size)
+
+        index += _xz_pad(len(index))
+        index += _xz_crc32(index)
+        footer = struct.pack("<I", len(index) // 4 - 1) + XZ_CHECK_CRC32
+        self.fileobj.write(index + _xz_crc32(footer) + footer + XZ_FOOTER_MAGIC)
+        super().close()
+
+class _Uncompressed(io.RawIOBase):
+    """ Pass-through writer that leaves fileobj open on close """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pos = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def write(self, data):
+        self.pos += len(data)
+        return self.fileobj.write(data)
+
+def open_compressor(fileobj, method="gzip", level=None, mtime=0, workers=None):
+    """
+    :Description:
+        Returns a writable file object compressing into fileobj with method.
+        Closing it finishes the compressed data but leaves fileobj open.
+        mtime is the timestamp stored in gzip headers.
+    """
+    extension(method)
+    if method == "gzip":
+        return gzip.GzipFile(filename='', mode='wb', fileobj=fileobj,
+                             compresslevel=DEFAULT_LEVELS["gzip"] if level is None else level,
+                             mtime=mtime or 0)
+
+    elif method == "xz":
+        return ParallelXzWriter(fileobj, preset=level, workers=workers)
+
+    return _Uncompressed(fileobj)
+
+def compress_bytes(data, method="gzip", level=None, workers=None):
+    out = io.BytesIO()
+    with open_compressor(out, method, level, workers=workers) as c:
+        c.write(data)
+
+    return out.getvalue()
+
+@contextlib.contextmanager
+def compressed_tar(fileobj, method="gzip", level=None, mtime=0):
+    """ Opens a tar writer on fileobj compressed with method """
+    with open_compressor(fileobj, method, level, mtime) as c:
+        with tarfile.open(fileobj=c, mode='w', format=tarfile.GNU_FORMAT) as tf:
+            yield tf
@@ -0,0 +1,157 @@
+"""
+:Description:
+    Contents-[arch] indexes, as read by apt-file: one line per file shipped
+    by the packages of a component and architecture, with the packages
+    shipping it,
+
+        usr/bin/mytool                                              utils/mytool
+        usr/share/doc/libfoo/copyright                              libs/libfoo,libs/libfoo-dev
+
+    sorted by path and written to dists/[platform]/[component]/Contents-[arch].gz.
+
+    The file list of a package is taken from the tar headers of its
+    data.tar member (see debfile.data_files) and cached by the package's
+    sha256 in [webroot]/.contents-cache, so a publish only reads packages it
+    has not seen before. The sorted lists are merged in a single streaming
+    pass (heapq.merge), through intermediate runs on disk when there are
+    more than MERGE_FAN_IN packages, so memory use does not grow with the
+    repository.
+"""
+
+import os
+import gzip
+import heapq
+import shutil
+import tempfile
+import itertools
+from aptrepo.lib.debfile import data_files
+import aptrepo.lib.snapshot as snapshot
+import aptrepo.lib.trace as trace
+
+CACHE_DIR = ".contents-cache"
+# Sorted inputs merged at once; more go through intermediate runs
+MERGE_FAN_IN = 256
+PATH_COLUMN = 60
+# Output lines compressed per write
+WRITE_LINES = 4096
+
+def contents_name(arch):
+    return "Contents-{}.gz".format(arch)
+
+def cache_path(webroot, sha256):
+    return os.path.join(webroot, CACHE_DIR, sha256[:2], sha256)
+
+def file_list(webroot, path, sha256):
+    """
+    :Description:
+        Returns the path of the cached, sorted file list of the package at
+        path, reading the package's data.tar headers the first time its
+        sha256 is seen.
+    """
+    cached = cache_path(webroot, sha256)
+    if not os.path.exists(cached):
+        print("Listing {}".format(path))
+        # A path with a newline cannot be written to a line based index
+        files = sorted(set(f for f in data_files(path) if not '\n' in f))
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        # Indexes of several architectures may list the same package at once
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(cached))
+        with os.fdopen(fd, 'wb') as raw, \
+                gzip.open(raw, 'wt', encoding='utf-8', errors='surrogateescape') as f:
+            f.writelines(p + '\n' for p in files)
+
+        os.replace(tmp, cached)
+        trace.count("packages_listed")
+
+    return cached
+
+def _read_list(cached, location):
+    with gzip.open(cached, 'rt', encoding='utf-8', errors='surrogateescape') as f:
+        for line in f:
+            yield line[:-1], location
+
+def _read_run(run):
+    with open(run, 'r', encoding='utf-8', errors='surrogateescape') as f:
+        for line in f:
+            path, _, location = line[:-1].partition('\0')
+            yield path, location
+
+def _merge_runs(sources, tmpdir):
+    """ Reduces sources (callables opening sorted (path, location) iterators) to at most MERGE_FAN_IN """
+    while len(sources) > MERGE_FAN_IN:
+        runs = []
+        for n in range(0, len(sources), MERGE_FAN_IN):
+            fd, run = tempfile.mkstemp(suffix=".run", dir=tmpdir)
+            with os.fdopen(fd, 'w', encoding='utf-8', errors='surrogateescape') as f:
+                for path, location in heapq.merge(*[s() for s in sources[n:n + MERGE_FAN_IN]]):
+                    f.write("{}\0{}\n".format(path, location))
+
+            runs.append(run)
+
+        sources = [lambda run=run: _read_run(run) for run in runs]
+
+    return sources
+
+def write_contents(webroot, path, arch, stanzas, locate=None):
+    """
+    :Description:
+        Writes Contents-[arch].gz in the component directory path for the
+        packages of stanzas (the Packages stanzas of the component's
+        binary-[arch] index). locate maps a Filename to where it can be
+        read, as in scanpackages.scan_packages.
+    """
+    locate = locate or (lambda f: os.path.join(webroot, f))
+    sources = []
+    with trace.phase("contents", index=os.path.join(os.path.basename(path), arch)):
+        for s in stanzas:
+            s = dict(s)
+            section = s.get('Section') or 'misc'
+            cached = file_list(webroot, locate(s['Filename']), s['SHA256'])
+            sources.append(lambda cached=cached, location="{}/{}".format(section, s['Package']):
+                           _read_list(cached, location))
+
+        target = os.path.join(path, contents_name(arch))
+        tmpdir = None
+        if len(sources) > MERGE_FAN_IN:
+            os.makedirs(os.path.join(webroot, CACHE_DIR), exist_ok=True)
+            tmpdir = tempfile.mkdtemp(prefix="merge", dir=os.path.join(webroot, CACHE_DIR))
+
+        def write(f):
+            with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as out:
+                lines = []
+                merged = heapq.merge(*[s() for s in _merge_runs(sources, tmpdir)])
+                for filepath, group in itertools.groupby(merged, key=lambda e: e[0]):
+                    locations = ','.join(sorted(set(location for p, location in group)))
+                    lines.append("{} {}\n".format(filepath.ljust(PATH_COLUMN - 1), locations))
+                    if len(lines) >= WRITE_LINES:
+                        out.write(''.join(lines).encode('utf-8', errors='surrogateescape'))
+                        lines = []
+
+                out.write(''.join(lines).encode('utf-8', errors='surrogateescape'))
+
+        try:
+            snapshot.atomic_write(target, write)
+
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir)
+
+def remove(path, arch):
+    """ Drops Contents-[arch].gz from the component directory path, e.g. when contents are turned off """
+    target = os.path.join(path, contents_name(arch))
+    if os.path.exists(target):
+        os.remove(target)
+
+def prune_cache(webroot, sha256s):
+    """ Removes the cached file lists of packages whose sha256 is not in sha256s; returns how many """
+    top = os.path.join(webroot, CACHE_DIR)
+    removed = 0
+    if os.path.isdir(top):
+        for d in os.listdir(top):
+            if os.path.isdir(os.path.join(top, d)) and len(d) == 2:
+                for f in os.listdir(os.path.join(top, d)):
+                    if not f in sha256s and not f.endswith(".tmp"):
+                        os.remove(os.path.join(top, d, f))
+                        removed += 1
+
+    return removed
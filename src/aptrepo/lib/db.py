@@ -1,15 +1,52 @@
 """
 Database Connector for apt-repo
 
+Package databases are parsed at most once per process: load_config() keeps
+the parsed file until its mtime, size or inode change, so constructing,
+validating and re-reading a PackageDB all share a single parse.
+
 TODO: Improve by chunking reads
 """
 import configparser
 import os
 import sys
+import dbm
+import copy
 import json
+import shelve
 from aptrepo.lib.arch import arch
 import socket
 
+# dbpath -> (stat key, parsed ConfigParser)
+_PARSED = {}
+
+def _stat_key(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def load_config(dbpath):
+    """
+    :Description:
+        Returns the parsed database file at dbpath, or None when there is
+        none. The result is cached until the file changes and is shared, so
+        callers must not modify it.
+    """
+    try:
+        key = _stat_key(dbpath)
+
+    except OSError:
+        return None
+
+    cached = _PARSED.get(dbpath)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(dbpath)
+    _PARSED[dbpath] = (key, config)
+    return config
+
 # Define how configparser values get placed back into python objects here:
 LEGEND = {
     'Package': {
@@ -26,7 +63,12 @@ LEGEND = {
         'architecture': lambda x: [y.strip() for y in x.split(',')]
         },
     'Build': {
-        'profiles': lambda x: [y.strip() for y in x.split(',')]
+        'profiles': lambda x: [y.strip() for y in x.split(',')],
+        'writer': lambda x: str(x),
+        'cache': lambda x: str(x),
+        'exclude': lambda x: [y.strip() for y in x.split(',') if y.strip()],
+        'compression': lambda x: str(x),
+        'compress_level': lambda x: str(x)
         },
     'Override': lambda x, y: {x: y},
     'Files': lambda x, y: {x: y},
@@ -39,6 +81,8 @@ LEGEND = {
 class PackageDB():
     
     PROFILES = ["deb", "opk", "ipk", "tar.gz"]
+    WRITERS = ["dpkg", "native"]
+    CACHE_MODES = ["mtime", "content", "off"]
     SECTIONS = ['Package', 'Build', 'Override', 'Files', 'Control', 'User']
     
     def __init__(self, path, pkgname, **kwargs):
@@ -56,8 +100,10 @@ class PackageDB():
                 'suggests': kwargs.get('suggests', []),
                 'replaces': kwargs.get('replaces', []),
                 'section': kwargs.get('section', "misc"),
-                'architecture': kwargs.get('architecture', arch())},
-            'Build': {'profiles': ['deb']},
+                'architecture': kwargs.get('architecture', [arch()])},
+            'Build': {'profiles': ['deb'], 'writer': 'dpkg', 'cache': 'mtime',
+                      'exclude': ['__pycache__', '.svn'], 'compression': 'gzip',
+                      'compress_level': ''},
             'Override': {k: v for k, v in kwargs.get('override', {}).items()},
             'Files': {k: v for k, v in kwargs.get('files', {}).items()},
             'Control': {k: v for k, v in kwargs.get('control', {}).items()},
@@ -86,6 +132,10 @@ class PackageDB():
             if not profile in self.PROFILES:
                 sys.stderr.write("Warning: Build Profile <{}> is not in the list " 
                     "of supported profiles\n".format(profile))
+
+        if not self.db['Build'].get('writer', 'dpkg') in self.WRITERS:
+            sys.stderr.write("Warning: Build Writer <{}> is not in the list "
+                "of supported writers\n".format(self.db['Build']['writer']))
         
         for k, v in self.db.items():
             if not k in config.sections():
@@ -104,11 +154,14 @@ class PackageDB():
 
                 config[k][key] = val
                 
-        with open(os.path.join(self.db['Package']['directory'], 
-                               self.pkgname, self.pkgname), 'w') as f:
+        dbpath = os.path.join(self.db['Package']['directory'], self.pkgname, self.pkgname)
+        with open(dbpath, 'w') as f:
             
             config.write(f)
             
+        # What was just written is what the next read would parse
+        _PARSED[dbpath] = (_stat_key(dbpath), config)
+            
             
     def update(self, **kwargs):
         if not kwargs.get('profile') is None:
@@ -124,9 +177,9 @@ class PackageDB():
     
     def read(self, path, pkgname):
         """ Reads sections found in SECTIONS """
-        config = configparser.ConfigParser()
-        config.optionxform = str
-        config.read(os.path.join(path, pkgname, pkgname))
+        config = load_config(os.path.join(path, pkgname, pkgname))
+        if config is None:
+            raise Exception("Package database not found: {}".format(os.path.join(path, pkgname, pkgname)))
         
         buildprofs = [a.strip() for a in config['Build']['profiles'].split(',')]
         for bp in list(filter(lambda x: not x in self.PROFILES, buildprofs)):
@@ -144,16 +197,22 @@ class PackageDB():
                     self.db[section][key] = LEGEND[section][key](config[section][key])
                                
     def validate(self):
-        config = configparser.ConfigParser()
-        config.optionxform = str
-        config.read(os.path.join(self.db['Package']['directory'], self.pkgname, self.pkgname))
-        for s in config.sections():
+        config = load_config(os.path.join(self.db['Package']['directory'], self.pkgname, self.pkgname))
+        for s in (config.sections() if config is not None else []):
             if not s in self.SECTIONS:
                 print("Failed to validate section {}".format(s))
                 return False
             
         return True
     
+    @classmethod
+    def from_dict(cls, pkgname, db):
+        """ A PackageDB holding an already loaded database, without touching the disk """
+        packagedb = cls.__new__(cls)
+        packagedb.pkgname = pkgname
+        packagedb.db = copy.deepcopy(db)
+        return packagedb
+
     def duplicate(self, path, pkgname):
         ''' Includes some refactoring '''
         raise NotImplementedError(__name__)
@@ -201,6 +260,59 @@ def migrate(old_db_filehandle, newdb):
     
     else:
         raise ValueError("Migration failed to translate shelve db into new configparser db")
-        
-    
-    
+
+LEGACY_SUFFIXES = ['', '.db', '.dat', '.dir', '.bak', '.pag']
+LEGACY_BACKUP = ".legacy"
+
+def is_legacy_db(dbpath):
+    """ True when dbpath is a 0.9 shelve database rather than a configuration file """
+    try:
+        return bool(dbm.whichdb(dbpath))
+
+    except OSError:
+        return False
+
+def load_package_db(path, pkgname, **kwargs):
+    """
+    :Description:
+        Returns the PackageDB of pkgname, first migrating a 0.9 shelve
+        database to the configuration file format if that is what is on
+        disk. Only a cheap dbm.whichdb() probe is paid otherwise.
+    """
+    dbpath = os.path.join(path, pkgname, pkgname)
+    if is_legacy_db(dbpath):
+        print("\tMigrating database to configuration file format")
+        # Depending on the dbm flavour the shelve is one file or several,
+        # the first of which may have the name of the configuration file
+        legacy = [dbpath + suffix for suffix in LEGACY_SUFFIXES if os.path.isfile(dbpath + suffix)]
+        moved = []
+        try:
+            with shelve.open(dbpath, 'r') as dbf:
+                newkwargs = {x: y for x, y in dbf.items()}
+
+            newkwargs.setdefault('directory', path)
+            # Kept aside until the configuration file is written and readable
+            for f in legacy:
+                os.replace(f, f + LEGACY_BACKUP)
+                moved.append(f)
+
+            PackageDB(path, pkgname, **newkwargs).write()
+            check = configparser.ConfigParser()
+            if not check.read(dbpath) or not check.sections():
+                raise Exception("{} could not be read back".format(dbpath))
+
+            for f in moved:
+                os.remove(f + LEGACY_BACKUP)
+
+            print("\tMigration procedure complete.")
+
+        except Exception as E:
+            if moved and os.path.isfile(dbpath) and not dbpath in moved:
+                os.remove(dbpath)
+
+            for f in moved:
+                os.replace(f + LEGACY_BACKUP, f)
+
+            sys.stderr.write("Error: migration of {} failed, the database is left as it was: {}\n".format(dbpath, E))
+
+    return PackageDB(path, pkgname, **kwargs)
@@ -0,0 +1,225 @@
+"""
+:Description:
+    Python representation of the parts of dpkg-deb that apt-repo needs:
+    walking the outer ar container, pulling the control file out of the
+    control.tar member without extracting anything to disk, and writing a
+    .deb by streaming its members straight into the ar container.
+
+    A .deb is an ar archive holding, in order, "debian-binary",
+    "control.tar[.gz|.xz|...]" and "data.tar[.gz|.xz|...]". An .ipk holds
+    the same members, either in an ar archive too or, as opkg-build and
+    apt-pkg write them, in a gzip compressed tar archive, in no fixed
+    order: apt-pkg puts control.tar.gz first, opkg-build puts it last.
+"""
+
+import io
+import os
+import tarfile
+import contextlib
+
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+GZIP_MAGIC = b"\x1f\x8b"
+
+def iter_ar_members(fileobj):
+    """
+    :Description:
+        Yields (name, size, offset) for every member of the ar archive opened
+        as fileobj. offset is the position of the member data in the file;
+        the data itself is skipped, so only the 60 byte headers are read.
+    """
+    if fileobj.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise Exception("Not an ar archive: {}".format(getattr(fileobj, 'name', fileobj)))
+
+    while True:
+        header = fileobj.read(AR_HEADER_SIZE)
+        if len(header) < AR_HEADER_SIZE:
+            return
+
+        name = header[0:16].decode('ascii').strip()
+        # GNU ar terminates names with a slash
+        if name.endswith('/'):
+            name = name[:-1]
+
+        size = int(header[48:58].decode('ascii').strip())
+        offset = fileobj.tell()
+        yield (name, size, offset)
+        # Members are aligned to even offsets
+        fileobj.seek(offset + size + (size % 2))
+
+def read_ar_member(path, prefix):
+    """ Returns the raw bytes of the first member whose name starts with prefix """
+    with open(path, 'rb') as f:
+        for name, size, offset in iter_ar_members(f):
+            if name.startswith(prefix):
+                f.seek(offset)
+                return name, f.read(size)
+
+    raise Exception("{} has no {} member".format(path, prefix))
+
+def read_control(path):
+    """
+    :Description:
+        Returns the text of the DEBIAN/control file of the .deb or .ipk at
+        path. Only the control.tar member is read.
+    """
+    with open_member(path, 'control.tar') as (name, member):
+        if name.endswith('.zst'):
+            raise Exception("{}: zstd compressed control members are not supported".format(path))
+
+        with tarfile.open(fileobj=member, mode='r|*') as tf:
+            for m in tf:
+                if m.isfile() and os.path.normpath(m.name) == 'control':
+                    return tf.extractfile(m).read().decode('utf-8')
+
+    raise Exception("{} has no control file".format(path))
+
+class ArMemberReader(io.RawIOBase):
+    """ Read only, seekable view of the member at offset (size bytes long) of an open ar archive """
+
+    def __init__(self, fileobj, offset, size):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: self.size}[whence]
+        self.pos = min(max(base + pos, 0), self.size)
+        return self.pos
+
+    def readinto(self, buf):
+        n = min(len(buf), self.size - self.pos)
+        if n <= 0:
+            return 0
+
+        self.fileobj.seek(self.offset + self.pos)
+        data = self.fileobj.read(n)
+        buf[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+@contextlib.contextmanager
+def open_member(path, prefix):
+    """
+    :Description:
+        Yields (name, readable file object) for the first member whose name
+        starts with prefix of the package at path, an ar archive or the
+        tar.gz outer archive of an ipk. Nothing is extracted: an ar member
+        is read in place, whatever its position. A tar.gz archive cannot be
+        seeked, so it is decompressed as a stream up to the member: for an
+        ipk written by opkg-build, which puts data.tar.gz before
+        control.tar.gz, getting at the control file costs inflating the
+        outer archive over the whole (still compressed) data.tar.gz, about
+        as much as hashing the file. Scans only pay it for packages that
+        are not in the stanza cache.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(AR_MAGIC))
+        f.seek(0)
+        if magic.startswith(GZIP_MAGIC):
+            with tarfile.open(fileobj=f, mode='r|gz') as outer:
+                for m in outer:
+                    name = os.path.basename(os.path.normpath(m.name))
+                    if m.isfile() and name.startswith(prefix):
+                        yield name, outer.extractfile(m)
+                        return
+
+        else:
+            for name, size, offset in iter_ar_members(f):
+                if name.startswith(prefix):
+                    yield name, io.BufferedReader(ArMemberReader(f, offset, size))
+                    return
+
+    raise Exception("{} has no {} member".format(path, prefix))
+
+def data_files(path):
+    """
+    :Description:
+        Yields the path (without the leading "./") of every file, symlink
+        and hardlink in the data.tar member of the .deb or .ipk at path.
+        Only tar headers are parsed and nothing is extracted: an
+        uncompressed data.tar in an ar archive is walked by seeking from
+        header to header, anything else is decompressed as a stream.
+    """
+    with open_member(path, 'data.tar') as (name, member):
+        if name.endswith('.zst'):
+            raise Exception("{}: zstd compressed data members are not supported".format(path))
+
+        seekable = name == 'data.tar' and member.seekable()
+        with tarfile.open(fileobj=member, mode='r:' if seekable else 'r|*') as tf:
+            for m in tf:
+                if not m.isdir():
+                    relpath = os.path.normpath(m.name)
+                    if relpath != '.':
+                        yield relpath.lstrip('/')
+
+def parse_control(text):
+    """
+    :Description:
+        Parses a control stanza into a list of (field, value) pairs, keeping
+        the original field order. Continuation lines stay part of the value.
+    """
+    fields = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+
+        if line[0] in ' \t' and fields:
+            fields[-1] = (fields[-1][0], "{}\n{}".format(fields[-1][1], line))
+
+        else:
+            key, _, value = line.partition(':')
+            fields.append((key.strip(), value.strip()))
+
+    return fields
+
+def ar_header(name, size, mtime=0, mode=0o100644):
+    return "{:<16}{:<12}{:<6}{:<6}{:<8o}{:<10}`\n".format(
+        name, int(mtime), 0, 0, mode, size).encode('ascii')
+
+def write_ar_member(fileobj, name, writer, mtime=0):
+    """
+    :Description:
+        Appends a member to the ar archive being written to the seekable
+        fileobj. writer is either bytes or a callable that streams the member
+        data into fileobj; the size in the header is patched in afterwards,
+        so the member never has to be held in memory or staged on disk.
+    """
+    start = fileobj.tell()
+    fileobj.write(ar_header(name, 0, mtime))
+    if callable(writer):
+        writer(fileobj)
+
+    else:
+        fileobj.write(writer)
+
+    end = fileobj.tell()
+    size = end - start - AR_HEADER_SIZE
+    fileobj.seek(start)
+    fileobj.write(ar_header(name, size, mtime))
+    fileobj.seek(end)
+    if size % 2:
+        fileobj.write(b"\n")
+
+def write_deb(path, control_writer, data_writer, control_name="control.tar.gz",
+              data_name="data.tar.gz", mtime=0):
+    """
+    :Description:
+        Writes a .deb to path. control_writer and data_writer are callables
+        that stream a tar archive into the file object they are given.
+    """
+    with open(path, 'wb') as f:
+        f.write(AR_MAGIC)
+        write_ar_member(f, "debian-binary", b"2.0\n", mtime)
+        write_ar_member(f, control_name, control_writer, mtime)
+        write_ar_member(f, data_name, data_writer, mtime)
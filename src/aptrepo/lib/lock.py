@@ -0,0 +1,177 @@
+"""
+:Description:
+    Serializes the publishes of several processes (CI workers running
+    'apt-repo [platform] add' at the same time) to one repository.
+
+    Every publish runs under the repository's publish lock, an flock(2) on
+    [webroot]/.publish.lock, which the kernel releases if its holder dies.
+    Changes are first written to the publish queue ([webroot]/.queue/), one
+    JSON request per invocation; whoever holds the lock takes every queued
+    request and publishes them together, one transaction (so one index
+    regeneration and one Release) per platform. A worker that finds a
+    publish running either waits for its request to be published by it
+    (the default) or, with --no-wait, leaves the request queued and returns.
+
+    Package files of requests that do not wait are copied into the queue,
+    so the worker may delete its build tree as soon as it returns.
+"""
+
+import os
+import json
+import glob
+import time
+import fcntl
+import shutil
+import uuid
+
+LOCK_FILE = ".publish.lock"
+QUEUE_DIR = ".queue"
+RESULTS_DIR = "results"
+# Seconds a result is kept for a waiting sender, which reads it as soon as the publish is done
+RESULTS_TTL = 3600
+
+class PublishLock(object):
+    """ The publish lock of the repository at webroot; re-entrant within one holder """
+
+    def __init__(self, webroot):
+        self.path = os.path.join(webroot, LOCK_FILE)
+        self.fd = None
+        self.depth = 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def acquire(self, blocking=True):
+        """ Takes the lock, waiting for it when blocking; returns False if it is held elsewhere """
+        if self.fd is None:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+
+            except BlockingIOError:
+                os.close(fd)
+                return False
+
+            self.fd = fd
+
+        self.depth += 1
+        return True
+
+    def release(self):
+        if self.fd is None:
+            return
+
+        self.depth -= 1
+        if self.depth == 0:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+class PublishQueue(object):
+    """
+    :Description:
+        The queued publish requests of the repository at webroot. A request
+        is a dict with its id, platform, configdir, the repository options
+        its sender overrides (command line options), operations ((operation,
+        argument) pairs, see transaction) and whether its sender waits for
+        the result.
+    """
+
+    def __init__(self, webroot):
+        self.path = os.path.join(webroot, QUEUE_DIR)
+
+    def put(self, platform, configdir, operations, spool=False, wait=True, options=None):
+        """
+        :Description:
+            Queues operations; returns the request id. Add patterns are
+            expanded here, relative to the caller's working directory, and
+            with spool the matching files are copied into the queue.
+        """
+        request = "{:.6f}-{}-{}".format(time.time(), os.getpid(), uuid.uuid4().hex[:8])
+        os.makedirs(self.path, exist_ok=True)
+        queued = []
+        for op, arg in operations:
+            if op != "add":
+                queued.append((op, arg))
+                continue
+
+            matched = sorted(glob.glob(arg)) or [arg]
+            for n, path in enumerate(matched):
+                if spool and os.path.isfile(path):
+                    # One folder per file keeps the file name, which ipk feeds rely on
+                    spooled = os.path.join(self.path, request, str(n), os.path.basename(path))
+                    os.makedirs(os.path.dirname(spooled))
+                    shutil.copy2(path, spooled)
+                    path = spooled
+
+                queued.append((op, glob.escape(os.path.abspath(path))))
+
+        item = dict(id=request, platform=platform, configdir=configdir, options=options or {},
+                    operations=queued, wait=wait, pid=os.getpid())
+        tmp = os.path.join(self.path, ".{}.tmp".format(request))
+        with open(tmp, 'w') as f:
+            json.dump(item, f)
+
+        os.replace(tmp, os.path.join(self.path, request + ".json"))
+        return request
+
+    def items(self):
+        """ Every queued request, oldest first """
+        items = []
+        if os.path.isdir(self.path):
+            for f in sorted(os.listdir(self.path)):
+                if f.endswith(".json") and not f.startswith('.'):
+                    try:
+                        with open(os.path.join(self.path, f), 'r') as fp:
+                            items.append(json.load(fp))
+
+                    except (OSError, ValueError):
+                        continue
+
+        return items
+
+    def pending(self):
+        return bool(self.items())
+
+    def finish(self, item, result):
+        """ Drops a published request and its spooled files, keeping result for a waiting sender """
+        if item.get('wait'):
+            os.makedirs(os.path.join(self.path, RESULTS_DIR), exist_ok=True)
+            tmp = os.path.join(self.path, RESULTS_DIR, ".{}.tmp".format(item['id']))
+            with open(tmp, 'w') as f:
+                json.dump(result, f)
+
+            os.replace(tmp, os.path.join(self.path, RESULTS_DIR, item['id'] + ".json"))
+
+        os.remove(os.path.join(self.path, item['id'] + ".json"))
+        shutil.rmtree(os.path.join(self.path, item['id']), ignore_errors=True)
+
+    def result(self, request):
+        """ The result of a published request (dict of indexes and error), removed once read; None if unknown """
+        path = os.path.join(self.path, RESULTS_DIR, request + ".json")
+        try:
+            with open(path, 'r') as f:
+                result = json.load(f)
+
+        except (OSError, ValueError):
+            return None
+
+        os.remove(path)
+        return result
+
+    def expire(self, max_age=RESULTS_TTL):
+        """ Removes results older than max_age seconds, left by senders that stopped waiting """
+        results = os.path.join(self.path, RESULTS_DIR)
+        if os.path.isdir(results):
+            now = time.time()
+            for f in os.listdir(results):
+                try:
+                    if now - os.path.getmtime(os.path.join(results, f)) > max_age:
+                        os.remove(os.path.join(results, f))
+
+                except OSError:
+                    continue
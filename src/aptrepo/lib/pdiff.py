@@ -0,0 +1,259 @@
+"""
+:Description:
+    Incremental index diffs (PDiffs) as served by Debian archives. Next to
+    every Packages file, Packages.diff/ holds ed scripts that turn one
+    generation of the index into the next, compressed with gzip, and an
+    Index listing them:
+
+        SHA256-Current: [digest of the live Packages] [size]
+        SHA256-History:
+         [digest of the Packages a patch applies to] [size] [patch name]
+        SHA256-Patches:
+         [digest of the patch] [size] [patch name]
+        SHA256-Download:
+         [digest of the patch.gz] [size] [patch name].gz
+
+    A client whose Packages is listed in the history downloads the patches
+    from there on instead of the whole index, so a publish that changes a
+    single package costs it a few hundred bytes.
+
+    Packages files are sorted by package and version (see scanpackages), so
+    patches are computed with a single merge of the old and new stanzas
+    keyed on Package, Version and Architecture, linear in the size of the
+    index, instead of a generic longest common subsequence diff.
+"""
+
+import os
+import shutil
+import datetime
+import aptrepo.lib.compress as compress
+import aptrepo.lib.snapshot as snapshot
+from aptrepo.lib.security import hash_bytes
+
+DIFF_DIR = "Packages.diff"
+INDEX = "Index"
+KEEP_PATCHES = 14
+
+# Index fields, each computed with the hash_bytes() algorithm given
+CHECKSUMS = [("SHA1", "sha1"), ("SHA256", "sha256")]
+# Digests listed per patch: of the Packages it applies to, of the patch, of the patch.gz
+SECTIONS = ["History", "Patches", "Download"]
+
+PATCH_NAME = "%Y-%m-%d-%H%M.%S"
+
+def stanza_units(data):
+    """ Splits a Packages file into stanzas, each a list of its lines including the blank line ending it """
+    lines = data.decode('utf-8').split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+
+    units, unit = [], []
+    for line in lines:
+        unit.append(line)
+        if line == '':
+            units.append(unit)
+            unit = []
+
+    if unit:
+        units.append(unit)
+
+    return units
+
+def stanza_key(unit):
+    fields = {}
+    for line in unit:
+        name, sep, value = line.partition(': ')
+        if sep and name in ("Package", "Version", "Architecture") and not name in fields:
+            fields[name] = value
+
+    return (fields.get("Package", ""), fields.get("Version", ""), fields.get("Architecture", ""))
+
+def matching_stanzas(old, new):
+    """
+    :Description:
+        Pairs (i, j) of identical stanzas old[i] == new[j], increasing in
+        both i and j, found by merging the two lists on stanza_key(). Lists
+        sorted on that key give the minimal edit; any other order still
+        gives a correct, if larger, one.
+    """
+    matches = []
+    oldkeys = [stanza_key(u) for u in old]
+    newkeys = [stanza_key(u) for u in new]
+    i = j = 0
+    while i < len(old) and j < len(new):
+        if oldkeys[i] == newkeys[j]:
+            if old[i] == new[j]:
+                matches.append((i, j))
+
+            i += 1
+            j += 1
+
+        elif oldkeys[i] < newkeys[j]:
+            i += 1
+
+        else:
+            j += 1
+
+    return matches
+
+def ed_script(old_data, new_data):
+    """
+    :Description:
+        Returns the ed script (as diff --ed writes it: hunks from the end of
+        the file to its start) turning the Packages file old_data into
+        new_data, both bytes.
+    """
+    old, new = stanza_units(old_data), stanza_units(new_data)
+    for unit in new:
+        if '.' in unit:
+            # A lone "." would end the text of an ed command
+            raise ValueError("Packages line '.' cannot be written to an ed script")
+
+    # offsets[i] is the line number (1 based) old[i] starts at
+    offsets = [1]
+    for unit in old:
+        offsets.append(offsets[-1] + len(unit))
+
+    hunks = []
+    i = j = 0
+    for mi, mj in matching_stanzas(old, new) + [(len(old), len(new))]:
+        if i < mi or j < mj:
+            hunks.append((offsets[i], offsets[mi] - 1, [l for u in new[j:mj] for l in u]))
+
+        i, j = mi + 1, mj + 1
+
+    script = []
+    for first, last, lines in reversed(hunks):
+        lines = ''.join(l + '\n' for l in lines)
+        span = str(first) if first == last else "{},{}".format(first, last)
+        if last < first:
+            script.append("{}a\n{}.\n".format(last, lines))
+
+        elif not lines:
+            script.append("{}d\n".format(span))
+
+        else:
+            script.append("{}c\n{}.\n".format(span, lines))
+
+    return ''.join(script).encode('utf-8')
+
+def digests(data):
+    """ {algo: (digest, size)} of data for every Index checksum """
+    d = hash_bytes(data, [algo for field, algo in CHECKSUMS])
+    return {algo: (d[algo], str(d['size'])) for field, algo in CHECKSUMS}
+
+def read_index(path):
+    """
+    :Description:
+        Parses the Index in path into (current, history). current holds the
+        digests ({algo: (digest, size)}) of the live Packages, history one
+        (patch name, {"History": ..., "Patches": ..., "Download": ...})
+        entry per patch, oldest first, with the digests of the Packages it
+        applies to, of the patch and of the patch.gz. ({}, []) when there is
+        no readable Index.
+    """
+    try:
+        with open(os.path.join(path, DIFF_DIR, INDEX), 'r') as f:
+            lines = f.read().split('\n')
+
+    except OSError:
+        return {}, []
+
+    algos = dict(CHECKSUMS)
+    current, history, section = {}, {}, (None, None)
+    for line in lines:
+        if not line.strip():
+            continue
+
+        if not line.startswith(' '):
+            field, _, value = line.partition(':')
+            prefix, _, kind = field.partition('-')
+            section = (algos.get(prefix), kind)
+            if kind == "Current" and section[0] and len(value.split()) == 2:
+                current[section[0]] = tuple(value.split())
+
+        elif section[0] and section[1] in SECTIONS and len(line.split()) == 3:
+            digest, size, name = line.split()
+            if section[1] == "Download" and name.endswith(".gz"):
+                name = name[:-len(".gz")]
+
+            history.setdefault(name, {}).setdefault(section[1], {})[section[0]] = (digest, size)
+
+    return current, sorted(history.items())
+
+def write_index(path, current, history):
+    """ Writes Packages.diff/Index in path from what read_index() returns """
+    out = []
+    for field, algo in CHECKSUMS:
+        out.append("{}-Current: {} {}\n".format(field, *current[algo]))
+
+    for section in SECTIONS:
+        for field, algo in CHECKSUMS:
+            out.append("{}-{}:\n".format(field, section))
+            for name, entry in history:
+                out.append(" {} {:>10} {}{}\n".format(entry[section][algo][0], entry[section][algo][1], name,
+                                                      ".gz" if section == "Download" else ""))
+
+    snapshot.atomic_write(os.path.join(path, DIFF_DIR, INDEX), ''.join(out))
+
+def patch_name(taken):
+    """ A patch name for the current time, sorting after every name in taken """
+    name = datetime.datetime.now(datetime.timezone.utc).strftime(PATCH_NAME)
+    if taken and name <= max(taken):
+        # Two publishes within a second, or the clock went back
+        latest = datetime.datetime.strptime(max(taken), PATCH_NAME)
+        name = (latest + datetime.timedelta(seconds=1)).strftime(PATCH_NAME)
+
+    return name
+
+def remove(path):
+    """ Drops the Packages.diff of the index directory path, e.g. when PDiffs are turned off """
+    if os.path.isdir(os.path.join(path, DIFF_DIR)):
+        shutil.rmtree(os.path.join(path, DIFF_DIR))
+
+def update(path, old_data, new_data, keep=KEEP_PATCHES):
+    """
+    :Description:
+        Records the change of the Packages file in the index directory path
+        from old_data (None when there was none) to new_data: writes the
+        patch between them, adds it to the Index and removes patches beyond
+        the keep most recent ones. A history that does not end at old_data
+        (the index was rewritten with PDiffs turned off in between, or a
+        patch went missing) is started over. Returns the new patch name,
+        None when no patch was written.
+    """
+    diffdir = os.path.join(path, DIFF_DIR)
+    if keep <= 0 or old_data is None:
+        remove(path)
+        return None
+
+    if old_data == new_data:
+        return None
+
+    try:
+        patch = ed_script(old_data, new_data)
+
+    except ValueError:
+        remove(path)
+        return None
+
+    current, history = read_index(path)
+    old = digests(old_data)
+    if current.get('sha256') != old['sha256'] or \
+            not all(os.path.exists(os.path.join(diffdir, name + ".gz")) for name, entry in history) or \
+            not all(set(entry) == set(SECTIONS) for name, entry in history):
+        history = []
+
+    name = patch_name([n for n, entry in history])
+    download = compress.compress_bytes(patch, 'gzip')
+    os.makedirs(diffdir, exist_ok=True)
+    snapshot.atomic_write(os.path.join(diffdir, name + ".gz"), download)
+    history = (history + [(name, dict(History=old, Patches=digests(patch), Download=digests(download)))])[-keep:]
+    kept = set(n + ".gz" for n, entry in history)
+    # Only patches: Packages.diff/ also holds the Index and, with by_hash, by-hash/
+    for f in os.listdir(diffdir):
+        if f.endswith(".gz") and not f in kept and os.path.isfile(os.path.join(diffdir, f)):
+            os.remove(os.path.join(diffdir, f))
+
+    write_index(path, digests(new_data), history)
+    return name
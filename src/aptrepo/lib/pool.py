@@ -0,0 +1,139 @@
+"""
+:Description:
+    Pool storage for repository packages. As in the Debian archive, every
+    package file is stored once, in pool/[component]/[prefix]/[name]/, and
+    the Packages indexes of each architecture refer to it through their
+    Filename field instead of holding copies of their own.
+
+    Identical content is stored once: a file whose sha256 is already in the
+    pool is hardlinked rather than copied. A pool file never changes while
+    anything lists it: like the Debian archive, the pool refuses a package
+    file of the same name (name, version and architecture) with different
+    content, as every index and every generation kept for rollback that
+    lists it also records its size and checksums. Where a per-architecture path is
+    still wanted (the flat layout, or .ipk feeds that opkg reads straight
+    from the directory), it is a hardlink to the pool file as well.
+"""
+
+import os
+import shutil
+import aptrepo.lib.trace as trace
+from aptrepo.lib.arch import get_arch
+from aptrepo.lib.security import hash_file
+
+POOL_DIR = "pool"
+
+def pool_prefix(name):
+    """ pool/main/[prefix]/...: "libfoo" -> "libf", "foo" -> "f" """
+    if name.startswith('lib') and len(name) > 3:
+        return name[:4]
+
+    return name[:1]
+
+def package_filename(fields, ext=".deb"):
+    """ Canonical name_version_arch file name, without the version epoch """
+    version = fields['Version'].split(':', 1)[-1]
+    return "{}_{}_{}{}".format(fields['Package'], version, fields.get('Architecture', 'all'), ext)
+
+def pool_path(component, name, filename):
+    """ Path, relative to the repository root, of a package file in the pool """
+    return os.path.join(POOL_DIR, component, pool_prefix(name), name, filename)
+
+def arch_matches(fields, architecture):
+    """ True when a package built for fields['Architecture'] belongs in the architecture index """
+    pkgarch = fields.get('Architecture', 'all')
+    return pkgarch == 'all' or get_arch(pkgarch) == get_arch(architecture)
+
+def link_or_copy(src, dst, link=True):
+    """ Atomically puts src at dst, as a hardlink when link is set and both are on one filesystem """
+    tmp = "{}.tmp".format(dst)
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+
+    try:
+        if not link:
+            raise OSError("copy requested")
+
+        os.link(src, tmp)
+
+    except OSError:
+        shutil.copyfile(src, tmp)
+        trace.count("bytes_copied", os.path.getsize(tmp))
+
+    os.replace(tmp, dst)
+
+def place(webroot, src, relpath, sha256, catalog=None, known=None, in_use=None):
+    """
+    :Description:
+        Makes webroot/relpath hold the content of src, whose sha256 is
+        given. Nothing is written when the file is already there with the
+        same content; content already in the repository (per the catalog)
+        is hardlinked instead of copied; src itself is always copied, so
+        the pool never shares an inode with a file outside the repository.
+        known maps sha256 to files placed earlier and not yet in the catalog
+        and is updated. A file already there with other content is only
+        replaced when in_use(relpath) is false (nothing lists it); otherwise
+        an Exception is raised. Returns True when the file changed.
+    """
+    known = {} if known is None else known
+    dst = os.path.join(webroot, relpath)
+    if os.path.exists(dst):
+        if hash_file(dst, ["sha256"])['sha256'] == sha256:
+            known.setdefault(sha256, relpath)
+            return False
+
+        if in_use is None or in_use(relpath):
+            raise Exception("{} is already in the repository with different content; "
+                            "upload it with a new version".format(relpath))
+
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    candidates = [known[sha256]] if sha256 in known else []
+    if catalog is not None:
+        candidates.extend(row['filename'] for row in catalog.find_sha256(sha256))
+
+    source, link = src, False
+    for c in candidates:
+        if c != relpath and os.path.exists(os.path.join(webroot, c)):
+            source, link = os.path.join(webroot, c), True
+            break
+
+    link_or_copy(source, dst, link)
+    known.setdefault(sha256, relpath)
+    return True
+
+def is_used(catalog, filename):
+    """ True when an index lists filename, or a flat layout hardlink of this pool file """
+    if catalog.is_referenced(filename):
+        return True
+
+    parts = filename.split(os.sep)
+    if parts[0] == POOL_DIR and len(parts) > 2:
+        return any(r['component'] == parts[1] for r in catalog.find_basename(parts[-1]))
+
+    return False
+
+def collect(webroot, catalog, filenames, keep=()):
+    """
+    :Description:
+        Removes those of filenames (relative to webroot) that are pool files
+        no index refers to any more, nor any filename in keep (the files
+        listed by generations kept for rollback).
+    """
+    # Pool files can be shared by platforms, all of which must be known here
+    catalog.ensure_all()
+    removed = []
+    for f in sorted(set(filenames)):
+        if f.split(os.sep)[0] != POOL_DIR or f in keep:
+            continue
+
+        if not is_used(catalog, f) and os.path.exists(os.path.join(webroot, f)):
+            os.remove(os.path.join(webroot, f))
+            removed.append(f)
+            d = os.path.dirname(os.path.join(webroot, f))
+            # Drop the now empty pool/[component]/[prefix]/[name] folders
+            while (os.path.relpath(d, webroot).split(os.sep)[0] == POOL_DIR and
+                   len(os.path.relpath(d, webroot).split(os.sep)) > 2 and not os.listdir(d)):
+                os.rmdir(d)
+                d = os.path.dirname(d)
+
+    return removed
@@ -0,0 +1,213 @@
+"""
+:Description:
+    Python representation of the Release file generation done by
+    apt-ftparchive. The top level dists/[platform]/Release file lists every
+    index file of the platform with its size and checksums, so it has to be
+    rewritten every time an index changes.
+
+    With the sign_key option, Release is signed as Release.gpg (detached)
+    and InRelease (clearsigned, as gpg --clearsign writes it), only when the
+    content of Release changed: a Release that would only differ by its Date
+    is left as it is, signatures included. The Release files of every
+    platform of one publish are signed together, see sign_releases.
+"""
+
+import os
+import shutil
+import datetime
+from aptrepo.lib.arch import get_arch
+import aptrepo.lib.snapshot as snapshot
+import aptrepo.lib.trace as trace
+from aptrepo.lib.pdiff import DIFF_DIR, INDEX
+from aptrepo.lib.security import hash_files, signature_issuer, signer
+
+# Contents-[arch].gz of each component, see contents
+CONTENTS_PREFIX = "Contents-"
+
+INDEX_FILES = ["Packages", "Packages.gz", "Packages.xz", "Sources", "Sources.gz",
+               "Sources.xz", "Release"]
+
+# Release section name and the hash_file() algorithm it is computed with
+CHECKSUM_SECTIONS = [("MD5Sum", "md5"), ("SHA1", "sha1"), ("SHA256", "sha256")]
+
+# Options written into Release or used to sign it
+RELEASE_OPTIONS = ["name", "desc", "architecture", "restrictions", "by_hash", "sign_key", "gnupghome"]
+
+SIGNATURES = ["Release.gpg", "InRelease"]
+CLEARSIGN_HEADER = "-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA256\n\n"
+SIGNATURE_ARMOR = "-----BEGIN PGP SIGNATURE-----\n"
+
+BY_HASH_DIR = "by-hash"
+BY_HASH_KEEP = 3
+
+def index_files(distpath):
+    """ Yields paths, relative to distpath, of every index file below it """
+    for root, dirs, files in os.walk(distpath):
+        if BY_HASH_DIR in dirs:
+            dirs.remove(BY_HASH_DIR)
+
+        dirs.sort()
+        if root == distpath:
+            continue
+
+        for f in sorted(files):
+            if f in INDEX_FILES or (f == INDEX and os.path.basename(root) == DIFF_DIR) or \
+                    (f.startswith(CONTENTS_PREFIX) and f.endswith(".gz")):
+                yield os.path.relpath(os.path.join(root, f), distpath)
+
+def publish_by_hash(distpath, relfiles, digests, keep=BY_HASH_KEEP):
+    """
+    :Description:
+        Links every index file (but not the per-architecture Release files)
+        into [index dir]/by-hash/[Algo]/[digest] so clients and proxies can
+        fetch an index by the checksum they read from Release. Besides the
+        current generation, the keep most recent older ones are kept and
+        anything older is removed.
+    """
+    current = {}
+    for r in relfiles:
+        if os.path.basename(r) == "Release":
+            continue
+
+        d = digests[os.path.join(distpath, r)]
+        for section, algo in CHECKSUM_SECTIONS:
+            hashdir = os.path.join(distpath, os.path.dirname(r), BY_HASH_DIR, section)
+            os.makedirs(hashdir, exist_ok=True)
+            target = os.path.join(hashdir, d[algo])
+            if not os.path.exists(target):
+                try:
+                    os.link(os.path.join(distpath, r), target)
+
+                except OSError:
+                    shutil.copy2(os.path.join(distpath, r), target)
+
+            current.setdefault(hashdir, set()).add(d[algo])
+
+    for hashdir, digestset in current.items():
+        old = [f for f in os.listdir(hashdir) if not f in digestset]
+        old.sort(key=lambda f: os.path.getmtime(os.path.join(hashdir, f)), reverse=True)
+        # Every index file in the directory gets to keep its own generations
+        files_per_generation = len(digestset)
+        for f in old[keep * files_per_generation:]:
+            os.remove(os.path.join(hashdir, f))
+
+def clearsigned_text(text):
+    """ The clearsigned message of text up to its signature, dash escaped """
+    escaped = ''.join("- " + l if l.startswith('-') else l for l in text.splitlines(True))
+    return CLEARSIGN_HEADER + escaped + ("" if escaped.endswith("\n") else "\n") + SIGNATURE_ARMOR
+
+def clearsigned_data(text):
+    """ What the signature of the clearsigned text signs: the line break before the signature is not part of it """
+    return text[:-1] if text.endswith("\n") else text
+
+def remove_signatures(distpath):
+    for f in SIGNATURES:
+        if os.path.exists(os.path.join(distpath, f)):
+            os.remove(os.path.join(distpath, f))
+
+def _signed(distpath, text, gpg):
+    """ True when Release.gpg and InRelease, always written together, sign text with the key of gpg """
+    message = clearsigned_text(text)
+    try:
+        with open(os.path.join(distpath, 'Release.gpg'), 'r') as f:
+            signature = f.read()
+
+        with open(os.path.join(distpath, 'InRelease'), 'r') as f:
+            signed = f.read()
+
+    except (OSError, ValueError):
+        return False
+
+    return signed.startswith(message) and all(signature_issuer(s) in gpg.fingerprints for s in
+                                              (signature, SIGNATURE_ARMOR + signed[len(message):]))
+
+@trace.traced("sign")
+def sign_releases(releases):
+    """
+    :Description:
+        Writes Release.gpg and InRelease for the dists/[platform]/Release
+        of every (distpath, GpgSigner) of releases, unless both already
+        sign this Release with that key. All the signatures of one signer
+        are made in a single session (see GpgSigner.sign_all). Returns the
+        distpaths signed.
+    """
+    pending = {}
+    for distpath, gpg in releases:
+        with open(os.path.join(distpath, 'Release'), 'r') as f:
+            text = f.read()
+
+        if not _signed(distpath, text, gpg):
+            pending.setdefault(gpg, []).append((distpath, text))
+
+    signed = []
+    for gpg, items in pending.items():
+        signatures = gpg.sign_all([data.encode('utf-8') for distpath, text in items
+                                   for data in (text, clearsigned_data(text))])
+        for (distpath, text), detached, clearsigned in zip(items, signatures[0::2], signatures[1::2]):
+            snapshot.atomic_write(os.path.join(distpath, 'Release.gpg'), detached)
+            snapshot.atomic_write(os.path.join(distpath, 'InRelease'),
+                                  clearsigned_text(text) + clearsigned[len(SIGNATURE_ARMOR):])
+            trace.count("releases_signed")
+            signed.append(distpath)
+
+    return signed
+
+@trace.traced("release")
+def write_release(distpath, platform, opts, signing=None):
+    """
+    :Description:
+        Writes dists/[platform]/Release with the header taken from the
+        platform configuration and the MD5Sum/SHA1/SHA256 sections for
+        every index file, each hashed once on a thread pool, then signs it
+        when a sign_key is configured: at once, or, given the list signing,
+        later with the other Release files of the publish, by appending the
+        arguments of sign_releases to it. With the by_hash option set, the
+        indexes are published under by-hash/ too.
+    """
+    relfiles = list(index_files(distpath))
+    digests = hash_files([os.path.join(distpath, r) for r in relfiles],
+                         [algo for section, algo in CHECKSUM_SECTIONS])
+    if opts.get('by_hash'):
+        publish_by_hash(distpath, relfiles, digests, opts.get('by_hash_keep', BY_HASH_KEEP))
+
+    date = datetime.datetime.now(datetime.timezone.utc)
+    fields = [("Origin", opts.get('name')),
+              ("Label", opts.get('name')),
+              ("Suite", 'wheezy'),
+              ("Codename", 'wheezy'), # FIXME
+              ("Date", date.strftime("%a, %d %b %Y %H:%M:%S UTC")),
+              ("Architectures", ' '.join([get_arch(a) for a in opts.get('architecture')])),
+              ("Components", ' '.join(opts.get('restrictions'))),
+              ("Description", opts.get('desc'))]
+    if opts.get('by_hash'):
+        fields.append(("Acquire-By-Hash", "yes"))
+
+    # No trailing whitespace: a clearsigned text is signed without it
+    lines = ["{}: {}".format(k, v).rstrip() + "\n" for k, v in fields]
+    for section, algo in CHECKSUM_SECTIONS:
+        lines.append("{}:\n".format(section))
+        for r in relfiles:
+            d = digests[os.path.join(distpath, r)]
+            lines.append(" {} {:>16} {}\n".format(d[algo], d['size'], r))
+
+    try:
+        with open(os.path.join(distpath, 'Release'), 'r') as f:
+            unchanged = [l for l in f if not l.startswith("Date:")] == \
+                [l for l in lines if not l.startswith("Date:")]
+
+    except OSError:
+        unchanged = False
+
+    if not unchanged:
+        snapshot.atomic_write(os.path.join(distpath, 'Release'), ''.join(lines))
+
+    if opts.get('sign_key'):
+        release = (distpath, signer(opts.get('sign_key'), opts.get('gnupghome')))
+        if signing is None:
+            sign_releases([release])
+
+        else:
+            signing.append(release)
+
+    else:
+        remove_signatures(distpath)
@@ -4,10 +4,28 @@ from decimal import *
 
 ARGS_TO_CONF = {"architecture": lambda x: ', '.join(x),
                 "restrictions": lambda x: ', '.join(x),
-                "https": lambda x: "true" if x else "false"}
+                "https": lambda x: "true" if x else "false",
+                "by_hash": lambda x: "true" if x else "false",
+                "by_hash_keep": lambda x: str(x),
+                "compression": lambda x: ', '.join(x),
+                "flat": lambda x: "true" if x else "false",
+                "generations": lambda x: str(x),
+                "pdiffs": lambda x: str(x),
+                "keep_versions": lambda x: str(x),
+                "contents": lambda x: "true" if x else "false",
+                "port": lambda x: str(x)}
 CONF_TO_ARGS = {"architecture": lambda x: [y.strip() for y in x.split(',')],
                 "restrictions": lambda x: [y.strip() for y in x.split(',')],
-                "https": lambda x: True if x.lower() == "true" or x.lower() == "yes" else False}
+                "https": lambda x: True if x.lower() == "true" or x.lower() == "yes" else False,
+                "by_hash": lambda x: True if x.lower() == "true" or x.lower() == "yes" else False,
+                "by_hash_keep": lambda x: int(x),
+                "compression": lambda x: [y.strip() for y in x.split(',') if y.strip()],
+                "flat": lambda x: True if x.lower() == "true" or x.lower() == "yes" else False,
+                "generations": lambda x: int(x),
+                "pdiffs": lambda x: int(x),
+                "keep_versions": lambda x: int(x),
+                "contents": lambda x: True if x.lower() == "true" or x.lower() == "yes" else False,
+                "port": lambda x: int(x)}
 
 SUPPORTED_EXTENSIONS = [".deb", ".ipk"]
 
@@ -93,4 +111,7 @@ def package_space_usage(path, platform):
                 if f[-len(se):len(f)] == se:
                     count += os.path.getsize(os.path.join(root, f))
             
+    return format_size(count)
+
+def format_size(count):
     return "{}K".format(Decimal(count / 1024).quantize(Decimal('0.1'), rounding=ROUND_UP))
\ No newline at end of file
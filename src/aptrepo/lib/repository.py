@@ -0,0 +1,520 @@
+"""
+:Description:
+    The apt-repo actions as an importable API. A Repository is one platform
+    of a repository configuration; its options and its catalog are loaded
+    once and kept for the lifetime of the object, so a script (or
+    'apt-repo --batch') can run any number of actions in one process:
+
+        with Repository("stable", configdir="/etc/apt-repo.d") as repo:
+            repo.add(["build/*.deb"])
+            repo.remove(["oldtool"])
+            print(repo.latest(["mytool"]))
+
+    Methods return plain data (dicts, lists, strings) rather than printing
+    it; failures raise exceptions.
+
+    Changes are published under the repository's publish lock, and
+    concurrent apply() calls from several processes are coalesced into a
+    single publish (see lock).
+"""
+
+import os
+import json
+import shutil
+import socket
+from aptrepo.lib.arch import arch, get_arch, arch_dir
+from aptrepo.lib.catalog import Catalog, lookup
+from aptrepo.lib.lock import PublishLock, PublishQueue
+from aptrepo.lib.release import write_release, sign_releases, RELEASE_OPTIONS
+from aptrepo.lib.repos import write_config_file, load_config_file, SUPPORTED_EXTENSIONS, repo_paths, format_size
+from aptrepo.lib.server import RepositoryServer
+from aptrepo.lib.transaction import Transaction
+from aptrepo.lib.watch import IncomingWatcher
+import aptrepo.lib.snapshot as snapshot
+
+DEFAULT_CONFIGDIR = os.path.join(os.sep, 'etc', 'apt-repo.d')
+
+# Command line arguments that tune one invocation rather than the repository
+INVOCATION_OPTIONS = ["action", "file", "jobs", "quiet", "settle", "debounce", "once", "batch",
+                      "timings", "trace", "dry_run", "no_wait"]
+
+def default_options(directory=None, toplevel=None):
+    return dict(desc="apt-repo generated repository",
+                directory=directory if not directory is None else os.path.abspath(os.getcwd()),
+                name="",
+                email="no-reply@localhost.com",
+                architecture=[arch()],
+                toplevel="debian" if toplevel is None else toplevel,
+                restrictions=['main'],
+                https=False)
+
+def options_from_args(args):
+    """ Repository options given on the command line (argparse namespace) """
+    return {k: v for k, v in vars(args).items()
+            if not k in INVOCATION_OPTIONS and k != 'configdir' and not v is None}
+
+def format_deb_line(ip, platform, restrictions, architectures=[arch()], https=False, port=None):
+    if port and port != (443 if https else 80):
+        ip = "{}:{}".format(ip, port)
+
+    return "deb {} http{}://{}/ {} {}".format("[arch={}]".format(','.join(architectures)),
+                                              "s" if https else "", ip,
+                                              platform, ' '.join(restrictions))
+
+def create_repo_structure(configdir, platform, opts):
+    # Create the configuration directory
+    if not os.path.exists(configdir):
+        print("Creating configuration directory: {}".format(configdir))
+        os.makedirs(configdir, exist_ok=True)
+
+    # Create the configuration file
+    if not os.path.exists(os.path.join(configdir, platform)):
+        write_config_file(configdir, platform, opts)
+
+    # Start Create action process
+    umask = os.umask(0o022)
+    basepath = opts['directory']
+    if not os.path.exists(basepath):
+        os.makedirs(basepath, exist_ok=True)
+
+    # Create pool directories
+    for x in opts['restrictions']:
+        os.makedirs(os.path.join(basepath, opts['toplevel'], 'pool', x),
+                    exist_ok=True)
+
+    webroot = os.path.join(basepath, opts['toplevel'])
+    os.makedirs(os.path.join(webroot, 'dists'), exist_ok=True)
+    # dists/[platform] is published as a new generation, see snapshot
+    basepath = snapshot.stage(webroot, platform)
+
+    for y in opts.get('restrictions'):
+        for z in opts['architecture']:
+            z = get_arch(z)
+            os.makedirs(os.path.join(basepath, y, arch_dir(z)),
+                        exist_ok=True)
+
+            snapshot.atomic_write(os.path.join(basepath, y, arch_dir(z), "Release"),
+                                  "Archive: {}\n".format(platform) +
+                                  "Origin: {}\n".format(opts.get('name')) +
+                                  "Label: {}\n".format(opts.get('name')) +
+                                  "Component: {}\n".format(y) +
+                                  "Architecture: {}\n".format(z))
+
+    # Signed too when the platform has a sign_key, see release
+    write_release(basepath, platform, opts)
+    snapshot.publish(webroot, platform, basepath, opts.get('generations', snapshot.KEEP_GENERATIONS))
+    return webroot
+
+class Repository(object):
+    """
+    :Description:
+        One platform of a repository. options override those of the
+        platform's configuration file in configdir (None values are
+        ignored), as command line options do.
+    """
+
+    def __init__(self, platform, configdir=DEFAULT_CONFIGDIR, **options):
+        self.platform = platform
+        self.configdir = configdir
+        self.overrides = {k: v for k, v in options.items() if not v is None}
+        self._opts = None
+        self._catalog = None
+        self._lock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._catalog is not None:
+            self._catalog.close()
+            self._catalog = None
+
+        self._lock = None
+
+    def configure(self, **options):
+        """ Replaces the overriding options; the catalog stays open unless the repository moved """
+        overrides = {k: v for k, v in options.items() if not v is None}
+        if overrides != self.overrides:
+            if any(overrides.get(k) != self.overrides.get(k) for k in ('directory', 'toplevel')):
+                self.close()
+
+            self.overrides = overrides
+            self._opts = None
+
+    def reload(self):
+        """ Forgets the loaded options and catalog, e.g. after the configuration file changed """
+        self.close()
+        self._opts = None
+
+    @property
+    def configpath(self):
+        return os.path.join(self.configdir, self.platform)
+
+    @property
+    def opts(self):
+        if self._opts is None:
+            self._opts = load_config_file(self.configdir, self.platform)
+            # Written into configuration files by earlier versions; configdir is not an option
+            self._opts.pop('configdir', None)
+            self._opts.update(self.overrides)
+
+        return self._opts
+
+    @property
+    def webroot(self):
+        return os.path.join(self.opts.get('directory'), self.opts.get('toplevel'))
+
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            self._catalog = Catalog(self.webroot)
+            self._catalog.ensure(self.platform)
+
+        return self._catalog
+
+    def create(self):
+        """ Creates the configuration file (unless there is one) and the repository structure """
+        self.close()
+        self._opts = default_options(self.overrides.get('directory'), self.overrides.get('toplevel'))
+        self._opts.update(self.overrides)
+        return create_repo_structure(self.configdir, self.platform, self._opts)
+
+    def update(self):
+        """
+        :Description:
+            Writes the overriding options to the configuration file and
+            applies them. A change to what Release holds or how it is signed
+            is published at once, as a new generation.
+        """
+        if not os.path.exists(self.configpath):
+            raise Exception("Configuration File not Found")
+
+        saved = load_config_file(self.configdir, self.platform)
+        self.reload()
+        if 'directory' in self.overrides:
+            create_repo_structure(self.configdir, self.platform, self.opts)
+
+        # Published first: options that cannot be applied (an unknown key) are not saved
+        if not 'directory' in self.overrides and any(saved.get(k) != self.opts.get(k) for k in RELEASE_OPTIONS):
+            with self.lock:
+                transaction = self.transaction()
+                transaction.republish = True
+                transaction.commit()
+
+        write_config_file(self.configdir, self.platform, self.opts)
+        return self.opts
+
+    def delete(self):
+        """ Removes the repository tree; returns its path """
+        umask = os.umask(0o022)
+        toremove = self.webroot
+        self.close()
+        print("Removing {}".format(toremove))
+        if not os.path.exists(toremove):
+            raise Exception("Error: Failed to remove non-existant directory: {}\n".format(toremove))
+
+        shutil.rmtree(toremove)
+        return toremove
+
+    @property
+    def lock(self):
+        """ The publish lock of the repository, held while anything is published """
+        if self._lock is None:
+            self._lock = PublishLock(self.webroot)
+
+        return self._lock
+
+    @property
+    def queue(self):
+        return PublishQueue(self.webroot)
+
+    def transaction(self, jobs=None):
+        return Transaction(self.catalog, self.platform, self.opts, jobs)
+
+    def apply(self, operations, jobs=None, wait=True):
+        """
+        :Description:
+            Publishes (operation, argument) pairs; returns the regenerated
+            indexes. The operations are queued and published, together with
+            every other queued request, by whichever process holds the
+            publish lock: this one if it is free. With wait (the default) the
+            call returns once they are published, raising their error if
+            they failed; otherwise it returns [] at once when another
+            process is publishing, leaving them queued for it.
+        """
+        request = self.queue.put(self.platform, self.configdir, operations, spool=not wait, wait=wait,
+                                 options=self.queued_options())
+        results = self.publish_queued(jobs, blocking=wait)
+        result = self.queue.result(request) if wait else results.get(request)
+        if result is None:
+            print("A publish is running, queued as {}".format(request))
+            return []
+
+        if result['error']:
+            raise Exception(result['error'])
+
+        return result['indexes']
+
+    def publish_queued(self, jobs=None, blocking=True):
+        """
+        :Description:
+            Takes the publish lock (waiting for it when blocking) and
+            publishes every queued request, one transaction per platform.
+            Returns {request id: result} for the requests published here;
+            {} when blocking is False and another process holds the lock.
+        """
+        results = {}
+        while self.lock.acquire(blocking):
+            try:
+                results.update(self._drain(jobs))
+
+            finally:
+                self.queue.expire()
+                self.lock.release()
+
+            # A request queued while the lock was being released would otherwise wait for the next publish
+            if not self.queue.pending():
+                break
+
+            blocking = False
+
+        return results
+
+    def queued_options(self):
+        """ The overriding options, as they are stored in and read back from the publish queue """
+        return json.loads(json.dumps(self.overrides))
+
+    def _drain(self, jobs=None):
+        results = {}
+        items = self.queue.items()
+        while items:
+            groups = {}
+            for item in items:
+                key = (item['configdir'], item['platform'], json.dumps(item.get('options', {}), sort_keys=True))
+                groups.setdefault(key, []).append(item)
+
+            staged = []
+            signing = []
+            try:
+                # Each request is published with the options it was queued with
+                for (configdir, platform, options), group in sorted(groups.items()):
+                    options = json.loads(options)
+                    repo = self
+                    if (configdir, platform, options) != (self.configdir, self.platform, self.queued_options()):
+                        repo = Repository(platform, configdir, **options)
+
+                    # A platform stages one generation at a time; other options for it wait for the next round
+                    if any((r.webroot, r.platform) == (repo.webroot, platform) for r, g, t, e in staged):
+                        if repo is not self:
+                            repo.close()
+
+                        continue
+
+                    staged.append((repo, group) + repo._stage(group, signing, jobs))
+
+                # The Release files of every platform are signed together
+                failure = None
+                try:
+                    sign_releases(signing)
+
+                except Exception as E:
+                    failure = E
+
+                for repo, group, transaction, errors in staged:
+                    results.update(repo._finish(group, transaction, errors, failure))
+
+            finally:
+                for repo, group, transaction, errors in staged:
+                    if repo is not self:
+                        repo.close()
+
+            items = self.queue.items()
+
+        return results
+
+    def _stage(self, items, signing, jobs=None):
+        """
+        :Description:
+            Applies queued requests of this platform to one transaction and
+            stages it, its Release appended to signing (see
+            Transaction.stage); returns the transaction and {request id:
+            error}. A request is applied whole or not at all: when one of
+            its operations fails, the others are undone and only that
+            request gets the error.
+        """
+        transaction = self.transaction(jobs)
+        errors = {}
+        for item in items:
+            savepoint = transaction.savepoint()
+            try:
+                for op, arg in item['operations']:
+                    if op == "add":
+                        transaction.add_glob(arg)
+
+                    else:
+                        transaction.remove(arg)
+
+            except Exception as E:
+                transaction.rollback_to(savepoint)
+                errors[item['id']] = str(E)
+
+        try:
+            transaction.stage(signing)
+
+        except Exception as E:
+            transaction.abort()
+            for item in items:
+                errors.setdefault(item['id'], str(E))
+
+        return transaction, errors
+
+    def _finish(self, items, transaction, errors, failure=None):
+        """ Publishes a transaction of _stage(), unless signing failed with failure; returns the results of items """
+        indexes = []
+        try:
+            if failure is not None:
+                raise failure
+
+            indexes = transaction.publish()
+
+        except Exception as E:
+            transaction.abort()
+            for item in items:
+                errors.setdefault(item['id'], str(E))
+
+        results = {}
+        for item in items:
+            error = errors.get(item['id'])
+            results[item['id']] = dict(indexes=[] if error else indexes, error=error)
+            self.queue.finish(item, results[item['id']])
+
+        return results
+
+    def add(self, patterns, jobs=None):
+        return self.apply([("add", p) for p in patterns], jobs)
+
+    def remove(self, specs, jobs=None):
+        return self.apply([("remove", s) for s in specs], jobs)
+
+    def prune(self, specs=None, keep=None, dry_run=False, jobs=None):
+        """
+        :Description:
+            Removes all but the keep (by default the keep_versions option)
+            highest versions of every package, per component and
+            architecture, or only of the packages matching specs (see
+            catalog.lookup), as one transaction. Returns a report of the
+            removed entries, the package files no index lists any more and
+            their total bytes, and the regenerated indexes. With dry_run
+            the report is all that is done.
+
+            Files still listed by a generation kept for rollback are deleted
+            once that generation is pruned; 'deleted' lists those gone now.
+        """
+        keep = keep if keep is not None else self.opts.get('keep_versions')
+        if not keep or keep < 1:
+            raise Exception("Usage: apt-repo [platform] prune [package specs] --keep-versions N (N > 0)")
+
+        names = None
+        if specs:
+            names = sorted(set(m['name'] for p in specs for m in lookup(self.catalog, self.platform, p)))
+
+        rows = self.catalog.superseded(self.platform, keep, names)
+        # Pool files are shared by platforms: only those nothing else lists are freed
+        self.catalog.ensure_all()
+        pruned = set((r['idx'], r['filename']) for r in rows)
+        files = {}
+        for r in rows:
+            if not r['filename'] in files and all((x['idx'], x['filename']) in pruned
+                                                  for x in self.catalog.referencing(r['filename'])):
+                files[r['filename']] = r['size']
+
+        report = dict(keep=keep, dry_run=bool(dry_run), files=sorted(files), bytes=sum(files.values()),
+                      removed=[dict(index=r['idx'], name=r['name'], version=r['version'],
+                                    architecture=r['architecture'], filename=r['filename'], size=r['size'])
+                               for r in rows],
+                      indexes=[], deleted=[])
+        if not dry_run and rows:
+            with self.lock:
+                transaction = self.transaction(jobs)
+                transaction.prune(rows)
+                report['indexes'] = transaction.commit()
+
+            report['deleted'] = [f for f in report['files'] if not os.path.exists(os.path.join(self.webroot, f))]
+
+        return report
+
+    def info(self):
+        output = dict(self.opts)
+        output.update(dict(
+            repository=dict(
+                {self.platform: repo_paths(os.path.join(self.webroot, 'dists'), self.platform),
+                 "packages": self.catalog.count(self.platform),
+                 "totalsize": format_size(self.catalog.total_size(self.platform))})))
+        return output
+
+    def rollback(self, generation=None):
+        """ Makes an older generation live (see snapshot.rollback); returns its id and the kept ones """
+        with self.lock:
+            generation = snapshot.rollback(self.webroot, self.platform, generation)
+            self.catalog.rebuild(self.platform)
+
+        return dict(generation=generation, kept=snapshot.generations(self.webroot, self.platform))
+
+    def haspkg(self, specs):
+        """ Basenames of the package files matching any of specs (see catalog.lookup) """
+        found = []
+        for p in specs:
+            for m in lookup(self.catalog, self.platform, p):
+                if not m['basename'] in found:
+                    found.append(m['basename'])
+
+        return found
+
+    def latest(self, specs):
+        """ {name: catalog row of its highest version, or None when not found} """
+        return {p: self.catalog.latest(self.platform, p) for p in specs}
+
+    def deb_line(self, ip=None):
+        """ The sources.list line of the repository """
+        return format_deb_line(ip or socket.gethostbyname(socket.gethostname()),
+                               self.platform, self.opts.get('restrictions'),
+                               self.opts.get('architecture'), https=self.opts.get('https'),
+                               port=self.opts.get('port'))
+
+    def server(self, quiet=False):
+        return RepositoryServer(self.webroot, host=self.opts.get('bind') or "0.0.0.0",
+                                port=self.opts.get('port') or 80, quiet=quiet)
+
+    def watch(self, incoming, settle=2.0, debounce=5.0, once=False, jobs=None):
+        """ Publishes package files dropped into incoming, see watch.IncomingWatcher """
+        if not os.path.isdir(incoming):
+            raise Exception("Usage: apt-repo [platform] watch [incoming directory]")
+
+        def publish_batch(paths):
+            errors = {}
+            # Pool files are placed under the lock too, as other publishes collect unused ones
+            with self.lock:
+                transaction = self.transaction(jobs)
+                for p in paths:
+                    savepoint = transaction.savepoint()
+                    try:
+                        transaction.add(p)
+
+                    except Exception as E:
+                        transaction.rollback_to(savepoint)
+                        errors[p] = str(E)
+
+                try:
+                    transaction.commit()
+
+                except Exception:
+                    transaction.abort()
+                    raise
+
+            return errors
+
+        IncomingWatcher(incoming, publish_batch, SUPPORTED_EXTENSIONS,
+                        settle=settle, debounce=debounce).run(once=once)
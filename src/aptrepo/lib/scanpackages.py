@@ -3,31 +3,262 @@
     Python representation of dpkg-scanpackages program for the generation of
     package lists for the repository. This should be called on every add or
     remove so the user doesn't have to be bothered with dpkg-scanpackages calls.
-    
+
+    Control data is read straight out of each package's ar/tar members and
+    the resulting stanza is cached per index directory, keyed on the file's
+    size, mtime and inode, so a rescan only opens packages that changed.
+
+    An index either lists the package files found in its own directory or,
+    for pool based repositories, an explicit list of files anywhere below
+    the repository root.
+
+    .ipk packages are listed the way opkg-make-index lists them, so the
+    index directory doubles as an opkg feed: opkg fetches Filename relative
+    to the feed, so their Filename is written relative to the index
+    directory (where the transaction links them), with a SHA256sum field,
+    and Packages.stamps records the mtime of each of them.
+
 :Copyright:
     Angry Coders (C) 2015
     Daniel Kettle
     daniel.kettle@angrycoders.com, initial.dann@gmail.com
-   
-   
+
+
 """
 
-from subprocess import PIPE, Popen
 import os
+import json
+import functools
+import threading
+from aptrepo.lib.debfile import read_control, parse_control
+from aptrepo.lib.security import hash_file
+from aptrepo.lib.version import compare_versions
+import aptrepo.lib.compress as compress
+import aptrepo.lib.pdiff as pdiff
+import aptrepo.lib.snapshot as snapshot
+import aptrepo.lib.trace as trace
+
+# [webroot]/.packages-cache/[index].json: out of dists/, which is published
+STANZA_CACHE_DIR = ".packages-cache"
+# Where older versions kept the cache, in the index directory
+LEGACY_STANZA_CACHE = ".Packages.cache"
+
+# Field order used by dpkg-scanpackages; anything not listed goes after these
+FIELD_ORDER = ["Package", "Package-Type", "Source", "Version", "Architecture",
+               "Essential", "Origin", "Bugs", "Maintainer", "Installed-Size",
+               "Provides", "Pre-Depends", "Depends", "Recommends", "Suggests",
+               "Conflicts", "Breaks", "Replaces", "Enhances", "Filename",
+               "Size", "MD5sum", "SHA1", "SHA256", "SHA256sum", "Section", "Priority",
+               "Multi-Arch", "Homepage", "Description"]
+
+PACKAGE_EXTENSIONS = [".deb", ".ipk"]
+FEED_EXTENSIONS = [".ipk"]
+STAMPS = "Packages.stamps"
+
+# Indexes are scanned from worker threads: each progress line is one locked write
+_print_lock = threading.Lock()
+
+def format_stanza(fields):
+    order = {k: i for i, k in enumerate(FIELD_ORDER)}
+    fields = sorted(fields, key=lambda kv: order.get(kv[0], len(FIELD_ORDER)))
+    # Description is always the last field, continuation lines included
+    fields.sort(key=lambda kv: kv[0] == "Description")
+    return ''.join("{}: {}\n".format(k, v) for k, v in fields)
+
+def package_stanza(webroot, path, filename=None):
+    """
+    :Description:
+        Builds the Packages stanza fields for a single package file; Filename
+        is relative to webroot, as apt clients expect, unless given.
+    """
+    fields = [(k, v) for k, v in parse_control(read_control(path))
+              if v and not k in ("Filename", "Size", "MD5sum", "SHA1", "SHA256")]
+    digests = hash_file(path, ["md5", "sha1", "sha256"])
+    fields.extend([("Filename", filename or os.path.relpath(path, webroot)),
+                   ("Size", str(digests['size'])),
+                   ("MD5sum", digests['md5']),
+                   ("SHA1", digests['sha1']),
+                   ("SHA256", digests['sha256'])])
+    return fields
+
+def stanza_cache_path(webroot, index):
+    return os.path.join(webroot, STANZA_CACHE_DIR, index + ".json")
+
+def load_stanza_cache(webroot, index):
+    try:
+        with open(stanza_cache_path(webroot, index), 'r') as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+        return {}
+
+def save_stanza_cache(webroot, index, cache):
+    os.makedirs(os.path.dirname(stanza_cache_path(webroot, index)), exist_ok=True)
+    snapshot.atomic_write(stanza_cache_path(webroot, index), json.dumps(cache))
+
+def scan_packages(webroot, path, files=None, memo=None, locate=None, index=None):
+    """
+    :Description:
+        Returns the Packages stanzas for every package in path, or for the
+        package files in files (relative to webroot) when given. Only
+        packages whose size, mtime or inode changed since the last scan are
+        re-read. memo is an optional dict shared by scans of several
+        indexes, so a pool file listed in many of them is read only once.
+        locate maps a file relative to webroot to where it can be read,
+        when that is not below webroot (a staged generation), and index is
+        then the path of the index below dists/ (relative to webroot).
+    """
+    locate = locate or (lambda f: os.path.join(webroot, f))
+    memo = {} if memo is None else memo
+    index = index or os.path.relpath(path, webroot)
+    if files is None:
+        files = [os.path.relpath(os.path.join(path, f), webroot) for f in os.listdir(path)]
+
+    cache = load_stanza_cache(webroot, index)
+    newcache = {}
+    stanzas = []
+    for f in sorted(set(files)):
+        if not os.path.splitext(f)[1] in PACKAGE_EXTENSIONS:
+            continue
+
+        fullpath = locate(f)
+        st = os.stat(fullpath)
+        key = [st.st_size, st.st_mtime_ns, st.st_ino]
+        entry = cache.get(f)
+        if entry is None or entry['key'] != key:
+            entry = memo.get((f, tuple(key)))
+
+        if entry is None:
+            with _print_lock:
+                print("Scanning {}\n".format(fullpath), end='', flush=True)
+
+            entry = dict(key=key, fields=package_stanza(webroot, fullpath, f))
+
+        memo[(f, tuple(key))] = entry
+
+        newcache[f] = entry
+        stanzas.append([tuple(kv) for kv in entry['fields']])
+
+    save_stanza_cache(webroot, index, newcache)
+    stanzas.sort(key=functools.cmp_to_key(compare_stanzas))
+    return stanzas
+
+def compare_stanzas(a, b):
+    """ Orders stanzas by package name, then by Debian version (see version.compare_versions) """
+    a, b = dict(a), dict(b)
+    if a.get("Package", "") != b.get("Package", ""):
+        return -1 if a.get("Package", "") < b.get("Package", "") else 1
+
+    return compare_versions(a.get("Version", ""), b.get("Version", ""))
+
+def feed_stanza(fields):
+    """ The stanza of an .ipk as written for opkg: Filename relative to the feed, and SHA256sum """
+    filename = dict(fields).get('Filename', '')
+    if not os.path.splitext(filename)[1] in FEED_EXTENSIONS:
+        return fields
+
+    return [(k, os.path.basename(v) if k == 'Filename' else v) for k, v in fields] + \
+        [('SHA256sum', v) for k, v in fields if k == 'SHA256']
+
+def feed_stamps(path, stanzas):
+    """ Packages.stamps of opkg-make-index: "[mtime] [file]" for every .ipk listed in the index directory path """
+    stamps = []
+    for s in stanzas:
+        filename = dict(s).get('Filename', '')
+        if os.path.splitext(filename)[1] in FEED_EXTENSIONS:
+            mtime = os.path.getmtime(os.path.join(path, os.path.basename(filename)))
+            stamps.append("{} {}\n".format(int(mtime), os.path.basename(filename)))
+
+    return ''.join(stamps).encode('utf-8')
+
+def write_packages(path, stanzas, compression=None, pdiffs=0):
+    """
+    :Description:
+        Writes Packages in path, plus one compressed variant per method in
+        compression (gzip and xz when not given), all from the same in-memory
+        index. Variants that are no longer configured are removed so that
+        Release never lists a stale index. With pdiffs set, the patch from
+        the Packages being replaced is added to Packages.diff, which keeps
+        the pdiffs most recent ones (see pdiff). Indexes listing .ipk files
+        also get Packages.stamps.
+    """
+    compression = ['gzip', 'xz'] if compression is None else compression
+    data = ''.join(format_stanza(feed_stanza(s)) + '\n' for s in stanzas).encode('utf-8')
+    outputs = {"Packages": data}
+    stamps = feed_stamps(path, stanzas)
+    if stamps:
+        outputs[STAMPS] = stamps
+
+    for method in compression:
+        if method != 'none':
+            with trace.phase("compression", method=method, index=os.path.basename(path)):
+                outputs["Packages" + compress.extension(method)] = compress.compress_bytes(data, method)
+
+    if pdiffs:
+        with trace.phase("pdiff", index=os.path.basename(path)):
+            try:
+                with open(os.path.join(path, "Packages"), 'rb') as f:
+                    old = f.read()
+
+            except OSError:
+                old = None
+
+            pdiff.update(path, old, data, pdiffs)
+
+    else:
+        pdiff.remove(path)
+
+    for name, content in outputs.items():
+        snapshot.atomic_write(os.path.join(path, name), content)
+
+    compressed = ["Packages" + compress.extension(method) for method in compress.METHODS]
+    for stale in compressed + [STAMPS, LEGACY_STANZA_CACHE]:
+        if not stale in outputs and os.path.exists(os.path.join(path, stale)):
+            os.remove(os.path.join(path, stale))
+
+def read_packages(path, index=None):
+    """
+    :Description:
+        Parses the Packages file in path back into stanzas; [] when there is
+        none. With index, the index directory relative to the repository
+        root, the Filename of .ipk entries is made relative to the root
+        again, as scan_packages() returns it.
+    """
+    try:
+        with open(os.path.join(path, "Packages"), 'r', encoding='utf-8') as f:
+            text = f.read()
+
+    except OSError:
+        return []
+
+    stanzas = [parse_control(block) for block in text.split("\n\n") if block.strip()]
+    if index is not None:
+        stanzas = [[(k, os.path.join(index, v) if k == 'Filename' and not os.sep in v else v)
+                    for k, v in s if k != 'SHA256sum'] for s in stanzas]
+
+    return stanzas
+
+def Packages_gz(webroot, path, compression=None, catalog=None, files=None):
+    """
+    :Description:
+        Regenerates the Packages files of the index directory path (relative
+        to webroot), from the packages in it or from files (relative to
+        webroot) when given, and records the index in catalog if given.
+    """
+    stanzas = regenerate(webroot, path, compression, files)
+    print("Wrote {} entries to {}".format(len(stanzas), os.path.join(webroot, path, "Packages")))
+    if catalog is not None:
+        catalog.replace_index(os.path.relpath(os.path.join(webroot, path), webroot), stanzas)
+
+    return 0
 
-def Packages_gz(webroot, path):
-    os.chdir(webroot)
-    relpath = os.path.relpath(path)
-    # dpkg-scanpackages [repo w/o directory + toplevel] [/dev/null] > [repo w/o directory + toplevel]/Packages.gz
-    cmd = "dpkg-scanpackages {} /dev/null | gzip -9c > {}/Packages.gz".format(
-        relpath, relpath)
-    print(cmd)
-    proc = Popen(cmd, shell=True)
-    proc.communicate()
-    cmd = "dpkg-scanpackages {} /dev/null > {}/Packages".format(
-        relpath, relpath)
-    print(cmd)
-    proc = Popen(cmd, shell=True)
-    proc.communicate()
-    return proc.returncode
+def regenerate(webroot, path, compression=None, files=None, memo=None, locate=None, pdiffs=0, index=None):
+    """ Scans and rewrites the Packages files of one index directory; returns its stanzas """
+    path = os.path.join(webroot, path)
+    index = index or os.path.relpath(path, webroot)
+    os.makedirs(path, exist_ok=True)
+    with trace.phase("index_scan", index=index):
+        stanzas = scan_packages(webroot, path, files, memo, locate, index)
 
+    write_packages(path, stanzas, compression, pdiffs)
+    return stanzas
@@ -1,22 +1,330 @@
 from subprocess import PIPE, Popen
 import os
+import time
+import base64
 import hashlib
+import threading
+import aptrepo.lib.trace as trace
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_ALGORITHMS = ["md5", "sha1", "sha256", "sha512"]
+CHUNK_SIZE = 1024 * 1024
+
+# OpenPGP public key algorithm -> the values of the sig-val gpg-agent returns, in packet order
+AGENT_SIGNATURES = {1: [b's'], 22: [b'r', b's']}
+# SHA256, as both OpenPGP and libgcrypt number it
+DIGEST_SHA256 = 8
+
+def hash_file(path, algorithms=HASH_ALGORITHMS):
+    """
+    :Description:
+        Streams the file at path once in CHUNK_SIZE blocks and returns a dict
+        with its size and the hex digest for every requested algorithm.
+    """
+    hashes = [hashlib.new(a) for a in algorithms]
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    size = 0
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+
+            size += n
+            for h in hashes:
+                h.update(view[:n])
+
+    result = {a: h.hexdigest() for a, h in zip(algorithms, hashes)}
+    result['size'] = size
+    trace.count("bytes_hashed", size)
+    return result
+
+def hash_bytes(data, algorithms=HASH_ALGORITHMS):
+    """ hash_file() for data already in memory """
+    result = {a: hashlib.new(a, data).hexdigest() for a in algorithms}
+    result['size'] = len(data)
+    trace.count("bytes_hashed", len(data))
+    return result
+
+def hash_files(paths, algorithms=HASH_ALGORITHMS, workers=None):
+    """
+    :Description:
+        Hashes many files concurrently on a thread pool (hashlib releases the
+        GIL on large updates). Returns a dict of path to hash_file() result.
+    """
+    paths = list(paths)
+    if len(paths) < 2:
+        return {p: hash_file(p, algorithms) for p in paths}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(paths, pool.map(lambda p: hash_file(p, algorithms), paths)))
 
 def md5sum_file(path, filename):
     f = os.path.join(path, filename)
     if not os.path.exists(f):
         raise Exception("Attempted to generate hash of file {}, file not found".format(f))
-    
-    md5 = hashlib.md5()
-    with open(f, 'r') as openf:
-        md5.update(openf.read().encode("utf-8")) # FIXME: Read in at 128 bytes so we don't overload on huge files
-    
-    filesize = os.path.getsize(f)
+
+    digests = hash_file(f, ["md5"])
     # format and return it
-    # FIXME: we may need to buffer and right-align the filesize for readability and standization
-    return " {}\t{} {}".format(md5.hexdigest(), filesize, filename) 
+    return " {} {:>16} {}".format(digests['md5'], digests['size'], filename)
 
 def gen_gpg_key():
+    trace.count("subprocesses")
     proc = Popen(["gpg", "--gen-key", "--batch"])
     proc.communicate()
-    return proc.returncode
\ No newline at end of file
+    return proc.returncode
+
+def signature_issuer(armored):
+    """
+    :Description:
+        Returns the issuer fingerprint (upper case hex) recorded in the
+        hashed subpackets of an ASCII armored OpenPGP v4 signature, as gpg
+        writes it, or None when there is none.
+    """
+    lines = armored.strip().split('\n')
+    if not '' in lines:
+        return None
+
+    data = base64.b64decode(''.join(l for l in lines[lines.index('') + 1:]
+                                    if not l.startswith('=') and not l.startswith('-----')))
+    if not data:
+        return None
+
+    if data[0] & 0x40:
+        start = 2 if data[1] < 192 else 3 if data[1] < 224 else 6
+    else:
+        start = 1 + [1, 2, 4, 0][data[0] & 0x03]
+
+    packet = data[start:]
+    if len(packet) < 6 or packet[0] != 4:
+        return None
+
+    subpackets = packet[6:6 + int.from_bytes(packet[4:6], 'big')]
+    i = 0
+    while i < len(subpackets):
+        n = subpackets[i]
+        if n < 192:
+            length, i = n, i + 1
+        elif n < 255:
+            length, i = ((n - 192) << 8) + subpackets[i + 1] + 192, i + 2
+        else:
+            length, i = int.from_bytes(subpackets[i + 1:i + 5], 'big'), i + 5
+
+        # Issuer Fingerprint: key version, then the fingerprint
+        if length and subpackets[i] & 0x7f == 33:
+            return subpackets[i + 2:i + length].hex().upper()
+
+        i += length
+
+    return None
+
+def _subpacket(kind, data):
+    return bytes([len(data) + 1, kind]) + data
+
+def _mpi(value):
+    value = value.lstrip(b'\0')
+    bits = (len(value) - 1) * 8 + value[0].bit_length() if value else 0
+    return bits.to_bytes(2, 'big') + value
+
+def _packet(tag, body):
+    """ A new format OpenPGP packet """
+    n = len(body)
+    if n < 192:
+        length = bytes([n])
+    elif n < 8384:
+        length = bytes([((n - 192) >> 8) + 192, (n - 192) & 0xff])
+    else:
+        length = b'\xff' + n.to_bytes(4, 'big')
+
+    return bytes([0xc0 | tag]) + length + body
+
+def _crc24(data):
+    crc = 0xb704ce
+    for b in data:
+        crc ^= b << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864cfb
+
+    return crc & 0xffffff
+
+def armor_signature(packet):
+    """ ASCII armor of an OpenPGP signature packet, as gpg --armor writes it """
+    encoded = base64.b64encode(packet).decode('ascii')
+    return "-----BEGIN PGP SIGNATURE-----\n\n{}\n={}\n-----END PGP SIGNATURE-----\n".format(
+        '\n'.join(encoded[i:i + 64] for i in range(0, len(encoded), 64)),
+        base64.b64encode(_crc24(packet).to_bytes(3, 'big')).decode('ascii'))
+
+def parse_sexp(data, i=0):
+    """ Parses the canonical S-expression at data[i:] into nested lists of bytes; returns it and where it ends """
+    if data[i:i + 1] == b'(':
+        items, i = [], i + 1
+        while data[i:i + 1] != b')':
+            item, i = parse_sexp(data, i)
+            items.append(item)
+
+        return items, i + 1
+
+    colon = data.index(b':', i)
+    end = colon + 1 + int(data[i:colon])
+    return data[colon + 1:end], end
+
+def _unescape(line):
+    """ The data of an Assuan D line: %XX escapes decoded """
+    out, i = bytearray(), 0
+    while i < len(line):
+        if line[i:i + 1] == b'%':
+            out.append(int(line[i + 1:i + 3], 16))
+            i += 3
+
+        else:
+            out.append(line[i])
+            i += 1
+
+    return bytes(out)
+
+class GpgSigner(object):
+    """
+    :Description:
+        Signs with the secret key key of the keyring in gnupghome (the
+        user's default keyring when None). The key is looked up once; the
+        signatures themselves are OpenPGP packets built here around what
+        the keyring's gpg-agent signs, so any number of texts are signed in
+        one gpg-connect-agent session instead of one gpg run each (keys of
+        other types than RSA and EdDSA are signed by gpg). Use signer() to
+        share one instance per keyring and key.
+    """
+
+    def __init__(self, key, gnupghome=None):
+        self.key = key
+        self.env = dict(os.environ)
+        if gnupghome:
+            self.env['GNUPGHOME'] = os.path.abspath(gnupghome)
+
+        self._keys = None
+        self._lock = threading.Lock()
+
+    def _run(self, args, data=None):
+        trace.count("subprocesses")
+        proc = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, env=self.env)
+        out, err = proc.communicate(data)
+        if proc.returncode != 0:
+            raise Exception("{} failed: {}".format(' '.join(args[:2]), err.decode('utf-8', 'replace').strip()))
+
+        return out
+
+    @property
+    def keys(self):
+        """
+        :Description:
+            The signing key and its subkeys, primary first, as dicts of
+            fpr, grip, algo (OpenPGP number), created and sign (True when
+            it is a valid signing key); looked up once.
+        """
+        with self._lock:
+            if self._keys is None:
+                out = self._run(["gpg", "--batch", "--with-colons", "--with-keygrip",
+                                 "--list-secret-keys", "--", self.key])
+                keys = []
+                for fields in [l.split(':') for l in out.decode('utf-8').splitlines()]:
+                    if fields[0] in ('sec', 'ssb'):
+                        if fields[0] == 'sec' and keys:
+                            break
+
+                        keys.append(dict(algo=int(fields[3]), created=int(fields[5]),
+                                         sign='s' in fields[11] and not fields[1] in ('e', 'r', 'd', 'i')))
+
+                    elif fields[0] in ('fpr', 'grp') and keys:
+                        keys[-1].setdefault('fpr' if fields[0] == 'fpr' else 'grip', fields[9])
+
+                if not keys:
+                    raise Exception("No secret key {} in the gpg keyring".format(self.key))
+
+                self._keys = keys
+
+        return self._keys
+
+    @property
+    def fingerprints(self):
+        """ Fingerprints of the signing key and its subkeys (any may sign), primary first """
+        return [k['fpr'] for k in self.keys]
+
+    def signing_key(self):
+        """ The key gpg signs with: the newest signing subkey, else the primary key """
+        usable = [k for k in self.keys[1:] if k['sign']] or [k for k in self.keys[:1] if k['sign']]
+        if not usable:
+            raise Exception("Key {} cannot sign".format(self.key))
+
+        return max(usable, key=lambda k: k['created'])
+
+    def sign(self, data):
+        """
+        :Description:
+            Returns an ASCII armored, detached, text mode SHA256 signature
+            of data (bytes), see sign_all().
+        """
+        return self.sign_all([data])[0]
+
+    def sign_all(self, texts):
+        """
+        :Description:
+            Returns an ASCII armored, detached, text mode SHA256 signature
+            for each of texts (bytes), all made in one gpg-agent session.
+        """
+        key = self.signing_key()
+        if not key['algo'] in AGENT_SIGNATURES:
+            return [self._run(["gpg", "--batch", "--yes", "--armor", "--textmode", "--digest-algo", "SHA256",
+                               "--local-user", self.fingerprints[0], "--detach-sign"], data).decode('ascii')
+                    for data in texts]
+
+        created = int(time.time())
+        hashed = _subpacket(2, created.to_bytes(4, 'big')) + _subpacket(33, b'\x04' + bytes.fromhex(key['fpr']))
+        # Version 4, signature of a canonical text document
+        head = bytes([4, 0x01, key['algo'], DIGEST_SHA256]) + len(hashed).to_bytes(2, 'big') + hashed
+        digests = [hashlib.sha256(data.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n') + head +
+                                  b'\x04\xff' + len(head).to_bytes(4, 'big')).digest() for data in texts]
+        commands = []
+        for digest in digests:
+            commands += ["SIGKEY {}".format(key['grip']), "SETHASH {} {}".format(DIGEST_SHA256, digest.hex()),
+                         "PKSIGN"]
+
+        results = self._agent(commands)[2::3]
+        unhashed = _subpacket(16, bytes.fromhex(key['fpr'][-16:]))
+        signatures = []
+        for digest, result in zip(digests, results):
+            sigval = dict((p[0], p[1]) for p in parse_sexp(result)[0][1][1:] if isinstance(p, list))
+            body = head + len(unhashed).to_bytes(2, 'big') + unhashed + digest[:2] + \
+                b''.join(_mpi(sigval[v]) for v in AGENT_SIGNATURES[key['algo']])
+            signatures.append(armor_signature(_packet(2, body)))
+
+        trace.count("signatures", len(signatures))
+        return signatures
+
+    def _agent(self, commands):
+        """ Runs the Assuan commands in one gpg-connect-agent session; returns the data each returned """
+        out = self._run(["gpg-connect-agent"], ''.join(c + "\n" for c in commands + ["/bye"]).encode('ascii'))
+        results, data = [], b''
+        for line in out.split(b'\n'):
+            if line.startswith(b'D '):
+                data += _unescape(line[2:])
+
+            elif line == b'OK' or line.startswith(b'OK '):
+                results.append(data)
+                data = b''
+
+            elif line.startswith(b'ERR '):
+                raise Exception("gpg-agent failed: {}".format(line[4:].decode('utf-8', 'replace')))
+
+        if len(results) < len(commands):
+            raise Exception("gpg-agent answered {} of {} commands".format(len(results), len(commands)))
+
+        return results
+
+# (key, gnupghome) -> GpgSigner, for the lifetime of the process
+_SIGNERS = {}
+
+def signer(key, gnupghome=None):
+    """ The shared GpgSigner of key in gnupghome """
+    return _SIGNERS.setdefault((key, gnupghome), GpgSigner(key, gnupghome))
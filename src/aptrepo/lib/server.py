@@ -0,0 +1,325 @@
+"""
+:Description:
+    Static HTTP/1.1 server for a repository, so build farms and test rigs
+    can point apt at apt-repo directly instead of setting up nginx or
+    apache. A single asyncio process serves [directory]/[toplevel]:
+
+    o GET and HEAD, with keep-alive and pipelined requests
+    o zero-copy file bodies through loop.sendfile() (os.sendfile)
+    o single byte ranges (206/416), so interrupted downloads resume
+    o ETag and Last-Modified, with 304 answers to If-None-Match and
+      If-Modified-Since. Index files get the SHA256 listed in the live
+      Release file as their ETag, everything else a stat based one.
+    o precompressed variants: a client accepting gzip that asks for
+      Packages gets Packages.gz with Content-Encoding: gzip
+
+    Hidden files and folders (the catalog, .generations) and paths leading
+    out of the webroot are never served: they answer 404, as a missing
+    file does, so their existence is not given away. dists/[platform] is
+    reached through its generation symlink.
+"""
+
+import os
+import sys
+import asyncio
+import datetime
+import mimetypes
+import email.utils
+from urllib.parse import unquote, urlsplit
+
+SERVER_NAME = "apt-repo"
+KEEPALIVE_TIMEOUT = 60
+MAX_HEADER_SIZE = 16 * 1024
+
+MIME_TYPES = {".deb": "application/vnd.debian.binary-package",
+              ".ipk": "application/octet-stream",
+              ".gpg": "application/pgp-signature",
+              ".xz": "application/x-xz",
+              ".gz": "application/gzip"}
+
+REASONS = {200: "OK", 206: "Partial Content", 304: "Not Modified",
+           400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 416: "Range Not Satisfiable",
+           500: "Internal Server Error"}
+
+def content_type(path):
+    ext = os.path.splitext(path)[1]
+    if ext in MIME_TYPES:
+        return MIME_TYPES[ext]
+
+    if os.path.basename(path) in ("Packages", "Release", "InRelease", "Index", "Sources"):
+        return "text/plain; charset=utf-8"
+
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+def parse_range(header, size):
+    """
+    :Description:
+        Parses a Range header against a file of size bytes. Returns
+        (start, end) inclusive, None to serve the whole file (no header,
+        other units or several ranges) or False when unsatisfiable.
+    """
+    if not header or not header.startswith("bytes=") or ',' in header:
+        return None
+
+    first, _, last = header[len("bytes="):].strip().partition('-')
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0:
+                return False
+
+            return max(size - length, 0), size - 1
+
+        start = int(first)
+        end = int(last) if last else size - 1
+
+    except ValueError:
+        return None
+
+    if start >= size or end < start:
+        return False
+
+    return start, min(end, size - 1)
+
+def http_date(timestamp):
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+class ReleaseHashes(object):
+    """ SHA256 of every index file of each platform, as listed by its live Release """
+
+    def __init__(self, webroot):
+        self.webroot = webroot
+        self.cache = {}
+
+    def lookup(self, relpath):
+        parts = relpath.split('/')
+        if len(parts) < 3 or parts[0] != 'dists':
+            return None
+
+        distpath = os.path.join(self.webroot, 'dists', parts[1])
+        release = os.path.join(distpath, 'Release')
+        try:
+            st = os.stat(release)
+
+        except OSError:
+            return None
+
+        key = (os.path.realpath(distpath), st.st_mtime_ns, st.st_size)
+        if self.cache.get(parts[1], (None,))[0] != key:
+            hashes = {}
+            section = None
+            with open(release, 'r') as f:
+                for line in f:
+                    if not line.startswith(' '):
+                        section = line.split(':', 1)[0]
+
+                    elif section == "SHA256":
+                        digest, size, name = line.split()
+                        hashes[name] = digest
+
+            self.cache[parts[1]] = (key, hashes)
+
+        return self.cache[parts[1]][1].get('/'.join(parts[2:]))
+
+class RepositoryServer(object):
+    """
+    :Description:
+        Serves the repository rooted at webroot. Use serve_forever() or
+        start() / close() from a running event loop.
+    """
+
+    def __init__(self, webroot, host="0.0.0.0", port=80, quiet=False):
+        self.webroot = os.path.abspath(webroot)
+        self.realroot = os.path.realpath(webroot)
+        self.host = host
+        self.port = port
+        self.quiet = quiet
+        self.hashes = ReleaseHashes(self.webroot)
+        self.server = None
+
+    def resolve(self, target):
+        """ Maps a request target to (file path, path relative to webroot), or None """
+        relpath = unquote(urlsplit(target).path).lstrip('/')
+        parts = [p for p in relpath.split('/') if p]
+        if any(p.startswith('.') or '\0' in p for p in parts):
+            return None
+
+        path = os.path.join(self.webroot, *parts)
+        real = os.path.realpath(path)
+        if real != self.realroot and not real.startswith(os.path.join(self.realroot, '')):
+            return None
+
+        return path, '/'.join(parts)
+
+    def etag(self, relpath, st):
+        digest = self.hashes.lookup(relpath)
+        if digest is not None:
+            return '"{}"'.format(digest)
+
+        return '"{:x}-{:x}-{:x}"'.format(st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def log(self, peer, method, target, status, size):
+        if not self.quiet:
+            sys.stdout.write('{} - - [{}] "{} {}" {} {}\n'.format(
+                peer[0] if peer else '-',
+                datetime.datetime.now(datetime.timezone.utc).strftime("%d/%b/%Y:%H:%M:%S +0000"),
+                method, target, status, size))
+
+    async def send_headers(self, writer, version, status, headers):
+        lines = ["{} {} {}".format(version, status, REASONS.get(status, ""))]
+        lines.extend("{}: {}".format(k, v) for k, v in headers)
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+        await writer.drain()
+
+    async def send_error(self, writer, version, status, keepalive, extra=()):
+        body = "{} {}\n".format(status, REASONS.get(status, "")).encode('utf-8')
+        headers = [("Server", SERVER_NAME), ("Date", http_date(None)),
+                   ("Content-Type", "text/plain; charset=utf-8"),
+                   ("Content-Length", len(body)),
+                   ("Connection", "keep-alive" if keepalive else "close")]
+        await self.send_headers(writer, version, status, list(headers) + list(extra))
+        writer.write(body)
+        await writer.drain()
+        return len(body)
+
+    async def respond(self, writer, method, target, version, headers, keepalive):
+        """ Answers one request; returns (status, body bytes sent) """
+        if not method in ("GET", "HEAD"):
+            return 405, await self.send_error(writer, version, 405, keepalive, [("Allow", "GET, HEAD")])
+
+        resolved = self.resolve(target)
+        if resolved is None:
+            return 404, await self.send_error(writer, version, 404, keepalive)
+
+        path, relpath = resolved
+        encoding = None
+        if 'gzip' in headers.get('accept-encoding', '') and os.path.isfile(path + ".gz") \
+                and not path.endswith(".gz"):
+            path, encoding = path + ".gz", "gzip"
+
+        try:
+            f = open(path, 'rb')
+
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return 404, await self.send_error(writer, version, 404, keepalive)
+
+        except PermissionError:
+            return 403, await self.send_error(writer, version, 403, keepalive)
+
+        with f:
+            st = os.fstat(f.fileno())
+            etag = self.etag(relpath + (".gz" if encoding else ""), st)
+            common = [("Server", SERVER_NAME), ("Date", http_date(None)),
+                      ("Last-Modified", http_date(st.st_mtime)), ("ETag", etag),
+                      ("Accept-Ranges", "bytes"),
+                      ("Connection", "keep-alive" if keepalive else "close")]
+            if encoding:
+                common.extend([("Content-Encoding", encoding), ("Vary", "Accept-Encoding")])
+
+            inm = headers.get('if-none-match')
+            ims = headers.get('if-modified-since')
+            if inm is not None:
+                not_modified = etag in [t.strip() for t in inm.split(',')] or inm.strip() == '*'
+
+            elif ims is not None:
+                try:
+                    not_modified = int(st.st_mtime) <= email.utils.parsedate_to_datetime(ims).timestamp()
+
+                except (TypeError, ValueError):
+                    not_modified = False
+
+            else:
+                not_modified = False
+
+            if not_modified:
+                await self.send_headers(writer, version, 304, common)
+                return 304, 0
+
+            byterange = parse_range(headers.get('range'), st.st_size)
+            if byterange is False:
+                return 416, await self.send_error(writer, version, 416, keepalive,
+                                                  [("Content-Range", "bytes */{}".format(st.st_size))])
+
+            status, start, count = 200, 0, st.st_size
+            extra = []
+            if byterange is not None and headers.get('if-range', etag) in (etag, http_date(st.st_mtime)):
+                status, start, count = 206, byterange[0], byterange[1] - byterange[0] + 1
+                extra.append(("Content-Range", "bytes {}-{}/{}".format(byterange[0], byterange[1], st.st_size)))
+
+            await self.send_headers(writer, version, status, common + extra + [
+                ("Content-Type", content_type(relpath)), ("Content-Length", count)])
+            if method == "HEAD" or not count:
+                return status, 0
+
+            loop = asyncio.get_running_loop()
+            await loop.sendfile(writer.transport, f, start, count)
+            return status, count
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+
+                except asyncio.LimitOverrunError:
+                    await self.send_error(writer, "HTTP/1.1", 400, False)
+                    return
+
+                lines = request.decode('latin-1').split("\r\n")
+                try:
+                    method, target, version = lines[0].split()
+
+                except ValueError:
+                    await self.send_error(writer, "HTTP/1.1", 400, False)
+                    return
+
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        k, v = line.split(':', 1)
+                        headers[k.strip().lower()] = v.strip()
+
+                connection = headers.get('connection', '').lower()
+                keepalive = (version == "HTTP/1.1" and connection != "close") or \
+                            (version == "HTTP/1.0" and connection == "keep-alive")
+                try:
+                    status, size = await self.respond(writer, method, target, version, headers, keepalive)
+
+                except ConnectionError:
+                    return
+
+                self.log(peer, method, target, status, size)
+                if not keepalive:
+                    return
+
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port,
+                                                 limit=MAX_HEADER_SIZE, reuse_address=True)
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def _serve(self):
+        server = await self.start()
+        for s in server.sockets:
+            print("Serving {} on http://{}:{}/".format(self.webroot, *s.getsockname()[:2]))
+
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self._serve())
+
+        except KeyboardInterrupt:
+            pass
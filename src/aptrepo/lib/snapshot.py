@@ -0,0 +1,233 @@
+"""
+:Description:
+    Atomic publishing of dists/[platform]. Every publish builds a complete
+    new generation of the platform's indexes in a staging directory and
+    makes it live by swapping the dists/[platform] symlink with a single
+    rename(2), so clients only ever see one consistent set of Packages and
+    Release files, never a half written one.
+
+    Generations live in [webroot]/.generations/[platform]/[id]. A new
+    generation starts as a hardlink copy of the live one, which is why
+    everything writing below dists/ replaces files (write a temporary file,
+    then os.replace) rather than rewriting them in place. The previous
+    generations are kept for instant rollback.
+"""
+
+import os
+import shutil
+import aptrepo.lib.scanpackages as scanpackages
+
+GENERATIONS_DIR = ".generations"
+STAGING_SUFFIX = ".staging"
+KEEP_GENERATIONS = 3
+
+def atomic_write(path, data):
+    """
+    :Description:
+        Replaces the file at path with data: bytes, text, or a function
+        writing to the open (binary) file. The new content is written to
+        path.tmp and renamed over path, so a copy hardlinked into another
+        generation keeps its own content.
+    """
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            if callable(data):
+                data(f)
+
+            else:
+                f.write(data.encode('utf-8') if isinstance(data, str) else data)
+
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+        raise
+
+    os.replace(tmp, path)
+
+def generations_path(webroot, platform):
+    return os.path.join(webroot, GENERATIONS_DIR, platform)
+
+def live_path(webroot, platform):
+    return os.path.join(webroot, 'dists', platform)
+
+def generations(webroot, platform):
+    """ Ids of the published generations of platform, oldest first """
+    path = generations_path(webroot, platform)
+    if not os.path.isdir(path):
+        return []
+
+    return sorted(g for g in os.listdir(path) if g.isdigit())
+
+def current_generation(webroot, platform):
+    """ Id of the live generation, or None when dists/[platform] is not a generation """
+    link = live_path(webroot, platform)
+    if not os.path.islink(link):
+        return None
+
+    return os.path.basename(os.readlink(link).rstrip(os.sep))
+
+def _swap(webroot, platform, generation):
+    """ Points dists/[platform] at generation in one atomic rename """
+    link = live_path(webroot, platform)
+    tmp = os.path.join(os.path.dirname(link), ".{}.new".format(platform))
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+
+    os.symlink(os.path.relpath(os.path.join(generations_path(webroot, platform), generation),
+                               os.path.dirname(link)), tmp)
+    os.replace(tmp, link)
+
+def migrate(webroot, platform):
+    """
+    :Description:
+        Turns a plain dists/[platform] directory, as written by older
+        versions, into generation 000000. This is the only step that is not
+        atomic: the directory is renamed away just before the symlink takes
+        its place.
+    """
+    link = live_path(webroot, platform)
+    if os.path.isdir(link) and not os.path.islink(link):
+        os.makedirs(generations_path(webroot, platform), exist_ok=True)
+        os.rename(link, os.path.join(generations_path(webroot, platform), "000000"))
+        _swap(webroot, platform, "000000")
+
+def _link_tree(src, dst):
+    """ Copies the tree src to dst as hardlinks (copies across filesystems) """
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for f in files:
+            s = os.path.join(root, f)
+            if os.path.islink(s):
+                os.symlink(os.readlink(s), os.path.join(target, f))
+                continue
+
+            try:
+                os.link(s, os.path.join(target, f))
+
+            except OSError:
+                shutil.copy2(s, os.path.join(target, f))
+
+def stage(webroot, platform):
+    """
+    :Description:
+        Returns the path of a new staging generation holding a copy of the
+        live one (empty for a new platform). Write into it, then publish()
+        it or remove it with discard().
+    """
+    migrate(webroot, platform)
+    path = generations_path(webroot, platform)
+    os.makedirs(path, exist_ok=True)
+    for g in os.listdir(path):
+        # Left behind by a publish that never finished
+        if g.endswith(STAGING_SUFFIX):
+            shutil.rmtree(os.path.join(path, g))
+
+    existing = generations(webroot, platform)
+    staged = os.path.join(path, "{:06d}{}".format(int(existing[-1]) + 1 if existing else 0,
+                                                 STAGING_SUFFIX))
+    current = current_generation(webroot, platform)
+    if current is not None:
+        _link_tree(os.path.join(path, current), staged)
+
+    else:
+        os.makedirs(staged)
+
+    return staged
+
+def discard(staged):
+    shutil.rmtree(staged, ignore_errors=True)
+
+def locator(webroot, platform, staged):
+    """
+    :Description:
+        Returns a function mapping paths relative to webroot to the file
+        system: paths below dists/[platform] land in the staging generation,
+        anything else (the pool) in webroot.
+    """
+    prefix = os.path.join('dists', platform, '')
+
+    def locate(relpath):
+        if relpath.startswith(prefix):
+            return os.path.join(staged, relpath[len(prefix):])
+
+        return os.path.join(webroot, relpath)
+
+    return locate
+
+def generation_files(path):
+    """ Every Filename listed by the indexes of the generation at path """
+    filenames = set()
+    for root, dirs, files in os.walk(path):
+        if "Packages" in files:
+            filenames.update(dict(s).get('Filename') for s in scanpackages.read_packages(root))
+
+    filenames.discard(None)
+    return filenames
+
+def retained_files(webroot):
+    """ Every Filename listed by any kept generation of any platform """
+    filenames = set()
+    top = os.path.join(webroot, GENERATIONS_DIR)
+    if os.path.isdir(top):
+        for platform in os.listdir(top):
+            for g in generations(webroot, platform):
+                filenames |= generation_files(os.path.join(top, platform, g))
+
+    return filenames
+
+def prune(webroot, platform, keep=KEEP_GENERATIONS):
+    """
+    :Description:
+        Removes all but the live generation and the keep most recent other
+        ones. Returns the Filenames the removed generations listed, so pool
+        files only they referred to can be collected.
+    """
+    current = current_generation(webroot, platform)
+    old = [g for g in generations(webroot, platform) if g != current]
+    filenames = set()
+    for g in old[:max(len(old) - keep, 0)]:
+        path = os.path.join(generations_path(webroot, platform), g)
+        filenames |= generation_files(path)
+        shutil.rmtree(path)
+
+    return filenames
+
+def publish(webroot, platform, staged, keep=KEEP_GENERATIONS):
+    """
+    :Description:
+        Makes the staging generation live and prunes old generations.
+        Returns the new generation id and the Filenames listed by pruned
+        generations.
+    """
+    generation = os.path.basename(staged)[:-len(STAGING_SUFFIX)]
+    os.rename(staged, os.path.join(generations_path(webroot, platform), generation))
+    _swap(webroot, platform, generation)
+    print("Published generation {} of {}".format(generation, platform))
+    return generation, prune(webroot, platform, keep)
+
+def rollback(webroot, platform, generation=None):
+    """
+    :Description:
+        Makes an older generation live again: the given one, or the one
+        published before the live generation. Newer generations are kept,
+        so a rollback can itself be undone. Returns the generation id.
+    """
+    kept = generations(webroot, platform)
+    current = current_generation(webroot, platform)
+    if generation is None:
+        older = [g for g in kept if current is None or g < current]
+        if not older:
+            raise Exception("No generation of {} to roll back to".format(platform))
+
+        generation = older[-1]
+
+    generation = "{:06d}".format(int(generation))
+    if not generation in kept:
+        raise Exception("Generation {} of {} not found (kept: {})".format(
+            generation, platform, ', '.join(kept)))
+
+    _swap(webroot, platform, generation)
+    return generation
@@ -0,0 +1,178 @@
+"""
+:Description:
+    Opt-in phase timing and I/O counters for builds and publishes, behind the
+    --timings and --trace options of apt-pkg and apt-repo.
+
+    Code marks its phases with 'with trace.phase("archive"):' and counts work
+    with trace.count("bytes_hashed", n); both return at once while tracing
+    is off. Once enable()d, the tracer records every phase (wall time,
+    process and thread) and the counters, and can print a summary
+    or write a Chrome trace file (chrome://tracing, Perfetto) that also
+    holds the phase totals and counters under "otherData".
+
+    Build phases: stage (payload copy and manifest), exclude (non-deployable
+    pruning, within stage), size, control, archive (dpkg-deb, the native
+    writer or the ipk tars). Publish phases: stage_generation, index_scan,
+    compression, pdiff, contents, release, sign (within release), publish,
+    catalog, collect. Counters: files_walked, files_excluded, bytes_copied,
+    bytes_hashed, subprocesses, packages_listed, releases_signed. Nested phases
+    are included in their parent's time.
+"""
+
+import os
+import sys
+import json
+import time
+import functools
+import threading
+import contextlib
+
+_tracer = None
+
+class Tracer(object):
+    """ Phase events and counters of one process; safe to use from several threads """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        # (name, start seconds, duration seconds, pid, thread id, args)
+        self.events = []
+        self.counters = {}
+
+    def add_event(self, name, start, duration, args=None):
+        with self.lock:
+            self.events.append((name, start - self.start, duration, os.getpid(),
+                                threading.get_ident(), args or {}))
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def mark(self):
+        """ A position to take since() from """
+        with self.lock:
+            return len(self.events), dict(self.counters)
+
+    def since(self, mark):
+        """ The events and counter increments recorded after mark, for merge() in another process """
+        with self.lock:
+            events = [list(e[:5]) + [e[5]] for e in self.events[mark[0]:]]
+            counters = {k: v - mark[1].get(k, 0) for k, v in self.counters.items() if v != mark[1].get(k, 0)}
+
+        # Absolute times, as the two tracers started at different moments
+        for e in events:
+            e[1] += self.start
+
+        return dict(events=events, counters=counters)
+
+    def merge(self, data):
+        """ Adds what since() returned in a worker process """
+        with self.lock:
+            for name, start, duration, pid, tid, args in data.get('events', []):
+                self.events.append((name, start - self.start, duration, pid, tid, args))
+
+            for k, v in data.get('counters', {}).items():
+                self.counters[k] = self.counters.get(k, 0) + v
+
+    def totals(self):
+        """ {phase: {"seconds": total wall time, "calls": count}}, slowest first """
+        totals = {}
+        with self.lock:
+            for name, start, duration, pid, tid, args in self.events:
+                t = totals.setdefault(name, dict(seconds=0.0, calls=0))
+                t['seconds'] += duration
+                t['calls'] += 1
+
+        return dict(sorted(((k, dict(seconds=round(v['seconds'], 6), calls=v['calls']))
+                            for k, v in totals.items()), key=lambda kv: -kv[1]['seconds']))
+
+    def summary(self, stream=sys.stderr):
+        elapsed = time.perf_counter() - self.start
+        stream.write("\nTimings ({:.3f}s elapsed):\n".format(elapsed))
+        stream.write("  {:<16} {:>10} {:>7}\n".format("phase", "seconds", "calls"))
+        for name, t in self.totals().items():
+            stream.write("  {:<16} {:>10.4f} {:>7}\n".format(name, t['seconds'], t['calls']))
+
+        if self.counters:
+            stream.write("  {:<16} {:>10}\n".format("counter", "value"))
+            for name, value in sorted(self.counters.items()):
+                stream.write("  {:<16} {:>10}\n".format(name, value))
+
+    def chrome_trace(self):
+        """ The Chrome trace event format document of everything recorded """
+        with self.lock:
+            events = [dict(name=name, cat="apt-repo", ph="X", ts=round(start * 1e6, 3),
+                           dur=round(duration * 1e6, 3), pid=pid, tid=tid, args=args)
+                      for name, start, duration, pid, tid, args in self.events]
+            counters = dict(self.counters)
+
+        end = round((time.perf_counter() - self.start) * 1e6, 3)
+        if counters:
+            events.append(dict(name="counters", ph="C", ts=end, pid=os.getpid(), tid=0, args=counters))
+
+        return dict(traceEvents=events, displayTimeUnit="ms",
+                    otherData=dict(phases=self.totals(), counters=counters))
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f, indent=1)
+
+def enable():
+    """ Starts recording (again, from scratch); returns the Tracer """
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+def disable():
+    global _tracer
+    _tracer = None
+
+def enabled():
+    return _tracer is not None
+
+def current():
+    return _tracer
+
+@contextlib.contextmanager
+def phase(name, **args):
+    """ Times the enclosed block as phase name when tracing is enabled """
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+
+    finally:
+        tracer.add_event(name, start, time.perf_counter() - start, args)
+
+def traced(name):
+    """ Decorator timing every call of the function as phase name """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+def count(name, n=1):
+    tracer = _tracer
+    if tracer is not None:
+        tracer.count(name, n)
+
+def report(timings=False, path=None, stream=sys.stderr):
+    """ Prints the summary and/or writes the trace file, as asked by --timings and --trace """
+    if _tracer is None:
+        return
+
+    if timings:
+        _tracer.summary(stream)
+
+    if path:
+        _tracer.write(path)
+        stream.write("Trace written to {}\n".format(path))
@@ -0,0 +1,394 @@
+"""
+:Description:
+    Batched changes to a repository platform. Any number of packages are
+    added to and removed from a Transaction; until commit() only new files
+    are written to the pool (a published pool file is never replaced, see
+    pool.place), and commit() works out the set of (component, architecture)
+    indexes that actually changed and regenerates each of them exactly once,
+    in parallel, before writing the platform Release file once. All of that
+    happens in a staged generation of dists/[platform] that is published
+    atomically (see snapshot).
+
+    Operation lists (for 'apt-repo [platform] apply', --file and stdin) hold
+    one operation per line: "add [glob]", "remove [spec]", or a bare
+    argument that gets the default operation. Blank lines and lines starting
+    with "#" are ignored.
+"""
+
+import os
+import sys
+import glob
+import functools
+import aptrepo.lib.contents as contents
+import aptrepo.lib.snapshot as snapshot
+import aptrepo.lib.trace as trace
+from concurrent.futures import ThreadPoolExecutor
+from aptrepo.lib.arch import arch_dir
+from aptrepo.lib.catalog import lookup, spec_matches, split_index_path
+from aptrepo.lib.debfile import read_control, parse_control
+from aptrepo.lib.pool import package_filename, pool_path, arch_matches, place, link_or_copy, collect, is_used
+from aptrepo.lib.release import write_release, sign_releases
+from aptrepo.lib.repos import SUPPORTED_EXTENSIONS
+from aptrepo.lib.scanpackages import regenerate, read_packages, FEED_EXTENSIONS
+from aptrepo.lib.security import hash_file
+from aptrepo.lib.version import compare_versions
+
+OPERATIONS = ["add", "remove"]
+
+def parse_operations(lines, default=None):
+    """ Yields (operation, argument) for every line of an operation list """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        op, _, arg = line.partition(' ')
+        if op in OPERATIONS and arg.strip():
+            yield op, arg.strip()
+
+        elif default is not None:
+            yield default, line
+
+        else:
+            raise Exception("Invalid operation: '{}' (use {} [argument])".format(
+                line, ' or '.join(OPERATIONS)))
+
+def read_operations(path, default=None):
+    """ parse_operations() for the file at path, or stdin when path is "-" """
+    if path == '-':
+        return list(parse_operations(sys.stdin, default))
+
+    with open(path, 'r') as f:
+        return list(parse_operations(f, default))
+
+class Transaction(object):
+    """
+    :Description:
+        Pending changes to platform in the repository of catalog. Members of
+        every touched index are kept as {(name, version, arch): filename}.
+    """
+
+    def __init__(self, catalog, platform, opts, jobs=None):
+        self.catalog = catalog
+        self.webroot = catalog.webroot
+        self.platform = platform
+        self.opts = opts
+        self.jobs = jobs
+        self.members = {}
+        self.original = {}
+        # Files to delete when no index refers to them after commit
+        self.candidates = set()
+        # sha256 -> file placed by this transaction
+        self.known = {}
+        # Pool files written by this transaction, in order
+        self.placed = []
+        # (pool file, path below dists/) hardlinks to create in the new generation
+        self.links = []
+        # Publish a new generation even when no index changed, for the Release options
+        self.republish = False
+        # (generation, dirty indexes, their stanzas) staged by stage(), for publish()
+        self.staged = None
+        catalog.ensure(platform)
+
+    def _members(self, index):
+        if not index in self.members:
+            self.members[index] = {(m['name'], m['version'], m['architecture']): m['filename']
+                                   for m in self.catalog.members(index)}
+            self.original[index] = dict(self.members[index])
+
+        return self.members[index]
+
+    def savepoint(self):
+        """ The pending changes so far, to go back to with rollback_to() """
+        return ({i: dict(m) for i, m in self.members.items()}, set(self.candidates),
+                dict(self.known), list(self.links), len(self.placed))
+
+    def rollback_to(self, savepoint):
+        """
+        :Description:
+            Drops every change made since savepoint was taken. Files placed
+            in the pool since then are deleted at commit unless something
+            lists them.
+        """
+        members, candidates, known, links, placed = savepoint
+        for index in list(self.members):
+            if index in members:
+                self.members[index] = members[index]
+
+            else:
+                del self.members[index]
+                del self.original[index]
+
+        self.candidates = candidates | set(self.placed[placed:])
+        self.placed = self.placed[:placed]
+        self.known = known
+        self.links = links
+
+    def abort(self):
+        """ Drops every pending change, e.g. after commit() failed; deletes the pool files nothing lists """
+        if self.staged is not None:
+            snapshot.discard(self.staged[0])
+            self.staged = None
+
+        for f in collect(self.webroot, self.catalog, self.candidates | set(self.placed),
+                         snapshot.retained_files(self.webroot)):
+            print("Deleted {}".format(f))
+
+        self.members = {}
+        self.original = {}
+        self.candidates = set()
+        self.known = {}
+        self.placed = []
+        self.links = []
+        self.republish = False
+
+    def add_glob(self, pattern):
+        """ add() for every package file matching pattern; returns how many matched """
+        matched = [g for g in sorted(glob.glob(pattern)) if os.path.splitext(g)[1] in SUPPORTED_EXTENSIONS]
+        if not matched:
+            sys.stderr.write("No package file matched: {}\n".format(pattern))
+
+        for g in matched:
+            self.add(g)
+
+        return len(matched)
+
+    def add(self, path):
+        """ Stores the package file at path in the pool and lists it in every matching index """
+        ext = os.path.splitext(path)[1]
+        fields = dict(parse_control(read_control(path)))
+        name, filename = fields['Package'], package_filename(fields, ext)
+        sha256 = hash_file(path, ["sha256"])['sha256']
+        for r in self.opts['restrictions']:
+            stored = pool_path(r, name, filename)
+            if place(self.webroot, path, stored, sha256, self.catalog, self.known, self._in_use):
+                self.placed.append(stored)
+                print("Stored {} as {}".format(path, stored))
+
+            for a in self.opts['architecture']:
+                if not arch_matches(fields, a):
+                    continue
+
+                index = os.path.join('dists', self.platform, r, arch_dir(a))
+                target = stored
+                # ipk feeds are read from the architecture directories
+                if self.opts.get('flat') or ext in FEED_EXTENSIONS:
+                    target = os.path.join(index, filename)
+                    self.links.append((stored, target))
+
+                members = self._members(index)
+                key = (fields['Package'], fields['Version'], fields.get('Architecture', 'all'))
+                if members.get(key, target) != target:
+                    self.candidates.add(members[key])
+
+                members[key] = target
+
+    def _in_use(self, filename):
+        """ True when a published index, a generation kept for rollback or this transaction lists filename """
+        self.catalog.ensure_all()
+        return (filename in self.placed or is_used(self.catalog, filename) or
+                filename in snapshot.retained_files(self.webroot))
+
+    def remove(self, spec):
+        """
+        :Description:
+            Unlists every package matching spec (see catalog.lookup), both
+            those already published and those added earlier in this
+            transaction. Returns the number of entries removed.
+        """
+        removed = 0
+        for m in lookup(self.catalog, self.platform, spec):
+            key = (m['name'], m['version'], m['architecture'])
+            if self._members(m['idx']).get(key) == m['filename']:
+                self._unlist(m['idx'], key)
+                removed += 1
+
+        for index, members in self.members.items():
+            for key, filename in list(members.items()):
+                if spec_matches(spec, key[0], key[1], os.path.basename(filename)):
+                    del members[key]
+                    removed += 1
+                    print("Removing {} from {}".format(filename, index))
+                    self.candidates.add(filename)
+
+        if not removed:
+            sys.stderr.write("No package matched for removal: {}\n".format(spec))
+
+        return removed
+
+    def _unlist(self, index, key):
+        """ Drops key from index; its file is deleted at commit if nothing else lists it """
+        filename = self._members(index).pop(key)
+        print("Removing {} from {}".format(filename, index))
+        self.candidates.add(filename)
+        # Flat layout files are hardlinks of a pool copy
+        self.candidates.add(pool_path(split_index_path(index)[1], key[0], os.path.basename(filename)))
+        return filename
+
+    def retain(self, keep, indexes=None):
+        """
+        :Description:
+            Unlists all but the keep highest versions (in Debian version
+            order) of every package and architecture in each of indexes (by
+            default every index this transaction touched). Returns the
+            (index, (name, version, arch), filename) entries removed.
+        """
+        removed = []
+        newest_first = functools.cmp_to_key(lambda a, b: compare_versions(b[1], a[1]))
+        for index in sorted(self.members if indexes is None else indexes):
+            groups = {}
+            for key in self._members(index):
+                groups.setdefault((key[0], key[2]), []).append(key)
+
+            for keys in groups.values():
+                for key in sorted(keys, key=newest_first)[keep:]:
+                    removed.append((index, key, self._unlist(index, key)))
+
+        return removed
+
+    def prune(self, rows):
+        """ Unlists the published packages of catalog rows (see Catalog.superseded); returns how many were """
+        removed = 0
+        for m in rows:
+            key = (m['name'], m['version'], m['architecture'])
+            if self._members(m['idx']).get(key) == m['filename']:
+                self._unlist(m['idx'], key)
+                removed += 1
+
+        return removed
+
+    def dirty(self):
+        """ Indexes whose package list changed, in path order """
+        return sorted(i for i in self.members if self.members[i] != self.original[i])
+
+    def commit(self):
+        """
+        :Description:
+            Stages a new generation of dists/[platform] in which every dirty
+            index is regenerated once, on a pool of jobs threads (scanning
+            and compression mostly run outside the GIL), and Release is
+            rewritten (with the contents option, the Contents-[arch] files
+            of their components too); then publishes it, records the indexes in the catalog
+            and deletes pool files nothing refers to any more. Returns the
+            regenerated indexes. With the keep_versions option set, indexes
+            that are given new versions first keep only the keep_versions
+            highest of each package (see retain).
+
+            This is stage(), the signing of Release and publish(); a publish
+            of several platforms calls those itself to sign all their
+            Release files together.
+        """
+        signing = []
+        self.stage(signing)
+        try:
+            sign_releases(signing)
+
+        except Exception:
+            self.abort()
+            raise
+
+        return self.publish()
+
+    def stage(self, signing=None):
+        """
+        :Description:
+            The first half of commit(): stages the new generation, leaving
+            its Release to be signed (see release.write_release) and the
+            generation to be published by publish(). Returns the indexes
+            to regenerate; nothing is staged when there are none.
+        """
+        # The retention policy of the platform, for the indexes getting new versions
+        if self.opts.get('keep_versions'):
+            self.retain(self.opts['keep_versions'],
+                        [i for i in self.members if set(self.members[i]) - set(self.original[i])])
+
+        dirty = self.dirty()
+        if not dirty and not self.links and not self.republish:
+            # Pool files of rolled back operations may still be left over
+            for f in collect(self.webroot, self.catalog, self.candidates, snapshot.retained_files(self.webroot)):
+                print("Deleted {}".format(f))
+
+            self.candidates = set()
+            self.placed = []
+            return dirty
+
+        with trace.phase("stage_generation", platform=self.platform):
+            staged = snapshot.stage(self.webroot, self.platform)
+
+        locate = snapshot.locator(self.webroot, self.platform, staged)
+        try:
+            for stored, target in self.links:
+                os.makedirs(os.path.dirname(locate(target)), exist_ok=True)
+                link_or_copy(os.path.join(self.webroot, stored), locate(target))
+                print("Linked {} to {}".format(stored, target))
+
+            # Unlisted flat layout files go with the old generation
+            for f in self.candidates:
+                if locate(f).startswith(os.path.join(staged, '')) and os.path.exists(locate(f)):
+                    os.remove(locate(f))
+
+            memo = {}
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                futures = [(index, pool.submit(regenerate, self.webroot, locate(index),
+                                               self.opts.get('compression'),
+                                               list(self._members(index).values()), memo, locate,
+                                               self.opts.get('pdiffs', 0), index))
+                           for index in dirty]
+                results = [(index, future.result()) for index, future in futures]
+                listed = dict(results)
+                if self.opts.get('contents'):
+                    # Indexes published before contents were turned on get theirs too
+                    for index in self.catalog.indexes(self.platform):
+                        if not index in listed and not os.path.exists(os.path.join(
+                                os.path.dirname(locate(index)), contents.contents_name(split_index_path(index)[2]))):
+                            listed[index] = read_packages(locate(index), index)
+
+                    for future in [pool.submit(contents.write_contents, self.webroot, os.path.dirname(locate(index)),
+                                               split_index_path(index)[2], stanzas, locate)
+                                   for index, stanzas in sorted(listed.items())]:
+                        future.result()
+
+                else:
+                    for index in listed:
+                        contents.remove(os.path.dirname(locate(index)), split_index_path(index)[2])
+
+            write_release(staged, self.platform, self.opts, signing)
+
+        except Exception:
+            snapshot.discard(staged)
+            raise
+
+        self.staged = (staged, dirty, results)
+        return dirty
+
+    def publish(self):
+        """ The second half of commit(): publishes the staged generation; returns its regenerated indexes """
+        if self.staged is None:
+            return []
+
+        staged, dirty, results = self.staged
+        self.staged = None
+        with trace.phase("publish", platform=self.platform):
+            generation, pruned = snapshot.publish(self.webroot, self.platform, staged,
+                                                  self.opts.get('generations', snapshot.KEEP_GENERATIONS))
+
+        # The catalog connection belongs to this thread
+        with trace.phase("catalog", platform=self.platform):
+            for index, stanzas in results:
+                print("Wrote {} entries to {}".format(len(stanzas), os.path.join(self.webroot, index, "Packages")))
+                self.catalog.replace_index(index, stanzas)
+
+        with trace.phase("collect", platform=self.platform):
+            for f in collect(self.webroot, self.catalog, self.candidates | pruned,
+                             snapshot.retained_files(self.webroot)):
+                print("Deleted {}".format(f))
+
+            if self.opts.get('contents'):
+                contents.prune_cache(self.webroot, self.catalog.sha256s())
+
+        self.original = {i: dict(m) for i, m in self.members.items()}
+        self.candidates = set()
+        self.placed = []
+        self.links = []
+        self.republish = False
+        return dirty
@@ -0,0 +1,77 @@
+"""
+:Description:
+    Python representation of dpkg's version comparison, so packages can be
+    ordered by version without calling dpkg --compare-versions.
+
+    A version is [epoch:]upstream_version[-debian_revision]. Epochs compare
+    numerically; the other parts are compared as alternating runs of
+    non-digits (letters sort before other characters, "~" before anything,
+    even the end of the string) and digits (compared numerically).
+"""
+
+def parse_version(version):
+    """ Splits a version into (epoch, upstream, revision) """
+    version = version.strip()
+    epoch = 0
+    if ':' in version:
+        e, version = version.split(':', 1)
+        epoch = int(e) if e else 0
+
+    upstream, sep, revision = version.rpartition('-')
+    if not sep:
+        upstream, revision = revision, ""
+
+    return epoch, upstream, revision
+
+def _order(c):
+    if c == '~':
+        return -1
+
+    if not c or c.isdigit():
+        return 0
+
+    if c.isalpha():
+        return ord(c)
+
+    return ord(c) + 256
+
+def _compare_part(a, b):
+    ia = ib = 0
+    while ia < len(a) or ib < len(b):
+        while (ia < len(a) and not a[ia].isdigit()) or (ib < len(b) and not b[ib].isdigit()):
+            ac = _order(a[ia] if ia < len(a) else '')
+            bc = _order(b[ib] if ib < len(b) else '')
+            if ac != bc:
+                return ac - bc
+
+            ia += 1
+            ib += 1
+
+        da = ia
+        while ia < len(a) and a[ia].isdigit():
+            ia += 1
+
+        db = ib
+        while ib < len(b) and b[ib].isdigit():
+            ib += 1
+
+        na = int(a[da:ia] or 0)
+        nb = int(b[db:ib] or 0)
+        if na != nb:
+            return na - nb
+
+    return 0
+
+def compare_versions(a, b):
+    """ Returns a negative number, 0 or a positive number as version a is lower, equal or higher than b """
+    ea, ua, ra = parse_version(a)
+    eb, ub, rb = parse_version(b)
+    if ea != eb:
+        return ea - eb
+
+    return _compare_part(ua, ub) or _compare_part(ra, rb)
+
+def collate_versions(a, b):
+    """ compare_versions() normalized to -1, 0, 1 for use as an SQLite collation """
+    c = compare_versions(a, b)
+    return (c > 0) - (c < 0)
@@ -0,0 +1,216 @@
+"""
+:Description:
+    Incoming directory watcher for 'apt-repo [platform] watch [incoming]'.
+
+    New or changed package files dropped into the incoming directory are
+    published in batches: a file is taken once its size and mtime have not
+    changed for the settle time (so half uploaded files are left alone),
+    and a batch is applied once no file has changed for the debounce time
+    (or max_delay after its first file was ready), so a burst of uploads
+    costs one index regeneration. Applied files are moved to processed/,
+    rejected ones to failed/ next to a .error file saying why.
+
+    On Linux the directory is watched with inotify (through ctypes, so no
+    extra module is needed); elsewhere, or when inotify is not available,
+    it is polled with one scandir() per interval.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import ctypes
+import ctypes.util
+import datetime
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+PROCESSED_DIR = "processed"
+FAILED_DIR = "failed"
+
+class InotifyWaiter(object):
+    """ Blocks until something changes in path, or the timeout passes """
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), INOTIFY_MASK) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, "inotify_add_watch failed for {}".format(path))
+
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+
+        # Only the wake up matters; the directory is rescanned either way
+        try:
+            while os.read(self.fd, 65536):
+                pass
+
+        except OSError as E:
+            if E.errno != errno.EAGAIN:
+                raise
+
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+class PollWaiter(object):
+    """ Polling stand-in for InotifyWaiter """
+
+    def __init__(self, path, interval=2.0):
+        self.interval = interval
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval) if timeout is not None else self.interval)
+        return True
+
+    def close(self):
+        pass
+
+def open_waiter(path, interval=2.0):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWaiter(path)
+
+        except (OSError, AttributeError) as E:
+            sys.stderr.write("inotify unavailable ({}), polling every {}s\n".format(E, interval))
+
+    return PollWaiter(path, interval)
+
+def move_aside(path, folder, error=None):
+    """ Moves path into folder (next to it), with a .error file when error is given """
+    os.makedirs(folder, exist_ok=True)
+    target = os.path.join(folder, os.path.basename(path))
+    if os.path.exists(target):
+        target = "{}.{}".format(target, datetime.datetime.now().strftime("%Y%m%d%H%M%S%f"))
+
+    os.replace(path, target)
+    if error is not None:
+        with open(target + ".error", 'w') as f:
+            f.write("{}\n".format(error))
+
+    return target
+
+class IncomingWatcher(object):
+    """
+    :Description:
+        Watches incoming for files with one of extensions. apply_batch is
+        called with a list of ready paths and returns {path: error} for the
+        files it rejected (an exception rejects the whole batch).
+    """
+
+    def __init__(self, incoming, apply_batch, extensions, settle=2.0, debounce=5.0,
+                 max_delay=60.0, interval=2.0):
+        self.incoming = os.path.abspath(incoming)
+        self.apply_batch = apply_batch
+        self.extensions = extensions
+        self.settle = settle
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.interval = interval
+        # path -> ((size, mtime_ns), time of the last change)
+        self.pending = {}
+        self.last_change = 0
+        self.batch_started = None
+
+    def scan(self):
+        """ {path: (size, mtime_ns)} of the candidate files in incoming """
+        found = {}
+        for entry in os.scandir(self.incoming):
+            # Dotfiles are the temporary names of uploads in progress (rsync, scp -p)
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+
+            if os.path.splitext(entry.name)[1] in self.extensions:
+                st = entry.stat()
+                found[entry.path] = (st.st_size, st.st_mtime_ns)
+
+        return found
+
+    def update(self, now):
+        found = self.scan()
+        for path, key in found.items():
+            if not path in self.pending or self.pending[path][0] != key:
+                self.pending[path] = (key, now)
+                self.last_change = now
+
+        for path in list(self.pending):
+            if not path in found:
+                del self.pending[path]
+
+    def ready(self, now):
+        return sorted(p for p, (key, changed) in self.pending.items() if now - changed >= self.settle)
+
+    def process(self, paths):
+        print("Publishing {} file(s) from {}".format(len(paths), self.incoming))
+        try:
+            errors = self.apply_batch(paths) or {}
+
+        except Exception as E:
+            errors = {p: "batch failed: {}".format(E) for p in paths}
+
+        for p in paths:
+            self.pending.pop(p, None)
+            if p in errors:
+                sys.stderr.write("Rejected {}: {}\n".format(p, errors[p]))
+                move_aside(p, os.path.join(self.incoming, FAILED_DIR), errors[p])
+
+            elif os.path.exists(p):
+                move_aside(p, os.path.join(self.incoming, PROCESSED_DIR))
+
+    def step(self, now):
+        """ One scan; applies a batch when it is due. Returns True when one was applied """
+        self.update(now)
+        ready = self.ready(now)
+        if not ready:
+            self.batch_started = None
+            return False
+
+        if self.batch_started is None:
+            self.batch_started = now
+
+        if now - self.last_change >= self.debounce or now - self.batch_started >= self.max_delay:
+            self.batch_started = None
+            self.process(ready)
+            return True
+
+        return False
+
+    def run(self, once=False):
+        """ Watches until interrupted; with once, publishes what is there now and returns """
+        if once:
+            self.update(time.monotonic())
+            paths = sorted(self.pending)
+            if paths:
+                self.process(paths)
+
+            return
+
+        waiter = open_waiter(self.incoming, self.interval)
+        print("Watching {} for {}".format(self.incoming, ', '.join(self.extensions)))
+        try:
+            while True:
+                self.step(time.monotonic())
+                # Pending files need timely rechecks, an idle directory only events
+                waiter.wait(min(self.interval, self.settle, self.debounce) / 2 if self.pending else 60)
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            waiter.close()
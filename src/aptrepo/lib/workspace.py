@@ -0,0 +1,398 @@
+"""
+:Description:
+    Operations over a workspace: a directory holding many package folders,
+    each with its own package database ([directory]/[pkgname]/[pkgname]).
+
+    PackageWorkspace holds the apt-pkg actions as an importable API; the
+    package databases it loads stay loaded while their files are unchanged,
+    so scripts (and 'apt-pkg --batch') can run many actions in one process.
+"""
+
+import os
+import sys
+import json
+import stat
+import shutil
+import socket
+import contextlib
+import configparser
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import aptrepo.lib.db
+import aptrepo.lib.buildcache
+import aptrepo.lib.trace as trace
+from aptrepo.lib.arch import arch
+
+DEBIAN_FILES = ['postinst', 'postrm', 'preinst', 'prerm', 'control']
+
+WORKSPACE_CACHE = ".apt-pkg.cache"
+
+def is_package_db(path):
+    try:
+        config = aptrepo.lib.db.load_config(path)
+
+    except (configparser.Error, UnicodeDecodeError):
+        return False
+
+    return config is not None and 'Package' in config.sections()
+
+def _read_cache(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+        return {}
+
+def _write_cache(path, cache):
+    try:
+        with open(path + ".tmp", 'w') as f:
+            json.dump(cache, f)
+
+        os.replace(path + ".tmp", path)
+
+    except OSError as E:
+        sys.stderr.write("Warning: could not write workspace cache {}: {}\n".format(path, E))
+
+def load_workspace(directory, names=None, use_cache=True):
+    """
+    :Description:
+        Returns {pkgname: PackageDB} for every package database in directory
+        (or only those in names). Parsed databases are kept in
+        [directory]/.apt-pkg.cache, keyed on the mtime and size of each
+        database file, so only databases changed since the last load are
+        parsed again; folders that hold no package database are remembered
+        as well.
+    """
+    cachepath = os.path.join(directory, WORKSPACE_CACHE)
+    cache = _read_cache(cachepath) if use_cache else {}
+    fresh = {}
+    dbs = {}
+    for name in sorted(os.listdir(directory)) if names is None else names:
+        dbpath = os.path.join(directory, name, name)
+        try:
+            st = os.stat(dbpath)
+
+        except OSError:
+            continue
+
+        key = [st.st_mtime_ns, st.st_size]
+        entry = cache.get(name)
+        if entry is None or entry.get('key') != key:
+            entry = dict(key=key, db=None)
+            if stat.S_ISREG(st.st_mode) and is_package_db(dbpath):
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    entry['db'] = aptrepo.lib.db.PackageDB(directory, name).db
+
+        fresh[name] = entry
+        if entry['db'] is not None:
+            dbs[name] = aptrepo.lib.db.PackageDB.from_dict(name, entry['db'])
+
+    if use_cache and names is None and fresh != cache:
+        _write_cache(cachepath, fresh)
+
+    return dbs
+
+def select_packages(dbs, **criteria):
+    """
+    :Description:
+        Names of the databases of dbs (as returned by load_workspace) whose
+        fields match all criteria, e.g. section="utils" or
+        depends="python3": list fields match when they contain the value.
+    """
+    selected = []
+    for name, db in sorted(dbs.items()):
+        fields = {}
+        for section in db.SECTIONS:
+            fields.update(db.db.get(section, {}))
+
+        if all(v in fields.get(k, []) if isinstance(fields.get(k), list) else fields.get(k) == v
+               for k, v in criteria.items()):
+            selected.append(name)
+
+    return selected
+
+def update_packages(dbs, names=None, **kwargs):
+    """ Applies PackageDB.update(**kwargs) to dbs (or only names) and writes them; returns the names """
+    names = sorted(dbs) if names is None else list(names)
+    for name in names:
+        dbs[name].update(**kwargs)
+        dbs[name].write()
+
+    return names
+
+def find_packages(directory):
+    """ Yields the name of every package database found under directory """
+    for name in load_workspace(directory):
+        yield name
+
+def build_one(directory, pkgname, force=False, traced=False):
+    """
+    :Description:
+        Builds a single package; returns its result summary dict. With
+        traced, it holds what the build recorded under 'trace', for the
+        parent process to merge when this ran in a worker.
+    """
+    result = dict(package=pkgname, retcodes=[], ok=False, error=None)
+    if traced and not trace.enabled():
+        trace.enable()
+
+    mark = trace.current().mark() if traced else None
+    try:
+        db = aptrepo.lib.db.PackageDB(directory, pkgname)
+        if not db.validate():
+            result['error'] = "not a debian package directory"
+            return result
+
+        result['retcodes'] = aptrepo.lib.buildcache.cached_build_package(directory, pkgname,
+                                                                         force=force, **db.db)
+        result['ok'] = bool(result['retcodes']) and all(r == 0 for r in result['retcodes'])
+        if not result['ok']:
+            result['error'] = "build returned {}".format(result['retcodes'])
+
+    except Exception as E:
+        traceback.print_exc()
+        result['error'] = str(E)
+
+    if traced:
+        result['trace'] = trace.current().since(mark)
+
+    return result
+
+def build_workspace(directory, names=None, jobs=None, force=False):
+    """
+    :Description:
+        Builds every package of the workspace (or only those in names) on a
+        pool of jobs processes. Returns one result dict per package, in
+        package name order.
+    """
+    names = list(find_packages(directory)) if not names else list(names)
+    if jobs == 1 or len(names) < 2:
+        return [build_one(directory, n, force) for n in names]
+
+    traced = trace.enabled()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(build_one, [directory] * len(names), names, [force] * len(names),
+                                [traced] * len(names)))
+
+    # Phases of the worker processes go into this process' trace
+    for r in results:
+        if 'trace' in r:
+            trace.current().merge(r.pop('trace'))
+
+    return results
+
+def print_build_summary(results, stream=sys.stdout):
+    stream.write("\nBuild summary:\n")
+    for r in results:
+        if r['ok']:
+            stream.write("  {}: ok\n".format(r['package']))
+
+        else:
+            stream.write("  {}: FAILED ({})\n".format(r['package'], r['error']))
+
+    failed = len([r for r in results if not r['ok']])
+    stream.write("{} built, {} failed\n".format(len(results) - failed, failed))
+
+class PackageError(Exception):
+    """ A failed package action; code is the exit status apt-pkg reports for it """
+
+    def __init__(self, message, code=1):
+        Exception.__init__(self, message)
+        self.code = code
+
+class PackageWorkspace(object):
+    """
+    :Description:
+        The apt-pkg actions over the packages of directory. Methods return
+        plain data and raise PackageError on failure.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        # pkgname -> ((mtime_ns, size) of its database file, PackageDB)
+        self.dbs = {}
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _key(self, name):
+        try:
+            st = os.stat(os.path.join(self.directory, name, name))
+            return (st.st_mtime_ns, st.st_size)
+
+        except OSError:
+            return None
+
+    def db(self, name):
+        """ The PackageDB of name, loaded on first use and again only when its file changed """
+        cached = self.dbs.get(name)
+        if cached is None or cached[0] != self._key(name):
+            cached = (self._key(name), aptrepo.lib.db.load_package_db(self.directory, name,
+                                                                      directory=self.directory))
+            self.dbs[name] = cached
+
+        return cached[1]
+
+    def _write(self, name, db):
+        db.write()
+        self.dbs[name] = (self._key(name), db)
+
+    def _package(self, name):
+        db = self.db(name)
+        if not os.path.isdir(self.path(name)) or not db.validate():
+            raise PackageError("Not a recognized debian package directory: {}".format(name), 6)
+
+        return db
+
+    def names(self):
+        return list(find_packages(self.directory))
+
+    def create(self, name, **fields):
+        if os.path.exists(self.path(name)):
+            if os.path.isfile(self.path(name)):
+                raise PackageError("Warning: Filename collision at {}. Skipping...".format(name), 4)
+
+            raise PackageError("Warning: Package {} exists...".format(name), 4)
+
+        umask = os.umask(0o022)
+        os.makedirs(self.path(name), exist_ok=True)
+        db = aptrepo.lib.db.PackageDB(self.directory, name, directory=self.directory)
+        values = dict(fields)
+        values.update(
+            provides=[name.lower()] if fields.get('provides') is None else [p.lower() for p in fields['provides']],
+            replaces=[] if fields.get('replaces') is None else [r.lower() for r in fields['replaces']],
+            control={},
+            directory=self.directory,
+            is_essential=False,
+            author=[],
+            override={},
+            architecture=[arch()],
+            maintainer=[socket.gethostname()],
+            files={},
+            desc="No description set" if fields.get('desc') is None else fields['desc'],
+            description=["..."] if fields.get('description') is None else '\n '.join(fields['description']),
+            homepage="",
+            depends=[],
+            recommends=[],
+            suggests=[],
+            section="misc",
+            set_version="0.1")
+        db.update(**values)
+        self._write(name, db)
+        print("Creating {} Package".format(name))
+        return db.db
+
+    def delete(self, name):
+        if not os.path.isdir(self.path(name)):
+            raise PackageError("Warning: Directory {} does not exist.".format(name), 2)
+
+        self._package(name)
+        umask = os.umask(0o022)
+        print("Removing {} Package".format(name))
+        shutil.rmtree(self.path(name))
+        self.dbs.pop(name, None)
+
+    def _correct_path(self, path):
+        if os.path.isdir(path) and not path[-1] == os.sep:
+            return path + os.sep
+
+        return path
+
+    def add_file(self, name, path, target):
+        """ Packages the file or folder at path as target """
+        db = self._package(name)
+        db.db['Files'].update({self._correct_path(path): target})
+        self._write(name, db)
+
+    def override(self, name, path, target):
+        db = self._package(name)
+        db.db['Override'].update({self._correct_path(path): target})
+        self._write(name, db)
+
+    def remove_files(self, name, paths):
+        """ Removes paths from the files and overrides of name; returns those that were there """
+        db = self._package(name)
+        removed = []
+        for rm in paths:
+            for section in ['Files', 'Override']:
+                for key in set([rm, self._correct_path(rm)]):
+                    if key in db.db[section]:
+                        del db.db[section][key]
+                        removed.append(key)
+                        print("Removed {} from database".format(key))
+
+        self._write(name, db)
+        return removed
+
+    def control(self, name, script, path):
+        if not script in DEBIAN_FILES:
+            raise PackageError("{} is not a valid debian control script name.".format(script), 9)
+
+        if not os.path.isfile(path):
+            sys.stderr.write("{} not found or is a directory.\n".format(path))
+
+        db = self.db(name)
+        db.db['Control'].update({script: path})
+        self._write(name, db)
+
+    def build(self, name, force=False):
+        """ Builds name into every profile of its database; returns the build return codes """
+        db = self._package(name)
+        retcodes = aptrepo.lib.buildcache.cached_build_package(self.directory, name, force=force, **db.db)
+        if not retcodes or any(r != 0 for r in retcodes):
+            raise PackageError("Error: Package Building Failed, control file may be bad", 7)
+
+        return retcodes
+
+    def build_all(self, names=None, jobs=None, force=False):
+        """ build_workspace() over this workspace """
+        return build_workspace(self.directory, names=names, jobs=jobs, force=force)
+
+    def update(self, name, **fields):
+        db = self._package(name)
+        db.update(**fields)
+        print("Updating {}...".format(name))
+        self._write(name, db)
+        return db.db
+
+    def info(self, name):
+        return self._package(name).db
+
+    def clean(self, name):
+        """ Removes all package files (and control files) from the database """
+        db = self._package(name)
+        db.db['Files'] = {}
+        db.db['Control'] = {}
+        self._write(name, db)
+
+    def duplicate(self, name, targets):
+        """
+        :Description:
+            Copies the folder and database of name to each of targets,
+            pointing files and control scripts kept in the package folder,
+            and the package's own provides entry, at the copy. Returns the
+            names created.
+        """
+        db = self._package(name)
+        umask = os.umask(0o022)
+        source = os.path.join(self.path(name), '')
+        created = []
+        for target in targets:
+            if os.path.exists(self.path(target)):
+                sys.stderr.write("Warning: Package {} exists...\n".format(target))
+                continue
+
+            shutil.copytree(self.path(name), self.path(target), symlinks=True,
+                            ignore=lambda d, files: [name] if os.path.join(d, '') == source else [])
+            copy = aptrepo.lib.db.PackageDB.from_dict(target, db.db)
+            moved = lambda p: os.path.join(self.path(target), p[len(source):]) if p.startswith(source) else p
+            copy.db['Files'] = {moved(k): v for k, v in copy.db['Files'].items()}
+            copy.db['Control'] = {k: moved(v) for k, v in copy.db['Control'].items()}
+            copy.db['Package']['provides'] = [target if p == name else p for p in copy.db['Package']['provides']]
+            self._write(target, copy)
+            print("Duplicating {} Package as {}".format(name, target))
+            created.append(target)
+
+        return created
+
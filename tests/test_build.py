@@ -0,0 +1,100 @@
+"""
+:Description:
+    Package file naming, the build cache and the package writers. Run from the
+    top of the tree with
+
+        PYTHONPATH=src python3 -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from subprocess import DEVNULL, check_call, check_output
+from unittest import mock
+from aptrepo.lib.buildcache import artifact_paths
+from aptrepo.lib.workspace import PackageWorkspace
+
+class ArtifactNameTest(unittest.TestCase):
+
+    def test_epoch_is_not_in_file_names(self):
+        paths = artifact_paths("ep", Package={'set_version': "1:2.0", 'architecture': ["amd64"]},
+                               Build={'profiles': ["deb", "ipk"]})
+        self.assertEqual([os.path.basename(p) for p in paths], ["ep_2.0_amd64.deb", "ep_2.0_amd64.ipk"])
+
+    @unittest.skipUnless(shutil.which("dpkg-deb"), "dpkg-deb is needed to build test packages")
+    def test_matches_dpkg_deb(self):
+        """ The expected artifact is the file dpkg-deb --build writes """
+        tmp = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmp, "tree", "DEBIAN"))
+            with open(os.path.join(tmp, "tree", "DEBIAN", "control"), 'w') as f:
+                f.write("Package: ep\nVersion: 1:2.0\nArchitecture: amd64\n"
+                        "Maintainer: Test <test@localhost>\nDescription: test package\n")
+
+            check_call(["dpkg-deb", "--build", os.path.join(tmp, "tree"), tmp], stdout=DEVNULL)
+            paths = artifact_paths("ep", Package={'set_version': "1:2.0", 'architecture': ["amd64"]},
+                                   Build={'profiles': ["deb"]})
+            self.assertEqual(sorted(os.listdir(tmp)), sorted(["tree", os.path.basename(paths[0])]))
+
+        finally:
+            shutil.rmtree(tmp)
+
+@unittest.skipUnless(shutil.which("dpkg-deb"), "dpkg-deb is needed to compare the package writers")
+class WriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        # Packages are built into the working directory
+        os.chdir(self.tmp)
+        tree = os.path.join(self.tmp, "tree")
+        os.makedirs(os.path.join(tree, "sub"))
+        with open(os.path.join(tree, "a"), 'w') as f:
+            f.write("hello\n")
+
+        with open(os.path.join(tree, "sub", "run"), 'w') as f:
+            f.write("#!/bin/sh\n")
+
+        os.chmod(os.path.join(tree, "sub", "run"), 0o755)
+        os.symlink("a", os.path.join(tree, "link"))
+        self.workspace = PackageWorkspace(os.path.join(self.tmp, "db"))
+        self.workspace.create("demo")
+        self.workspace.update("demo", architecture=["amd64"], set_version="1.0")
+        self.workspace.add_file("demo", tree, "/opt/demo")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def build(self, writer):
+        """ Builds demo with writer and returns the bytes of its .deb """
+        self.workspace.update("demo", writer=writer)
+        self.workspace.build("demo", force=True)
+        with open(os.path.join(self.tmp, "demo_1.0_amd64.deb"), 'rb') as f:
+            return f.read()
+
+    def inspect(self, data, option):
+        path = os.path.join(self.tmp, "inspect.deb")
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        lines = check_output(["dpkg-deb", option, path]).decode('utf-8').splitlines()
+        # The archive sizes depend on the compressor, not on what was packaged
+        return [l for l in lines if not l.strip().startswith("size ")]
+
+    def test_native_matches_dpkg(self):
+        """ Both writers package the same members and control, and rebuild byte for byte """
+        with mock.patch.dict(os.environ, SOURCE_DATE_EPOCH="1577934245"):
+            debs = {}
+            for writer in ["dpkg", "native"]:
+                debs[writer] = self.build(writer)
+                # Newer inputs are clamped to the epoch, so they change nothing
+                os.utime(os.path.join(self.tmp, "tree", "a"))
+                self.assertEqual(self.build(writer), debs[writer], writer)
+
+        for option in ["-c", "-I"]:
+            self.assertEqual(self.inspect(debs["native"], option), self.inspect(debs["dpkg"], option), option)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,321 @@
+"""
+:Description:
+    Publishes to a throwaway repository through the Repository API. Run from
+    the top of the tree with
+
+        PYTHONPATH=src python3 -m unittest discover -s tests
+"""
+
+import io
+import os
+import gzip
+import multiprocessing
+import shutil
+import tarfile
+import tempfile
+import unittest
+from subprocess import DEVNULL, check_call
+from unittest import mock
+from aptrepo.lib.lock import PublishQueue
+from aptrepo.lib.repository import Repository
+from aptrepo.lib.scanpackages import package_stanza, stanza_cache_path
+from aptrepo.lib.security import hash_file
+
+def make_deb(outdir, name, version, arch="amd64", description="test package"):
+    """ Builds a minimal name_version_arch.deb in outdir with dpkg-deb """
+    tree = os.path.join(outdir, "{}_{}".format(name, version))
+    os.makedirs(os.path.join(tree, "DEBIAN"))
+    with open(os.path.join(tree, "DEBIAN", "control"), 'w') as f:
+        f.write("Package: {}\nVersion: {}\nArchitecture: {}\n"
+                "Maintainer: Test <test@localhost>\nDescription: {}\n".format(name, version, arch, description))
+
+    path = os.path.join(outdir, "{}_{}_{}.deb".format(name, version, arch))
+    check_call(["dpkg-deb", "--build", tree, path], stdout=DEVNULL)
+    return path
+
+def targz(members):
+    """ A tar.gz archive of (name, bytes) members, in order """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tf:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+    return buf.getvalue()
+
+def make_ipk(outdir, name, version, arch="amd64", control_first=True):
+    """ Builds a tar.gz name_version_arch.ipk in outdir, control.tar.gz first (as apt-pkg) or last (as opkg-build) """
+    control = ("./control.tar.gz", targz([("./control", "Package: {}\nVersion: {}\nArchitecture: {}\n"
+                                            "Maintainer: Test <test@localhost>\nDescription: test package\n".format(
+                                                name, version, arch).encode('utf-8'))]))
+    data = ("./data.tar.gz", targz([("./usr/bin/" + name, b"#!/bin/sh\n")]))
+    path = os.path.join(outdir, "{}_{}_{}.ipk".format(name, version, arch))
+    with open(path, 'wb') as f:
+        f.write(targz([("./debian-binary", b"2.0\n")] + ([control, data] if control_first else [data, control])))
+
+    return path
+
+def add_in_process(start, platform, configdir, directory, path, wait):
+    """ Adds path to platform from a process of its own, once every process has started """
+    start.wait()
+    with Repository(platform, configdir, directory=directory, architecture=["amd64"]) as repo:
+        repo.apply([("add", path)], wait=wait)
+
+    if not wait:
+        # Spooled into the queue, so the publisher no longer needs it
+        os.remove(path)
+
+class FeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_ipk_feed(self):
+        """ ipks of either member order are listed in Packages, Packages.gz and Packages.stamps """
+        with Repository("stable", os.path.join(self.tmp, "cfg"), directory=os.path.join(self.tmp, "repo"),
+                        architecture=["amd64"]) as repo:
+            repo.create()
+            repo.add([make_ipk(self.tmp, "first", "1.0"), make_ipk(self.tmp, "last", "1.0", control_first=False)])
+            feed = os.path.join(repo.webroot, "dists", "stable", "main", "binary-amd64")
+            with open(os.path.join(feed, "Packages"), 'rb') as f:
+                packages = f.read()
+
+            with gzip.open(os.path.join(feed, "Packages.gz")) as f:
+                self.assertEqual(f.read(), packages)
+
+            stanzas = [dict(l.split(": ", 1) for l in s.splitlines())
+                       for s in packages.decode('utf-8').split("\n\n") if s]
+            filenames = ["first_1.0_amd64.ipk", "last_1.0_amd64.ipk"]
+            self.assertEqual([s['Package'] for s in stanzas], ["first", "last"])
+            self.assertEqual([s['Filename'] for s in stanzas], filenames)
+            for s in stanzas:
+                self.assertEqual(s['SHA256sum'], hash_file(os.path.join(feed, s['Filename']), ["sha256"])['sha256'])
+
+            with open(os.path.join(feed, "Packages.stamps")) as f:
+                self.assertEqual(f.read(), ''.join("{} {}\n".format(int(os.path.getmtime(os.path.join(feed, n))), n)
+                                                   for n in filenames))
+
+@unittest.skipUnless(shutil.which("dpkg-deb"), "dpkg-deb is needed to build test packages")
+class PublishTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.configdir = os.path.join(self.tmp, "cfg")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def repository(self, **options):
+        return Repository("stable", self.configdir, directory=os.path.join(self.tmp, "repo"),
+                          architecture=["amd64"], **options)
+
+    def test_pdiffs_with_by_hash(self):
+        """ Packages.diff/by-hash/ survives the patch cleanup of later publishes """
+        with self.repository(by_hash=True, pdiffs=5) as repo:
+            repo.create()
+            for n in range(3):
+                repo.add([make_deb(self.tmp, "pkg{:02d}".format(n), "1.0")])
+
+            index = os.path.join(repo.webroot, "dists", "stable", "main", "binary-amd64")
+            patches = [f for f in os.listdir(os.path.join(index, "Packages.diff")) if f.endswith(".gz")]
+            self.assertEqual(len(patches), 2)
+            self.assertTrue(os.path.isdir(os.path.join(index, "Packages.diff", "by-hash")))
+            self.assertEqual(repo.catalog.count("stable"), 3)
+
+    def test_versions_in_debian_order(self):
+        """ Packages lists the versions of a package in dpkg order, not string order """
+        with self.repository() as repo:
+            repo.create()
+            repo.add([make_deb(self.tmp, "pkg", "1.10"), make_deb(self.tmp, "pkg", "1.9")])
+            with open(os.path.join(repo.webroot, "dists", "stable", "main", "binary-amd64", "Packages")) as f:
+                versions = [l.split()[1] for l in f if l.startswith("Version:")]
+
+            self.assertEqual(versions, ["1.9", "1.10"])
+
+    def test_stanza_cache_is_not_published(self):
+        """ The stanza cache lives outside dists/ and still spares unchanged packages a rescan """
+        with self.repository() as repo:
+            repo.create()
+            repo.add([make_deb(self.tmp, "one", "1.0")])
+            with mock.patch("aptrepo.lib.scanpackages.package_stanza", wraps=package_stanza) as scanned:
+                repo.add([make_deb(self.tmp, "two", "1.0")])
+
+            self.assertEqual([os.path.basename(c[0][1]) for c in scanned.call_args_list], ["two_1.0_amd64.deb"])
+            self.assertTrue(os.path.isfile(stanza_cache_path(repo.webroot, "dists/stable/main/binary-amd64")))
+            for root, dirs, files in os.walk(os.path.join(repo.webroot, ".generations")):
+                self.assertEqual([f for f in files if f.startswith('.')], [])
+
+    def test_same_version_with_other_content_is_refused(self):
+        """ A published pool file keeps the content its indexes, and those kept for rollback, describe """
+        with self.repository() as repo:
+            repo.create()
+            repo.add([make_deb(self.tmp, "pkg", "1.0")])
+            index = os.path.join(repo.webroot, "dists", "stable", "main", "binary-amd64")
+            with open(os.path.join(index, "Packages")) as f:
+                published = f.read()
+
+            other = os.path.join(self.tmp, "other")
+            os.makedirs(other)
+            with self.assertRaises(Exception):
+                repo.add([make_deb(other, "pkg", "1.0", description="other content")])
+
+            repo.add([make_deb(self.tmp, "pkg", "1.1")])
+            repo.rollback()
+            with open(os.path.join(index, "Packages")) as f:
+                self.assertEqual(f.read(), published)
+
+            stanza = dict(l.rstrip("\n").split(": ", 1) for l in published.splitlines(True) if ": " in l)
+            self.assertEqual(hash_file(os.path.join(repo.webroot, stanza['Filename']), ["sha256"])['sha256'],
+                             stanza['SHA256'])
+
+    def dist_files(self, repo, names=("Release", "main/binary-amd64/Packages")):
+        contents = []
+        for name in names:
+            with open(os.path.join(repo.webroot, "dists", "stable", name)) as f:
+                contents.append(f.read())
+
+        return contents
+
+    def test_rollback_restores_indexes(self):
+        """ Rolling back the second of two publishes brings back the Release and Packages of the first """
+        with self.repository() as repo:
+            repo.create()
+            repo.add([make_deb(self.tmp, "one", "1.0")])
+            first = self.dist_files(repo)
+            repo.add([make_deb(self.tmp, "two", "1.0")])
+            self.assertNotEqual(self.dist_files(repo), first)
+
+            repo.rollback()
+            self.assertEqual(self.dist_files(repo), first)
+            self.assertEqual(repo.catalog.count("stable"), 1)
+
+    def test_retained_generation_keeps_pool_files(self):
+        """ A removed package's pool file stays while a generation kept for rollback lists it """
+        with self.repository() as repo:
+            repo.create()
+            repo.add([make_deb(self.tmp, "pkg", "1.0")])
+            repo.remove(["pkg"])
+            self.assertNotIn("pkg_1.0_amd64.deb", self.dist_files(repo)[1])
+            self.assertEqual(self.pool_files(repo), ["pool/main/p/pkg/pkg_1.0_amd64.deb"])
+
+            repo.rollback()
+            stanza = dict(l.split(": ", 1) for l in self.dist_files(repo)[1].splitlines() if ": " in l)
+            self.assertEqual(hash_file(os.path.join(repo.webroot, stanza['Filename']), ["sha256"])['sha256'],
+                             stanza['SHA256'])
+
+    def test_pruned_generations_release_pool_files(self):
+        """ Once the last generation listing a removed package is pruned, its pool file is deleted """
+        with self.repository(generations=1) as repo:
+            repo.create()
+            repo.add([make_deb(self.tmp, "pkg", "1.0")])
+            repo.remove(["pkg"])
+            self.assertEqual(self.pool_files(repo), ["pool/main/p/pkg/pkg_1.0_amd64.deb"])
+
+            repo.add([make_deb(self.tmp, "other", "1.0")])
+            self.assertEqual(self.pool_files(repo), ["pool/main/o/other/other_1.0_amd64.deb"])
+            self.assertFalse(os.path.exists(os.path.join(repo.webroot, "pool", "main", "p")))
+            self.assertEqual(len(os.listdir(os.path.join(repo.webroot, ".generations", "stable"))), 2)
+
+    def pool_files(self, repo):
+        return [os.path.relpath(os.path.join(root, f), repo.webroot)
+                for root, dirs, files in os.walk(os.path.join(repo.webroot, "pool")) for f in files]
+
+    def test_watch_rejects_file_whole(self):
+        """ A watched file refused by its second component is listed nowhere, and its pool copies go """
+        other = os.path.join(self.tmp, "other")
+        incoming = os.path.join(self.tmp, "incoming")
+        os.makedirs(other)
+        os.makedirs(incoming)
+        with self.repository(restrictions=["main", "contrib"]) as repo:
+            repo.create()
+            repo.configure(restrictions=["contrib"])
+            repo.add([make_deb(self.tmp, "pkg", "1.0")])
+            repo.configure(restrictions=["main", "contrib"])
+            shutil.move(make_deb(other, "pkg", "1.0", description="other content"), incoming)
+            shutil.move(make_deb(self.tmp, "good", "1.0"), incoming)
+            repo.watch(incoming, once=True)
+
+            self.assertEqual(sorted(os.listdir(os.path.join(incoming, "failed"))),
+                             ["pkg_1.0_amd64.deb", "pkg_1.0_amd64.deb.error"])
+            self.assertEqual(repo.catalog.count("stable"), 3)
+            self.assertEqual(sorted(self.pool_files(repo)), ["pool/contrib/g/good/good_1.0_amd64.deb",
+                                                             "pool/contrib/p/pkg/pkg_1.0_amd64.deb",
+                                                             "pool/main/g/good/good_1.0_amd64.deb"])
+
+    def test_watch_failed_commit_leaves_no_pool_files(self):
+        """ When the batch cannot be published, the pool files it placed are deleted """
+        incoming = os.path.join(self.tmp, "incoming")
+        os.makedirs(incoming)
+        os.makedirs(os.path.join(self.tmp, "gnupg"), mode=0o700)
+        with self.repository() as repo:
+            repo.create()
+            # Release cannot be signed with a key the keyring does not have
+            repo.configure(directory=repo.opts['directory'], sign_key="nobody@localhost",
+                           gnupghome=os.path.join(self.tmp, "gnupg"))
+            shutil.move(make_deb(self.tmp, "good", "1.0"), incoming)
+            repo.watch(incoming, once=True)
+
+            self.assertIn("good_1.0_amd64.deb", os.listdir(os.path.join(incoming, "failed")))
+            self.assertEqual(self.pool_files(repo), [])
+
+    def test_concurrent_adds(self):
+        """ Packages added from several processes at once are all published, waiting or not """
+        with self.repository() as repo:
+            repo.create()
+            webroot = repo.webroot
+
+        count = 6
+        debs = [make_deb(self.tmp, "pkg{}".format(n), "1.0") for n in range(count)]
+        context = multiprocessing.get_context("fork")
+        start = context.Barrier(count)
+        processes = [context.Process(target=add_in_process, args=(start, "stable", self.configdir,
+                                                                  os.path.join(self.tmp, "repo"), deb, n % 2 == 0))
+                     for n, deb in enumerate(debs)]
+        for p in processes:
+            p.start()
+
+        for p in processes:
+            p.join(60)
+
+        self.assertEqual([p.exitcode for p in processes], [0] * count)
+        with open(os.path.join(webroot, "dists", "stable", "main", "binary-amd64", "Packages")) as f:
+            packages = [l.split()[1] for l in f if l.startswith("Package:")]
+
+        self.assertEqual(sorted(packages), ["pkg{}".format(n) for n in range(count)])
+        self.assertEqual(PublishQueue(webroot).items(), [])
+
+    def test_failed_request_is_not_published(self):
+        """ A request with a bad package publishes none of its packages """
+        with self.repository() as repo:
+            repo.create()
+            good = make_deb(self.tmp, "good", "1.0")
+            bad = os.path.join(self.tmp, "bad_1.0_amd64.deb")
+            with open(bad, 'wb') as f:
+                f.write(b"not a package")
+
+            with self.assertRaises(Exception):
+                repo.apply([("add", good), ("add", bad)])
+
+            self.assertEqual(repo.catalog.count("stable"), 0)
+            self.assertFalse(os.path.exists(os.path.join(repo.webroot, "pool", "main", "g", "good")))
+            self.assertEqual(os.listdir(os.path.join(repo.webroot, ".queue", "results")), [])
+
+    def test_configdir_is_not_saved(self):
+        """ create and update write the options, not where the configuration file lives """
+        with self.repository() as repo:
+            repo.create()
+            repo.configure(directory=repo.opts['directory'], desc="updated")
+            repo.update()
+
+        with open(os.path.join(self.configdir, "stable")) as f:
+            saved = f.read()
+
+        self.assertIn("updated", saved)
+        self.assertNotIn("configdir", saved)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+:Description:
+    The repository HTTP server, run in a thread on an ephemeral port. Run
+    from the top of the tree with
+
+        PYTHONPATH=src python3 -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+import http.client
+from aptrepo.lib.server import RepositoryServer
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.webroot = os.path.join(self.tmp, "repo")
+        os.makedirs(os.path.join(self.webroot, "pool", "main"))
+        os.makedirs(os.path.join(self.webroot, ".generations"))
+        self.data = bytes(range(256)) * 16
+        with open(os.path.join(self.webroot, "pool", "main", "pkg.deb"), 'wb') as f:
+            f.write(self.data)
+
+        with open(os.path.join(self.webroot, ".catalog.db"), 'w') as f:
+            f.write("private\n")
+
+        with open(os.path.join(self.tmp, "outside"), 'w') as f:
+            f.write("private\n")
+
+        os.symlink(os.path.join(self.tmp, "outside"), os.path.join(self.webroot, "pool", "outside"))
+
+        self.loop = asyncio.new_event_loop()
+        self.server = RepositoryServer(self.webroot, host="127.0.0.1", port=0, quiet=True)
+        self.port = self.loop.run_until_complete(self.server.start()).sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        shutil.rmtree(self.tmp)
+
+    async def shutdown(self):
+        """ Stops listening and ends the connection handlers still waiting for a request """
+        self.server.close()
+        handlers = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for t in handlers:
+            t.cancel()
+
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    def get(self, target, **headers):
+        """ (status, response, body) of a GET of target, on a connection of its own """
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        try:
+            connection.request("GET", target, headers=headers)
+            response = connection.getresponse()
+            return response.status, response, response.read()
+
+        finally:
+            connection.close()
+
+    def test_range(self):
+        status, response, body = self.get("/pool/main/pkg.deb", Range="bytes=100-1099")
+        self.assertEqual(status, 206)
+        self.assertEqual(response.getheader("Content-Range"), "bytes 100-1099/{}".format(len(self.data)))
+        self.assertEqual(body, self.data[100:1100])
+
+    def test_if_none_match(self):
+        status, response, body = self.get("/pool/main/pkg.deb")
+        self.assertEqual((status, body), (200, self.data))
+
+        status, response, body = self.get("/pool/main/pkg.deb", **{"If-None-Match": response.getheader("ETag")})
+        self.assertEqual((status, body), (304, b""))
+
+    def test_hidden_and_escaping_paths(self):
+        """ Dotfiles and paths out of the webroot answer as missing files do """
+        for target in ["/.catalog.db", "/.generations/", "/pool/%2e%2e/.catalog.db", "/../outside",
+                       "/pool/%2e%2e/%2e%2e/outside", "/pool/outside", "/pool/missing.deb"]:
+            with self.subTest(target=target):
+                status, response, body = self.get(target)
+                self.assertEqual(status, 404)
+                self.assertNotIn(b"private", body)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+:Description:
+    Release signing with throwaway gpg keyrings, checked with gpgv. Run from
+    the top of the tree with
+
+        PYTHONPATH=src python3 -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from subprocess import DEVNULL, PIPE, call, check_call, check_output
+from aptrepo.lib.repository import Repository
+from aptrepo.lib.security import GpgSigner
+from test_publish import make_deb
+
+# One key per signature type the agent session builds
+KEYS = {"rsa@localhost": "rsa2048", "ed@localhost": "ed25519"}
+
+@unittest.skipUnless(all(shutil.which(t) for t in ["gpg", "gpgv", "gpg-connect-agent", "dpkg-deb"]),
+                     "gpg, gpgv and dpkg-deb are needed to sign test repositories")
+class SigningTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.gnupghome = tempfile.mkdtemp()
+        cls.env = dict(os.environ, GNUPGHOME=cls.gnupghome)
+        for uid, algo in KEYS.items():
+            check_call(["gpg", "--batch", "--passphrase", "", "--quick-gen-key", uid, algo, "sign", "never"],
+                       env=cls.env, stdout=DEVNULL, stderr=DEVNULL)
+
+        cls.keyring = os.path.join(cls.gnupghome, "trusted.gpg")
+        with open(cls.keyring, 'wb') as f:
+            f.write(check_output(["gpg", "--batch", "--export"] + list(KEYS), env=cls.env))
+
+    @classmethod
+    def tearDownClass(cls):
+        call(["gpgconf", "--kill", "gpg-agent"], env=cls.env)
+        shutil.rmtree(cls.gnupghome)
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def repository(self, platform="stable", key="rsa@localhost"):
+        return Repository(platform, os.path.join(self.tmp, "cfg"), directory=os.path.join(self.tmp, "repo"),
+                          architecture=["amd64"], sign_key=key, gnupghome=self.gnupghome)
+
+    def gpgv(self, *args):
+        return call(["gpgv", "--keyring", self.keyring] + list(args), stdout=DEVNULL, stderr=DEVNULL)
+
+    def test_signatures_verify(self):
+        """ gpgv accepts Release.gpg and InRelease, which is laid out as gpg --clearsign writes it """
+        for key in KEYS:
+            with self.subTest(key=key), self.repository("stable-" + key.split('@')[0], key) as repo:
+                repo.create()
+                repo.add([make_deb(self.tmp, key.split('@')[0], "1.0")])
+                dist = os.path.join(repo.webroot, "dists", repo.platform)
+                self.assertEqual(self.gpgv(os.path.join(dist, "Release.gpg"), os.path.join(dist, "Release")), 0)
+                self.assertEqual(self.gpgv(os.path.join(dist, "InRelease")), 0)
+
+                with open(os.path.join(dist, "InRelease")) as f:
+                    inrelease = f.read()
+
+                clearsigned = check_output(["gpg", "--batch", "--clearsign", "--digest-algo", "SHA256",
+                                            "--local-user", key, "-o", "-", os.path.join(dist, "Release")],
+                                           env=self.env, stderr=PIPE).decode('utf-8')
+                armor = "-----BEGIN PGP SIGNATURE-----"
+                self.assertEqual(inrelease[:inrelease.index(armor)], clearsigned[:clearsigned.index(armor)])
+
+    def test_unchanged_release_is_not_signed_again(self):
+        with self.repository() as repo:
+            repo.create()
+            repo.add([make_deb(self.tmp, "pkg", "1.0")])
+            dist = os.path.join(repo.webroot, "dists", "stable")
+            before = [os.stat(os.path.join(dist, f)).st_ino for f in ["Release", "Release.gpg", "InRelease"]]
+            with mock.patch.object(GpgSigner, "sign_all", autospec=True, side_effect=GpgSigner.sign_all) as sign:
+                with repo.lock:
+                    transaction = repo.transaction()
+                    transaction.republish = True
+                    transaction.commit()
+
+            self.assertEqual(sign.call_count, 0)
+            self.assertEqual([os.stat(os.path.join(dist, f)).st_ino for f in ["Release", "Release.gpg", "InRelease"]],
+                             before)
+
+    def test_platforms_of_a_publish_are_signed_together(self):
+        """ Queued requests for two platforms are published with one signing session """
+        with self.repository("stable") as stable, self.repository("testing") as testing:
+            stable.create()
+            testing.create()
+            for repo in (stable, testing):
+                repo.queue.put(repo.platform, repo.configdir, [("add", make_deb(self.tmp, repo.platform, "1.0"))],
+                               options=repo.queued_options())
+
+            with mock.patch.object(GpgSigner, "sign_all", autospec=True, side_effect=GpgSigner.sign_all) as sign:
+                results = stable.publish_queued()
+
+            self.assertEqual([r['error'] for r in results.values()], [None, None])
+            self.assertEqual(sign.call_count, 1)
+            self.assertEqual(len(sign.call_args[0][1]), 4)
+            for platform in ("stable", "testing"):
+                self.assertEqual(self.gpgv(os.path.join(stable.webroot, "dists", platform, "InRelease")), 0)
+
+if __name__ == '__main__':
+    unittest.main()